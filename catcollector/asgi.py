@@ -12,5 +12,11 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'catcollector.settings')
+# serve the async versions of the views that mostly wait (main_app/async_views.py).
+# run it with uvicorn workers under gunicorn, with the Procfile's config:
+#   GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker \
+#   gunicorn -c python:catcollector.gunicorn_conf catcollector.asgi
+# ASYNC_VIEWS=0 keeps the sync views
+os.environ.setdefault('ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
@@ -0,0 +1,9 @@
+# the url configuration under ASGI (see asgi.py): everything in urls.py, with
+# the views in main_app/async_views.py answering their urls first
+from django.urls import include, path
+
+from main_app.urls import async_urlpatterns
+
+from .urls import urlpatterns as wsgi_urlpatterns
+
+urlpatterns = [path('', include(async_urlpatterns)), *wsgi_urlpatterns]
@@ -0,0 +1,83 @@
+import gc
+import multiprocessing
+import os
+
+# gunicorn's settings for production (the Procfile):
+#   gunicorn -c python:catcollector.gunicorn_conf catcollector.wsgi
+# each of these can be changed with an environment variable:
+#   WEB_CONCURRENCY          worker processes (Heroku sets it to suit the dyno).
+#                            with more than one, set PAGE_CACHE_URL to a shared
+#                            cache (redis://, file://) to keep page caching
+#   GUNICORN_WORKER_CLASS    sync: one request at a time per worker
+#                            gthread: GUNICORN_THREADS requests at a time per worker
+#                            gevent: many at a time on greenlets (needs the gevent
+#                              and psycogreen packages)
+#                            or uvicorn.workers.UvicornWorker, with catcollector.asgi
+#   GUNICORN_MAX_REQUESTS    a worker is replaced after this many requests (plus up
+#                            to 10% jitter, so they don't all restart together),
+#                            which caps slow leaks. 0 never replaces them
+#   GUNICORN_PRELOAD         1 (the default) imports the app once in the master and
+#                            forks the workers from it - they start faster, and
+#                            share the memory the code takes instead of each
+#                            holding a copy
+# `manage.py benchmark --target workers` compares the worker classes.
+#
+# this also selects the production settings profile (DJANGO_ENV, settings.py)
+
+os.environ.setdefault('DJANGO_ENV', 'production')
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2, 8)))
+# settings.py reads it too: cached pages need a PAGE_CACHE_URL every worker
+# shares, so with the default (per-process) one and more than one worker,
+# page caching is off. the app can't see gunicorn's --workers, so pick the
+# number with WEB_CONCURRENCY rather than that
+os.environ['WEB_CONCURRENCY'] = str(workers)
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100)) # gevent
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+timeout = 30
+keepalive = 5 # Heroku's router keeps connections open, so reuse them
+
+if worker_class == 'gevent':
+    # a greenlet per request means a new thread-local database connection per
+    # request too, which CONN_MAX_AGE can't reuse - only a pool can (see
+    # catcollector/postgres/), so keep them from piling up if there isn't one
+    os.environ.setdefault('DB_CONN_MAX_AGE', '0')
+
+TEMPLATE_DIRS = ('cats', 'toys', 'main_app', 'registration', '')
+
+
+def when_ready(server):
+    # the master, just before it forks the first workers. with preload_app
+    # it has the app imported already; load everything else a request would
+    # (every view, every template) here too, so the workers start with it
+    # instead of each doing it on their first requests
+    if not preload_app:
+        return
+    from django.conf import settings
+    from django.db import connections
+    from django.template.loader import get_template
+    from django.urls import get_resolver
+
+    get_resolver().url_patterns
+    templates = settings.BASE_DIR / 'main_app' / 'templates'
+    for folder in TEMPLATE_DIRS:
+        for path in sorted((templates / folder).glob('*.html')):
+            get_template(str(path.relative_to(templates)))
+    # the workers can't share the master's connections
+    connections.close_all()
+    # the garbage collector writing to every object it looks at would copy the
+    # shared pages into each worker one by one. leave what's loaded so far out
+    # of its way
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # psycopg2 blocks the whole process while it waits on Postgres unless
+        # it's told to yield to other greenlets
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
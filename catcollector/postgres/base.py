@@ -0,0 +1,154 @@
+import os
+import threading
+
+import psycopg2
+from django.db.backends.postgresql import base, creation
+from psycopg2 import extensions, extras
+
+from .pool import Pool, PoolTimeout
+
+# Django's own Postgres backend, plus the two things it only gets in later
+# versions (CONN_HEALTH_CHECKS in 4.1, pooling in 5.1):
+#
+#   CONN_HEALTH_CHECKS  a connection kept open between requests (CONN_MAX_AGE)
+#                       is checked with a SELECT 1 the first time each request
+#                       uses it, and quietly replaced if the server, a restart
+#                       or a proxy has dropped it - instead of that request
+#                       failing with "server closed the connection"
+#   POOL                {'size': 8, 'timeout': 10, 'max_age': 600} keeps up to
+#                       `size` connections per process in a pool (pool.py).
+#                       each request borrows one and gives it back when Django
+#                       would close it, so this wants CONN_MAX_AGE = 0. unlike
+#                       CONN_MAX_AGE, it works under ASGI, where every request
+#                       runs in a new thread and a connection kept per thread
+#                       is never used again
+#
+# settings.py switches to this backend (and fills these in from the DB_*
+# environment variables) whenever DATABASE_URL points at Postgres
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def close_pools():
+    # closes every pool's idle connections, in this process
+    for pool in list(_pools.values()):
+        pool.close()
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # the pool would still have connections to the test database open,
+        # and Postgres won't drop a database anyone is connected to
+        close_pools()
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.health_check_done = False
+
+    @property
+    def pool(self):
+        options = self.settings_dict.get('POOL') or {}
+        if not options.get('size'):
+            return None
+        # keyed by what it connects to, so the test runner switching NAME to
+        # the test database gets a pool of its own, and by process, so workers
+        # forked by `gunicorn --preload` don't share the sockets of a pool the
+        # master happened to open
+        params = self.get_connection_params()
+        key = (self.alias, os.getpid(), tuple(sorted((k, str(v)) for k, v in params.items())))
+        pool = _pools.get(key)
+        if pool is None:
+            with _pools_lock:
+                pool = _pools.get(key)
+                if pool is None:
+                    pool = _pools[key] = Pool(
+                        lambda: psycopg2.connect(**params),
+                        options['size'], timeout=options.get('timeout', 10.0),
+                        max_age=options.get('max_age'),
+                        check=_usable if self.settings_dict.get('CONN_HEALTH_CHECKS') else None,
+                        reset=_reset,
+                    )
+        return pool
+
+    def get_new_connection(self, conn_params):
+        pool = self.pool
+        if pool is None:
+            return super().get_new_connection(conn_params)
+        try:
+            connection = pool.get()
+        except PoolTimeout as error:
+            raise psycopg2.OperationalError(str(error)) from error
+        try:
+            # the same setup super() does on a brand new connection: isolation
+            # level and jsonb loading. both are local, neither costs a query
+            isolation_level = self.settings_dict['OPTIONS'].get('isolation_level')
+            if isolation_level is None:
+                self.isolation_level = connection.isolation_level
+            else:
+                self.isolation_level = isolation_level
+                if connection.isolation_level != isolation_level:
+                    connection.set_session(isolation_level=isolation_level)
+            extras.register_default_jsonb(conn_or_curs=connection, loads=lambda x: x)
+        except Exception:
+            pool.put(connection)
+            raise
+        return connection
+
+    def connect(self):
+        # a new connection (or one the pool just checked) doesn't need checking.
+        # set first, as connect() itself goes through ensure_connection()
+        self.health_check_done = True
+        super().connect()
+
+    def ensure_connection(self):
+        if (
+            self.connection is not None
+            and not self.health_check_done
+            and self.settings_dict.get('CONN_HEALTH_CHECKS')
+        ):
+            self.health_check_done = True
+            if not self.in_atomic_block and not self.is_usable():
+                self.close()
+        super().ensure_connection()
+
+    def close_if_unusable_or_obsolete(self):
+        # runs as each request starts and finishes (close_old_connections), so
+        # this is where a kept connection is marked as due for a check
+        super().close_if_unusable_or_obsolete()
+        self.health_check_done = False
+
+    def _close(self):
+        pool = self.pool
+        if pool is None or self.connection is None:
+            return super()._close()
+        with self.wrap_database_errors:
+            pool.put(self.connection)
+
+
+def _usable(connection):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+    except psycopg2.Error:
+        return False
+    return True
+
+
+def _reset(connection):
+    # whatever a borrower left open gets rolled back; a connection that's
+    # closed or in an unknown state raises, and the pool throws it away
+    if connection.closed:
+        raise psycopg2.InterfaceError('connection already closed')
+    status = connection.get_transaction_status()
+    if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+        raise psycopg2.OperationalError('connection is broken')
+    if status != extensions.TRANSACTION_STATUS_IDLE:
+        connection.rollback()
+    if not connection.autocommit:
+        connection.autocommit = True
@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import deque
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class Pool:
+    """
+    a small thread-safe pool of database connections for one process. at most
+    `size` are handed out at once; get() waits up to `timeout` seconds for one
+    to come back before giving up. idle connections are reused newest first
+    (the oldest ones are the likeliest to have been dropped by the server or a
+    proxy), and any older than `max_age` seconds are closed instead of reused.
+
+    connect() makes a new connection, check(conn) says whether an idle one
+    still works (None skips the check) and reset(conn) readies one that's
+    coming back for the next user - it should raise if it can't
+    """
+
+    def __init__(self, connect, size, timeout=10.0, max_age=None, check=None, reset=None):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.check = check
+        self.reset = reset
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = deque() # (connection, when it was opened)
+        self._opened = {} # id(connection): when it was opened, for the ones handed out
+        self._lock = threading.Lock()
+
+    def get(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(
+                f'no database connection came free within {self.timeout}s '
+                f'(all {self.size} in use)'
+            )
+        try:
+            while True:
+                with self._lock:
+                    conn, opened = self._idle.pop() if self._idle else (None, None)
+                if conn is None:
+                    conn, opened = self.connect(), time.monotonic()
+                elif self._expired(opened) or (self.check and not self.check(conn)):
+                    self._discard(conn)
+                    continue
+                with self._lock:
+                    self._opened[id(conn)] = opened
+                return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def put(self, conn):
+        # every connection get() hands out has to come back through here, even
+        # a broken one, or its slot is gone for good
+        with self._lock:
+            opened = self._opened.pop(id(conn), time.monotonic())
+        try:
+            if self._expired(opened):
+                self._discard(conn)
+                return
+            try:
+                if self.reset:
+                    self.reset(conn)
+            except Exception:
+                self._discard(conn)
+            else:
+                with self._lock:
+                    self._idle.append((conn, opened))
+        finally:
+            self._slots.release()
+
+    def close(self):
+        # closes the idle connections. ones that are handed out are closed as
+        # they come back only if they're too old, so call this at shutdown
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def _expired(self, opened):
+        return self.max_age is not None and time.monotonic() - opened >= self.max_age
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
@@ -11,6 +11,9 @@ https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
 import django_heroku # this was auto added but needs to be here if we use heroku
+import dj_database_url
+import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -24,7 +27,14 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = 'django-insecure-&3gayhloa^e$kx74frq7nz)ge*tj#4rl@5d_$19b23czx1f&1*'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# DJANGO_ENV=production is the production profile (catcollector/gunicorn_conf.py
+# sets it): DEBUG off, so no debug pages and no record of every query kept on
+# each connection, templates compiled once per process (TEMPLATES below) and
+# no per-request metrics lines in the log. it runs several worker processes,
+# so set PAGE_CACHE_URL to a shared cache too, or there's no page caching
+# (see Caches below)
+PRODUCTION = os.environ.get('DJANGO_ENV') == 'production'
+DEBUG = not PRODUCTION
 
 ALLOWED_HOSTS = []
 
@@ -46,6 +56,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'main_app.metrics.QueryMetricsMiddleware', # per-view query/latency metrics
+    'main_app.replicas.ReplicaMiddleware', # read replica routing, above sessions
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -54,11 +66,15 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'catcollector.urls'
+# under ASGI (asgi.py sets ASYNC_VIEWS) the busiest views are async
+ROOT_URLCONF = (
+    'catcollector.asgi_urls' if os.environ.get('ASYNC_VIEWS') == '1' else 'catcollector.urls'
+)
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django's own template engine, timing renders for main_app/metrics.py
+        'BACKEND': 'main_app.metrics.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -72,6 +88,17 @@ TEMPLATES = [
     },
 ]
 
+if PRODUCTION:
+    # parse each template the first time it's used and keep it, rather than
+    # reading and parsing it again for every render
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+
 WSGI_APPLICATION = 'catcollector.wsgi.application'
 
 
@@ -86,6 +113,60 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+# rendered cat pages and cards go in the 'pages' cache (main_app/caching.py). pick
+# its backend with the PAGE_CACHE_URL environment variable:
+#   locmem://               each process keeps its own (the default)
+#   file:///tmp/cat-pages   shared by every process on the machine
+#   redis://localhost:6379  shared by every machine (needs the redis package)
+# a cached page is retired by bumping a version number kept in that same cache,
+# by whichever process handled the change. with locmem:// the other processes
+# never hear about it and keep serving the old page (with a fresh ETag, so the
+# browser hangs on to it too) - so page caching is turned off when there's
+# more than one worker process (WEB_CONCURRENCY) and nothing shared to keep
+# the versions in. the cards don't have that problem (their keys come from the
+# database), so they're cached either way
+
+PAGE_CACHE_URL = os.environ.get('PAGE_CACHE_URL', 'locmem://')
+if PAGE_CACHE_URL.startswith('redis://'):
+    _page_cache = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': PAGE_CACHE_URL,
+    }
+elif PAGE_CACHE_URL.startswith('file://'):
+    _page_cache = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': PAGE_CACHE_URL[len('file://'):],
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+else:
+    _page_cache = {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'cat-pages',
+        # it holds a card for every cat and toy on the pages people look at
+        # too (main_app/templatetags/cards.py), far more than the default 300
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'pages': _page_cache,
+}
+PAGE_CACHE_ALIAS = 'pages'
+PAGE_CACHE_SHARED = not PAGE_CACHE_URL.startswith('locmem://')
+# how long a cached page may live, in seconds (0 turns page caching off)
+PAGE_CACHE_TIMEOUT = int(os.environ.get('PAGE_CACHE_TIMEOUT', 300))
+if not PAGE_CACHE_SHARED and int(os.environ.get('WEB_CONCURRENCY', 1)) > 1:
+    PAGE_CACHE_TIMEOUT = 0
+# and a cat or toy card (0 renders every card every time). a card's key
+# changes along with the object, so this only decides how long an unused one
+# hangs around
+CARD_CACHE_TIMEOUT = int(os.environ.get('CARD_CACHE_TIMEOUT', 3600))
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -121,6 +202,32 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/4.0/howto/static-files/
 
 STATIC_URL = 'static/'
+
+# uploaded photos. PHOTO_STORAGE picks where they go: main_app.storage.S3Storage
+# for the real bucket, or main_app.storage.LocalStorage to keep them in
+# MEDIA_ROOT (no AWS account needed)
+PHOTO_STORAGE = 'main_app.storage.S3Storage'
+S3_BASE_URL = 'https://s3-us-west-1.amazonaws.com/'
+S3_BUCKET = 'tuesdayscatcollector'
+MEDIA_URL = 'media/'
+MEDIA_ROOT = BASE_DIR / 'media'
+# uploads run in the background (main_app/uploads.py). WORKERS is the number of
+# upload threads per process (0 = upload inline, during the request), QUEUE_SIZE
+# how many uploads may be waiting at once, and a failed upload is tried
+# ATTEMPTS times, waiting BACKOFF seconds and then twice as long each time
+PHOTO_UPLOAD_WORKERS = 4
+PHOTO_UPLOAD_QUEUE_SIZE = 32
+PHOTO_UPLOAD_ATTEMPTS = 4
+PHOTO_UPLOAD_BACKOFF = 0.5
+PHOTO_SPOOL_DIR = BASE_DIR / 'photo_spool'
+# direct (browser -> storage) uploads: the biggest file a presigned upload will
+# accept, and how many seconds the presigned form stays valid
+PHOTO_UPLOAD_MAX_SIZE = 10 * 1024 * 1024
+PHOTO_UPLOAD_URL_EXPIRES = 300
+# thumbnail widths (in px) made for every photo, next to a WebP copy of each,
+# and the JPEG/WebP quality they're saved at
+PHOTO_THUMBNAIL_WIDTHS = (320, 640, 1280)
+PHOTO_DERIVATIVE_QUALITY = 80
 # Add this variable below to specify where successful logins should redirect to
 LOGIN_REDIRECT_URL = '/cats/'
 # make sure the forward slash is there, or else this will just append to the
@@ -128,6 +235,60 @@ LOGIN_REDIRECT_URL = '/cats/'
 # 'accounts/profile' 
 LOGOUT_REDIRECT_URL = '/'
 
+# how many cats the index shows per page, and the most a client can ask for
+# with ?page_size=
+CATS_PAGE_SIZE = 25
+CATS_MAX_PAGE_SIZE = 100
+# same idea for the "Available Toys" list on the cat details page
+TOYS_PAGE_SIZE = 20
+TOYS_MAX_PAGE_SIZE = 100
+# default and largest page sizes for the JSON API (main_app/api.py)
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+# how many results /search/ returns for each of cats and toys, and the most a
+# client can ask for with ?limit=
+SEARCH_LIMIT = 10
+SEARCH_MAX_LIMIT = 50
+# days of feeding history on the cat details page, how far back the index's
+# "missed meals" count looks, and the default/longest feeding calendar (weeks)
+FEEDING_HISTORY_DAYS = 14
+MISSED_MEALS_DAYS = 7
+CALENDAR_WEEKS = 26
+CALENDAR_MAX_WEEKS = 104
+# the most feedings one bulk_add_feeding request may log
+BULK_FEEDING_MAX = 5000
+# exports (main_app/exports.py) read this many rows from the database at a time,
+# and send the file out in pieces of roughly this many bytes
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_BUFFER_SIZE = 64 * 1024
+# `manage.py import_cats` writes this many rows per bulk_create/transaction
+IMPORT_CHUNK_SIZE = 1000
+
+# the most queries each view (by url name) may run per request, counting the
+# session and user lookups. going over logs a warning, and fails the request
+# under `manage.py test` - see main_app/metrics.py. views not listed get
+# QUERY_BUDGET_DEFAULT (None for no limit)
+QUERY_BUDGETS = {
+    'home': 3,
+    'about': 3,
+    'index': 5,
+    'details': 10,
+    'available_toys': 4,
+    'feeding_calendar': 5,
+    'toys_index': 4,
+    'detail': 4,
+    'search': 8,
+    'api_list': 6,
+    'api_detail': 6,
+    'bulk_add_feeding': 14,
+}
+QUERY_BUDGET_DEFAULT = 20
+TESTING = sys.argv[1:2] == ['test']
+QUERY_BUDGETS_STRICT = TESTING
+# /metrics wants this as a bearer token (Authorization: Bearer ...). without it,
+# only logged in staff can see the metrics
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
@@ -135,3 +296,75 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Configure Django App for Heroku.
 django_heroku.settings(locals())
+
+# read replicas (main_app/replicas.py). DATABASE_REPLICA_URLS is a comma
+# separated list of database urls, which become the aliases replica1,
+# replica2... the views in REPLICA_VIEWS read from them, except for visitors who
+# wrote something in the last REPLICA_PIN_SECONDS. to try it out locally with
+# two SQLite files:
+#   cp db.sqlite3 /tmp/replica.sqlite3
+#   DATABASE_REPLICA_URLS=sqlite:////tmp/replica.sqlite3 python manage.py runserver
+# and `manage.py sync_replicas` to copy the primary over again, as replication would
+DATABASE_REPLICAS = []
+if TESTING:
+    # the replica tests get a database of their own to copy rows into by hand.
+    # it's only created for tests that ask for it (databases = {..., 'replica'})
+    DATABASES['replica'] = {**DATABASES['default'], 'TEST': {
+        # sqlite's test databases are in memory already, one per alias
+        'NAME': None if 'sqlite' in DATABASES['default']['ENGINE']
+        else f'test_{DATABASES["default"]["NAME"]}_replica',
+    }}
+else:
+    for _url in filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(',')):
+        DATABASE_REPLICAS.append(f'replica{len(DATABASE_REPLICAS) + 1}')
+        DATABASES[DATABASE_REPLICAS[-1]] = dj_database_url.parse(_url.strip())
+DATABASE_ROUTERS = ['main_app.replicas.PrimaryReplicaRouter']
+REPLICA_VIEWS = ('index', 'details', 'toys_index', 'detail')
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 5))
+
+# Postgres connection reuse (catcollector/postgres/). django_heroku has just
+# set DATABASES from DATABASE_URL; these environment variables tune it:
+#   DB_CONN_MAX_AGE   seconds a connection is kept for later requests (600).
+#                     0 opens a new one for every request
+#   DB_HEALTH_CHECKS  check a kept connection still works before a request
+#                     uses it, and reconnect if not (1, or 0 to skip the check)
+#   DB_POOL_SIZE      if set, each process keeps a pool of up to this many
+#                     connections that requests borrow and give back, which
+#                     also works for the async views. DB_CONN_MAX_AGE is then
+#                     how long a pooled connection lives
+#   DB_POOL_TIMEOUT   seconds a request waits for a free pooled connection (10)
+# without a pool, async views get a new connection per request: under ASGI
+# each request runs in a thread of its own, so a kept one would never be used
+# again (see the benchmark in `manage.py bench_connections`)
+_pool_size = int(os.environ.get('DB_POOL_SIZE', 0))
+_conn_max_age = int(os.environ.get('DB_CONN_MAX_AGE', 600))
+if not _pool_size and os.environ.get('ASYNC_VIEWS') == '1':
+    _conn_max_age = 0
+for _db in DATABASES.values():
+    if _db['ENGINE'] not in (
+        'django.db.backends.postgresql', 'django.db.backends.postgresql_psycopg2'
+    ):
+        continue
+    _db.update(
+        ENGINE='catcollector.postgres',
+        CONN_MAX_AGE=0 if _pool_size else _conn_max_age,
+        CONN_HEALTH_CHECKS=os.environ.get('DB_HEALTH_CHECKS', '1') == '1',
+        POOL={
+            'size': _pool_size,
+            'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+            'max_age': _conn_max_age or None,
+        },
+    )
+
+# one JSON line per request from main_app/metrics.py. django_heroku has just
+# replaced LOGGING, so this has to come after it. by default only the query
+# budget warnings show - METRICS_LOG_LEVEL=INFO logs every request as well.
+# the totals at /metrics are kept either way
+LOGGING = locals()['LOGGING'] # set by django_heroku.settings(), which flake8 can't see
+LOGGING['formatters']['metrics'] = {'format': '%(message)s'}
+LOGGING['handlers']['metrics'] = {'class': 'logging.StreamHandler', 'formatter': 'metrics'}
+LOGGING['loggers']['main_app.metrics'] = {
+    'handlers': ['metrics'],
+    'level': os.environ.get('METRICS_LOG_LEVEL', 'WARNING'),
+    'propagate': False,
+}
@@ -13,6 +13,8 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
+from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include # add include
 
@@ -22,6 +24,9 @@ urlpatterns = [
     # include the built-in auth urls for the built-in views
     path('accounts/', include('django.contrib.auth.urls')),
 ]
+# serves photos kept by LocalStorage while DEBUG is on (static() does nothing
+# once DEBUG is off)
+urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
 """
 including the auth path above imports all of these URL patterns:
@@ -0,0 +1,155 @@
+from functools import wraps
+
+from django.conf import settings
+from django.http import Http404, JsonResponse
+
+from .models import Cat, Feeding, Photo, Toy
+from .pagination import get_page_size, keyset_page
+
+# a small read-only JSON API for the mobile app, at /api/<resource>/.
+#
+#   /api/cats/?fields=name,age&include=feedings,toys&fields[feedings]=date,meal
+#
+# fields= picks which columns come back (id always does), include= embeds the
+# related objects listed under each resource's "include" below, and
+# fields[<include>]= trims those too. lists are keyset paginated by id: follow
+# "next" until it's null.
+#
+# everything is read with values(), so no model instances get built, and one
+# response costs one query for the page plus one per include - never a query
+# per row. like cats_index, you only ever see your own cats (and their
+# feedings and photos); toys are shared by everyone, like on ToyList.
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _own_cats(request):
+    return Cat.objects.filter(user=request.user)
+
+
+RESOURCES = {
+    'cats': {
+        'queryset': _own_cats,
+        'fields': ('id', 'name', 'breed', 'description', 'age', 'updated_at'),
+        'include': {
+            'feedings': (lambda request, ids: Feeding.objects.filter(cat_id__in=ids),
+                         'cat_id', ('id', 'date', 'meal')),
+            'photos': (lambda request, ids: Photo.objects.filter(cat_id__in=ids),
+                       'cat_id', ('id', 'url', 'status', 'derivatives')),
+            'toys': (lambda request, ids: Cat.toys.through.objects.filter(cat_id__in=ids),
+                     'cat_id', ('toy__id', 'toy__name', 'toy__color')),
+        },
+    },
+    'feedings': {
+        'queryset': lambda request: Feeding.objects.filter(cat__user=request.user),
+        'fields': ('id', 'cat_id', 'date', 'meal', 'updated_at'),
+        'filters': {'cat': 'cat_id'},
+        'include': {},
+    },
+    'photos': {
+        'queryset': lambda request: Photo.objects.filter(cat__user=request.user),
+        'fields': ('id', 'cat_id', 'url', 'status', 'derivatives', 'updated_at'),
+        'filters': {'cat': 'cat_id'},
+        'include': {},
+    },
+    'toys': {
+        'queryset': lambda request: Toy.objects.all(),
+        'fields': ('id', 'name', 'color', 'updated_at'),
+        'include': {
+            # just your cats that have the toy
+            'cats': (lambda request, ids: Cat.toys.through.objects.filter(
+                        toy_id__in=ids, cat__user=request.user),
+                     'toy_id', ('cat__id', 'cat__name')),
+        },
+    },
+}
+
+
+def _pick_fields(requested, allowed, always=()):
+    if not requested:
+        return list(allowed)
+    names = [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        raise BadRequest(f'unknown field(s): {", ".join(unknown)}')
+    return list(dict.fromkeys([*always, *names])) # keeps order, drops repeats
+
+
+def _clean(row):
+    # toy__name -> name etc. for embedded objects
+    return {key.split('__')[-1]: value for key, value in row.items()}
+
+
+def _embed(request, resource, rows):
+    # for each include, one query for every row on the page at once
+    names = [name for name in request.GET.get('include', '').split(',') if name]
+    ids = [row['id'] for row in rows]
+    for name in names:
+        if name not in resource['include']:
+            raise BadRequest(f'unknown include: {name}')
+        queryset, link, allowed = resource['include'][name]
+        # fields[toys]=name asks for toy__name - embedded fields are picked by
+        # the names they come back under
+        paths = {field.split('__')[-1]: field for field in allowed}
+        picked = _pick_fields(request.GET.get(f'fields[{name}]'), paths, ['id'])
+        fields = [paths[field] for field in picked]
+        grouped = {row_id: [] for row_id in ids}
+        for related in queryset(request, ids).values(link, *fields):
+            grouped[related.pop(link)].append(_clean(related))
+        for row in rows:
+            row[name] = grouped[row['id']]
+    return rows
+
+
+def _queryset(request, resource):
+    queryset = resource['queryset'](request)
+    for param, field in resource.get('filters', {}).items():
+        if param in request.GET:
+            try:
+                queryset = queryset.filter(**{field: int(request.GET[param])})
+            except ValueError:
+                raise BadRequest(f'{param} should be a number')
+    fields = _pick_fields(request.GET.get('fields'), resource['fields'], ['id'])
+    return queryset.values(*fields)
+
+
+def api_login_required(view):
+    # like @login_required, but an API client gets a 401 instead of being sent
+    # to the login page
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': 'log in first'}, status=401)
+        try:
+            return view(request, *args, **kwargs)
+        except BadRequest as error:
+            return JsonResponse({'error': str(error)}, status=400)
+    return wrapper
+
+
+def _resource(name):
+    if name not in RESOURCES:
+        raise Http404
+    return RESOURCES[name]
+
+
+@api_login_required
+def api_list(request, resource):
+    resource = _resource(resource)
+    page_size = get_page_size(request, settings.API_PAGE_SIZE, settings.API_MAX_PAGE_SIZE)
+    rows, next_cursor = keyset_page(
+        _queryset(request, resource), ('id',), request.GET.get('after'), page_size
+    )
+    data = _embed(request, resource, rows)
+    return JsonResponse({'data': data, 'next': next_cursor})
+
+
+@api_login_required
+def api_detail(request, resource, pk):
+    resource = _resource(resource)
+    row = _queryset(request, resource).filter(id=pk).first()
+    if row is None:
+        return JsonResponse({'error': 'not found'}, status=404)
+    return JsonResponse({'data': _embed(request, resource, [row])[0]})
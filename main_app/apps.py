@@ -1,6 +1,20 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def install_search(sender, using, **kwargs):
+    # later migrations that rebuild the cat or toy table on SQLite drop the
+    # search triggers with it, so put back anything that's missing after every
+    # migrate (it does nothing if it's all there)
+    from django.db import connections
+    from . import search
+    search.install(connections[using])
 
 
 class MainAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'main_app'
+
+    def ready(self):
+        from . import signals # noqa: F401 - importing it connects the receivers
+        post_migrate.connect(install_search, sender=self)
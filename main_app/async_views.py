@@ -0,0 +1,139 @@
+import logging
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.shortcuts import redirect, render
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+from . import etags, rollups, storage, uploads
+from .caching import TOYS_VERSION_KEY, cache_page_per_user, cat_version_key, user_version_key
+from .forms import FeedingForm
+from .models import Cat, Photo
+from .pagination import get_page_size, keyset_page
+from .views import available_toys_page, photo_key, prefetch_counted, today_for
+
+logger = logging.getLogger(__name__)
+
+# async versions of the views that spend most of their time waiting - on the
+# database, or on S3 in add_photo's case. catcollector/asgi.py routes the same
+# urls here (see catcollector/asgi_urls.py), so under uvicorn a worker keeps
+# serving other requests while one of these waits, instead of tying up a
+# thread each like the sync views in views.py do under gunicorn.
+#
+# Django 4.0's ORM is sync only (aget(), acount() and friends arrive in 4.1),
+# so every bit of database work goes through sync_to_async - batched, one hop
+# per request where possible, since each hop costs a trip to another thread.
+# the pages they render are the same as the sync views'.
+
+_render = sync_to_async(render)
+
+
+def login_required(view):
+    # django.contrib.auth's login_required, for async views
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        # request.user is loaded from the session the first time it's used,
+        # which is a query, so look at it off the event loop
+        if not await sync_to_async(lambda: request.user.is_authenticated)():
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+def condition(etag_func):
+    # @condition(etag_func=...) from django.views.decorators.http, for async views
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            etag = await sync_to_async(etag_func)(request, *args, **kwargs)
+            etag = None if etag is None else quote_etag(etag)
+            response = get_conditional_response(request, etag=etag)
+            if response is None:
+                response = await view(request, *args, **kwargs)
+            if request.method in ('GET', 'HEAD') and etag:
+                response.headers.setdefault('ETag', etag)
+            return response
+        return wrapper
+    return decorator
+
+
+@login_required
+@condition(etag_func=etags.cats_index_etag)
+@cache_page_per_user('index', lambda request: [user_version_key(request.user.pk)])
+async def cats_index(request):
+    today = today_for(request)
+    cats = (
+        Cat.objects.filter(user=request.user).with_summary(today)
+        .with_missed_meals(settings.MISSED_MEALS_DAYS, today)
+    )
+    page_size = get_page_size(request, settings.CATS_PAGE_SIZE, settings.CATS_MAX_PAGE_SIZE)
+    cats, next_cursor = await sync_to_async(keyset_page)(
+        cats, ('name', 'id'), request.GET.get('after'), page_size
+    )
+    return await _render(request, 'cats/index.html', {
+        'cats': cats, 'next_cursor': next_cursor, 'page_size': page_size,
+        'missed_meals_days': settings.MISSED_MEALS_DAYS,
+        'is_first_page': not request.GET.get('after'),
+    })
+
+
+@login_required
+@condition(etag_func=etags.cats_details_etag)
+@cache_page_per_user(
+    'details', lambda request, cat_id: [cat_version_key(cat_id), TOYS_VERSION_KEY]
+)
+async def cats_details(request, cat_id):
+    today = today_for(request)
+
+    def load():
+        # the cat, its feeding history and a page of toys in one trip
+        cat = Cat.objects.with_feeding_status(today).get(id=cat_id)
+        prefetch_counted(cat)
+        history = rollups.history(cat.id, today, settings.FEEDING_HISTORY_DAYS)
+        return (cat, history, *available_toys_page(request, cat.id))
+
+    cat, history, toys, next_cursor = await sync_to_async(load)()
+    return await _render(request, 'cats/details.html', {
+        'cat': cat, 'feeding_form': FeedingForm(), 'toys': toys,
+        'toys_next': next_cursor, 'toy_q': request.GET.get('toy_q', ''),
+        'history': history, 'missed_meals': sum(missed for _, _, missed in history),
+        'history_days': settings.FEEDING_HISTORY_DAYS,
+    })
+
+
+@login_required
+async def add_photo(request, cat_id):
+    # unlike views.add_photo, the upload happens right here: waiting on S3
+    # costs an async worker nothing, and the photo is ready when the details
+    # page comes back. if storage says no, the photo goes to the spool and the
+    # retrying upload workers (uploads.py), just as it would have from the sync view
+    photo_file = await sync_to_async(lambda: request.FILES.get('photo-file'))()
+    if photo_file:
+        key = photo_key(photo_file.name)
+        photo = await sync_to_async(Photo.objects.create)(
+            url=storage.get_storage().url(key), key=key, cat_id=cat_id, status=Photo.PENDING
+        )
+        try:
+            await storage.asave(photo_file, key)
+        except Exception:
+            logger.warning('upload failed for photo %s, spooling it for a retry', photo.id,
+                           exc_info=True)
+            await sync_to_async(uploads.enqueue)(photo, photo_file)
+        else:
+            await sync_to_async(uploads.uploaded)(photo.id)
+    return redirect('details', cat_id=cat_id)
+
+
+@login_required
+async def assoc_toy(request, cat_id, toy_id):
+    await sync_to_async(lambda: Cat.objects.get(id=cat_id).toys.add(toy_id))()
+    return redirect('details', cat_id=cat_id)
+
+
+@login_required
+async def assoc_toy_delete(request, cat_id, toy_id):
+    await sync_to_async(lambda: Cat.objects.get(id=cat_id).toys.remove(toy_id))()
+    return redirect('details', cat_id=cat_id)
@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import time
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+from . import replicas
+
+# whole-page caching for cats_index and cats_details, per user.
+#
+# instead of hunting down and deleting every cached page when something changes,
+# each page's cache key includes a "version" number for the things it shows - the
+# user's cats for the index, one cat for its details page, and the toy catalogue.
+# signals.py bumps the matching version whenever a Cat, Feeding, Photo, Toy or a
+# cat's toys change, which is a single cache write no matter how many pages
+# depended on it. pages under the old version simply never get asked for again
+# and expire on their own.
+#
+# which cache backend holds all this is picked with PAGE_CACHE_URL in settings.
+
+HITS, MISSES = 'cats:stats:hits', 'cats:stats:misses'
+
+
+def page_cache():
+    return caches[settings.PAGE_CACHE_ALIAS]
+
+
+def user_version_key(user_id):
+    return f'cats:v:user:{user_id}'
+
+
+def cat_version_key(cat_id):
+    return f'cats:v:cat:{cat_id}'
+
+
+TOYS_VERSION_KEY = 'cats:v:toys'
+
+
+def bump(*keys):
+    cache = page_cache()
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            # never set, or already evicted. start from the clock rather than 1
+            # so we can't land back on a version some old page was cached under
+            cache.set(key, time.time_ns(), None)
+
+
+def _versions(keys):
+    cache = page_cache()
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, time.time_ns(), None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def _count(stat, kind):
+    cache = page_cache()
+    key = f'{stat}:{kind}'
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, None)
+        cache.incr(key)
+
+
+def stats():
+    # {'index': {'hits': 12, 'misses': 3}, 'details': {...}}
+    cache = page_cache()
+    kinds = ('index', 'details', 'calendar')
+    counts = cache.get_many([f'{stat}:{kind}' for stat in (HITS, MISSES) for kind in kinds])
+    return {
+        kind: {
+            'hits': counts.get(f'{HITS}:{kind}', 0),
+            'misses': counts.get(f'{MISSES}:{kind}', 0),
+        }
+        for kind in kinds
+    }
+
+
+def cache_page_per_user(kind, version_keys):
+    """
+    caches a view's html for PAGE_CACHE_TIMEOUT seconds. version_keys(request,
+    **kwargs) lists the version keys the page depends on. the key also includes
+    the user, today's date (fed-today changes at midnight), the query string and
+    the visitor's CSRF cookie, because pages with forms have a CSRF token baked
+    into them that only matches that cookie. works on async views too
+    """
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if request.method != 'GET' or not settings.PAGE_CACHE_TIMEOUT:
+                    return await view(request, *args, **kwargs)
+                key, cached = await sync_to_async(_lookup)(kind, version_keys, request, kwargs)
+                if cached is not None:
+                    return cached
+                response = await view(request, *args, **kwargs)
+                await sync_to_async(_store)(key, request, response)
+                return response
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'GET' or not settings.PAGE_CACHE_TIMEOUT:
+                return view(request, *args, **kwargs)
+            key, cached = _lookup(kind, version_keys, request, kwargs)
+            if cached is not None:
+                return cached
+            response = view(request, *args, **kwargs)
+            _store(key, request, response)
+            return response
+        return wrapper
+    return decorator
+
+
+def _lookup(kind, version_keys, request, kwargs):
+    # (cache key, cached response or None)
+    from .views import today_for
+    versions = _versions(version_keys(request, **kwargs))
+    raw = '|'.join(map(str, [
+        request.user.pk, today_for(request), request.get_full_path(),
+        request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''), *versions,
+    ]))
+    key = f'cats:page:{kind}:' + hashlib.sha256(raw.encode()).hexdigest()
+    cached = page_cache().get(key)
+    if cached is None:
+        _count(MISSES, kind)
+        return key, None
+    _count(HITS, kind)
+    content, content_type = cached
+    response = HttpResponse(content, content_type=content_type)
+    patch_vary_headers(response, ['Cookie'])
+    return key, response
+
+
+def _store(key, request, response):
+    # if this visitor had no CSRF cookie and the page needed one, a new one is
+    # about to be set - html with that token must not be reused
+    csrf_cookie = request.COOKIES.get(settings.CSRF_COOKIE_NAME, '')
+    fresh_csrf = not csrf_cookie and 'CSRF_COOKIE' in request.META
+    # a page read off a replica may be a little behind, and the version bump
+    # that should have retired it can come before the replica catches up - so
+    # it's only kept for as long as a writer's reads stay pinned to the primary
+    timeout = settings.PAGE_CACHE_TIMEOUT
+    if replicas.used():
+        timeout = min(timeout, settings.REPLICA_PIN_SECONDS)
+    if response.status_code == 200 and not response.streaming and not fresh_csrf:
+        page_cache().set(key, (response.content, response['Content-Type']), timeout)
@@ -0,0 +1,95 @@
+import io
+import logging
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Photo
+from .storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# smaller copies of each photo so pages don't have to download the full-size
+# original: one per width in PHOTO_THUMBNAIL_WIDTHS (only the ones smaller than
+# the original - we never blow a photo up), each in the original's format and as
+# WebP, plus a full-size WebP. they're saved next to the original in storage and
+# listed in Photo.derivatives like
+#   {"width": 2000, "sizes": {"320": {"src": url, "webp": url}, ...}}
+# generate() only makes what's missing from that map, so running it twice for
+# the same photo is cheap. it's slow (it decodes and re-encodes images), so it
+# always runs on the background workers in uploads.py, never during a request
+
+
+def derivative_key(key, width, extension):
+    base = key[:key.rfind('.')] if '.' in key else key
+    return f'{base}_{width}w.{extension}'
+
+
+def _encode(image, image_format):
+    fileobj = io.BytesIO()
+    if image_format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.save(fileobj, format=image_format, quality=settings.PHOTO_DERIVATIVE_QUALITY)
+    fileobj.seek(0)
+    return fileobj
+
+
+def generate(photo_id, source=None):
+    # source is an already-open file of the original, if the caller has one
+    # handy. otherwise it's fetched from storage
+    from PIL import Image, UnidentifiedImageError # Pillow is only needed here
+
+    photo = Photo.objects.only('key', 'url', 'derivatives').get(id=photo_id)
+    done = photo.derivatives.get('sizes', {})
+    original_width = photo.derivatives.get('width')
+    if original_width is not None:
+        wanted = [w for w in settings.PHOTO_THUMBNAIL_WIDTHS if w < original_width]
+        if all(str(width) in done for width in wanted + [original_width]):
+            return # everything is already there
+    storage = get_storage()
+    original = source
+    try:
+        if original is None:
+            original = storage.open(photo.key)
+        image = Image.open(original)
+        image.load() # reads the whole image in, so the file can be closed after
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        # DecompressionBombError: too many pixels to be safe to decode
+        logger.warning('photo %s is not an image we can read, skipping thumbnails', photo_id)
+        return
+    finally:
+        # the caller closes the source it passed in, we close the one we opened
+        if source is None and original is not None:
+            original.close()
+
+    # PNGs (and anything with transparency) stay PNG, everything else is JPEG
+    keep_alpha = image.mode in ('RGBA', 'LA', 'P')
+    fallback_format, fallback_extension = ('PNG', 'png') if keep_alpha else ('JPEG', 'jpg')
+    sizes = {}
+    widths = [w for w in settings.PHOTO_THUMBNAIL_WIDTHS if w < image.width]
+    for width in widths + [image.width]:
+        if str(width) in done:
+            continue
+        if width == image.width:
+            resized, variant = image, {'src': photo.url} # the original is the full size
+        else:
+            height = max(1, round(image.height * width / image.width))
+            resized, variant = image.resize((width, height), Image.LANCZOS), {}
+            key = derivative_key(photo.key, width, fallback_extension)
+            storage.save(_encode(resized, fallback_format), key)
+            variant['src'] = storage.url(key)
+        key = derivative_key(photo.key, width, 'webp')
+        storage.save(_encode(resized, 'WEBP'), key)
+        variant['webp'] = storage.url(key)
+        sizes[str(width)] = variant
+
+    # another worker may have been working on the same photo, so merge into
+    # whatever is saved now rather than overwriting it
+    with transaction.atomic():
+        photo = Photo.objects.select_for_update().only('derivatives', 'cat_id').get(id=photo_id)
+        photo.derivatives = {
+            'width': image.width,
+            'sizes': {**photo.derivatives.get('sizes', {}), **sizes},
+        }
+        photo.save(update_fields=['derivatives'])
+    logger.info('made %s derivative size(s) for photo %s', len(sizes), photo_id)
@@ -0,0 +1,56 @@
+import hashlib
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from .models import Cat, Toy
+
+# ETags for conditional GETs. a browser (or CDN) that already has a page sends
+# its ETag back in If-None-Match, and Django's @condition decorator answers
+# "304 Not Modified" - no body, no page queries, no template rendering - when
+# the ETag we compute here still matches.
+#
+# each ETag comes from one small aggregate query over the updated_at columns,
+# plus a row count (a delete leaves no newer timestamp behind, but it does
+# change the count). pages are per user and carry a CSRF token tied to the
+# visitor's cookie, so those go into the ETag as well. returning None means
+# "no ETag", and the view just runs normally.
+
+
+def _etag(request, *parts):
+    raw = '|'.join(map(str, [
+        request.user.pk, request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''), *parts,
+    ]))
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def toys_state():
+    return Toy.objects.aggregate(changed=Max('updated_at'), count=Count('id'))
+
+
+def cats_index_etag(request):
+    from .views import today_for
+    state = Cat.objects.filter(user=request.user).aggregate(
+        changed=Max('updated_at'), count=Count('id')
+    )
+    # fed-today flips at midnight without any row changing, hence the date
+    return _etag(request, state['changed'], state['count'], today_for(request))
+
+
+def cats_details_etag(request, cat_id):
+    from .views import today_for
+    changed = Cat.objects.filter(id=cat_id).values_list('updated_at', flat=True).first()
+    if changed is None:
+        return None
+    toys = toys_state() # the available toys list shows every toy
+    return _etag(request, changed, toys['changed'], toys['count'], today_for(request))
+
+
+def toy_list_etag(request):
+    toys = toys_state()
+    return _etag(request, toys['changed'], toys['count'])
+
+
+def toy_detail_etag(request, pk):
+    changed = Toy.objects.filter(pk=pk).values_list('updated_at', flat=True).first()
+    return None if changed is None else _etag(request, changed)
@@ -0,0 +1,100 @@
+import csv
+import json
+import zlib
+
+from django.conf import settings
+
+from .models import Cat, Feeding, Photo
+
+# streaming exports, shared by the export_data view and `manage.py export_cats`.
+# rows come out of the database in chunks with .iterator() and are written out
+# as they arrive, so memory stays flat however many feedings there are - the
+# whole export never exists in one piece, on either end.
+
+KINDS = ('cats', 'feedings', 'photos', 'toys')
+FORMATS = ('csv', 'jsonl')
+
+
+def _rows(kind, user=None, since=None, until=None):
+    """
+    returns (column names, iterable of row tuples) for one kind of data. user
+    limits it to one person's cats, since/until (dates) limit feedings to a
+    date range
+    """
+    if kind == 'cats':
+        queryset = Cat.objects.all()
+        if user is not None:
+            queryset = queryset.filter(user=user)
+        columns = ('id', 'name', 'breed', 'description', 'age', 'user__username', 'updated_at')
+    elif kind == 'feedings':
+        queryset = Feeding.objects.order_by('cat_id', 'date', 'meal')
+        if user is not None:
+            queryset = queryset.filter(cat__user=user)
+        if since is not None:
+            queryset = queryset.filter(date__gte=since)
+        if until is not None:
+            queryset = queryset.filter(date__lte=until)
+        columns = ('id', 'cat_id', 'date', 'meal')
+    elif kind == 'photos':
+        queryset = Photo.objects.all()
+        if user is not None:
+            queryset = queryset.filter(cat__user=user)
+        columns = ('id', 'cat_id', 'url', 'status')
+    elif kind == 'toys':
+        # one row per cat <-> toy pair, straight off the through table
+        queryset = Cat.toys.through.objects.all()
+        if user is not None:
+            queryset = queryset.filter(cat__user=user)
+        columns = ('cat_id', 'toy_id', 'toy__name', 'toy__color')
+    else:
+        raise ValueError(f'unknown export kind {kind!r}')
+    if kind != 'feedings':
+        queryset = queryset.order_by('pk')
+    rows = queryset.values_list(*columns).iterator(chunk_size=settings.EXPORT_CHUNK_SIZE)
+    # user__username -> username, toy__name -> toy_name, for the file header
+    return [column.replace('user__', '').replace('__', '_') for column in columns], rows
+
+
+class _Line:
+    # csv.writer wants a file to write to. this "file" just hands the line back
+    def write(self, value):
+        return value
+
+
+def _lines(fmt, columns, rows):
+    if fmt == 'csv':
+        writer = csv.writer(_Line())
+        yield writer.writerow(columns)
+        for row in rows:
+            yield writer.writerow(row)
+    elif fmt == 'jsonl':
+        for row in rows:
+            yield json.dumps(dict(zip(columns, row)), default=str) + '\n'
+    else:
+        raise ValueError(f'unknown export format {fmt!r}')
+
+
+def stream(kind, fmt, user=None, since=None, until=None, compress=False):
+    """
+    yields the export as chunks of bytes, gzipped on the fly if compress is
+    True. lines are grouped into chunks of about EXPORT_BUFFER_SIZE bytes so
+    we aren't sending one tiny write per row
+    """
+    columns, rows = _rows(kind, user, since, until)
+    gzip = zlib.compressobj(wbits=31) if compress else None # 31 = gzip format
+    buffer, size = [], 0
+    for line in _lines(fmt, columns, rows):
+        buffer.append(line)
+        size += len(line)
+        if size >= settings.EXPORT_BUFFER_SIZE:
+            chunk = ''.join(buffer).encode()
+            buffer, size = [], 0
+            if gzip:
+                chunk = gzip.compress(chunk)
+            if chunk:
+                yield chunk
+    chunk = ''.join(buffer).encode()
+    if gzip:
+        chunk = gzip.compress(chunk) + gzip.flush()
+    if chunk:
+        yield chunk
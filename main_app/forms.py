@@ -1,5 +1,6 @@
+from django import forms
 from django.forms import ModelForm # importing this to be able to write our own CBV
-from .models import Feeding
+from .models import Feeding, MEALS
 
 class FeedingForm(ModelForm): # extending the ModelForm class to apply it here as
     # FeedingForm. we can use some of the methods from ModelForm selectively
@@ -14,4 +15,13 @@ class FeedingForm(ModelForm): # extending the ModelForm class to apply it here a
 # behind the scenes already. there is django documentation on all the options
 
 # in views we will need to update the cat details route to import the new form and
-# allow it to render in the details.html page
\ No newline at end of file
+# allow it to render in the details.html page
+
+class FeedingEntryForm(forms.Form):
+    # one row of a bulk feeding upload (see bulk_add_feeding in views). it's a
+    # plain Form rather than a ModelForm so validating hundreds of rows doesn't
+    # cost a database query each - ownership and duplicates are checked for
+    # the whole batch at once in the view instead
+    cat = forms.IntegerField(min_value=1)
+    date = forms.DateField()
+    meal = forms.ChoiceField(choices=MEALS)
@@ -0,0 +1,95 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.utils import load_backend
+
+from .benchmark import percentile
+
+# DATABASE_URL=postgres://localhost/catcollector python manage.py bench_connections
+# what reusing database connections saves each request, against a real
+# Postgres. every "request" goes through the same steps Django takes around a
+# real one - close_old_connections() as it starts, a few queries, and
+# close_old_connections() again as it finishes - on --threads threads at once,
+# with the connection settings of each mode:
+#   new         CONN_MAX_AGE = 0, a new connection for every request
+#   persistent  CONN_MAX_AGE = 600 with health checks, one connection per thread
+#   pool        a pool of --threads connections (catcollector/postgres/pool.py)
+# the queries are trivial on purpose, so what's left is the connection cost.
+# against a database across a network (and with TLS, as on Heroku) the
+# difference only gets bigger
+
+MODES = {
+    # mode: settings on top of DATABASES['default']
+    'new': {'CONN_MAX_AGE': 0, 'CONN_HEALTH_CHECKS': False, 'POOL': None},
+    'persistent': {'CONN_MAX_AGE': 600, 'CONN_HEALTH_CHECKS': True, 'POOL': None},
+    'pool': {'CONN_MAX_AGE': 0, 'CONN_HEALTH_CHECKS': True, 'POOL': True}, # --threads connections
+}
+
+
+class Command(BaseCommand):
+    help = "Time requests' database work with and without connection reuse (Postgres only)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='per thread, per mode')
+        parser.add_argument('--threads', type=int, default=4)
+        parser.add_argument('--queries', type=int, default=5, help='queries per request')
+        parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+
+    def handle(self, *args, **options):
+        if connections['default'].vendor != 'postgresql':
+            raise CommandError('bench_connections needs DATABASE_URL to point at Postgres')
+        backend = load_backend('catcollector.postgres')
+        self.stdout.write(f'{options["threads"]} threads x {options["requests"]} requests, '
+                          f'{options["queries"]} queries each')
+        self.stdout.write(f'{"mode":<12}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"req/s":>9}')
+        for mode in options['modes']:
+            db = {**connections['default'].settings_dict, 'ENGINE': 'catcollector.postgres',
+                  **MODES[mode]}
+            if db['POOL']:
+                db['POOL'] = {'size': options['threads'], 'timeout': 10, 'max_age': 600}
+            timings, elapsed = self.run_mode(backend, db, f'bench_{mode}', options)
+            self.stdout.write(
+                f'{mode:<12}{percentile(timings, 0.50) * 1000:9.2f}'
+                f'{percentile(timings, 0.95) * 1000:9.2f}{percentile(timings, 0.99) * 1000:9.2f}'
+                f'{len(timings) / elapsed:9.1f}'
+            )
+
+    def run_mode(self, backend, db, alias, options):
+        timings, errors = [], []
+        lock = threading.Lock()
+
+        def worker():
+            # each thread gets its own connection wrapper, as Django gives
+            # each request thread
+            connection = backend.DatabaseWrapper(db, alias)
+            mine = []
+            try:
+                for _ in range(options['requests']):
+                    started = time.perf_counter()
+                    connection.close_if_unusable_or_obsolete() # request_started
+                    for _ in range(options['queries']):
+                        with connection.cursor() as cursor:
+                            cursor.execute('SELECT 1')
+                            cursor.fetchone()
+                    connection.close_if_unusable_or_obsolete() # request_finished
+                    mine.append(time.perf_counter() - started)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+                with lock:
+                    timings.extend(mine)
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        backend.close_pools()
+        if errors:
+            raise CommandError(f'{alias}: {errors[0]}')
+        return timings, elapsed
@@ -0,0 +1,148 @@
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.middleware.csrf import get_token
+from django.template import Engine, RequestContext
+from django.template.backends.django import get_installed_libraries
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+
+from main_app import rollups, seeding
+from main_app.caching import page_cache
+from main_app.models import Cat, Toy
+from main_app.views import prefetch_counted
+
+from .benchmark import _Rollback
+
+# python manage.py bench_render --cards 1000 --runs 10
+# how long the pages full of cards take to render, with the database left out
+# of it: the cat index with --cards cats on one page, the toy list with --cards
+# toys, and a cat's details page with --cards toys to pick from. each page's
+# data is queried once, then the page is rendered --runs times in each setup:
+#   uncached loader  every template read and parsed again for each render, as
+#                    in development (DEBUG on)
+#   cached loader    parsed once and kept (the production settings), but every
+#                    card rendered every time
+#   cards cold       card caching on (main_app/templatetags/cards.py), with the
+#                    cache emptied before each render - what the first visit
+#                    after a deploy, or with every cat changed, costs
+#   cards warm       card caching on, every card already cached
+# the cards are cached in a cache of the benchmark's own, and the data is
+# seeded in a transaction that is rolled back at the end
+
+MODES = {
+    # mode: (cached loader, card caching, empty the cache before each render)
+    'uncached loader': (False, False, False),
+    'cached loader': (True, False, False),
+    'cards cold': (True, True, True),
+    'cards warm': (True, True, False),
+}
+BENCH_CACHE = 'bench_cards'
+
+
+def _engine(cached):
+    loaders = [
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+    ]
+    if cached:
+        loaders = [('django.template.loaders.cached.Loader', loaders)]
+    return Engine(
+        dirs=settings.TEMPLATES[0]['DIRS'], loaders=loaders,
+        context_processors=settings.TEMPLATES[0]['OPTIONS']['context_processors'],
+        libraries=get_installed_libraries(), # {% load cards %}, {% load static %}...
+    )
+
+
+class Command(BaseCommand):
+    help = "Time rendering the pages with the most cards, with and without caching"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cards', type=int, default=1000, help='cats and toys per page')
+        parser.add_argument('--runs', type=int, default=10, help='renders per page, per mode')
+
+    def handle(self, *args, **options):
+        caches = {
+            **settings.CACHES,
+            BENCH_CACHE: {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'bench-cards',
+                'OPTIONS': {'MAX_ENTRIES': options['cards'] * 10},
+            },
+        }
+        # the production settings' manifest storage wants collectstatic first,
+        # and {% static %} isn't what this is measuring
+        plain_static = 'django.contrib.staticfiles.storage.StaticFilesStorage'
+        try:
+            with override_settings(
+                CACHES=caches, PAGE_CACHE_ALIAS=BENCH_CACHE, STATICFILES_STORAGE=plain_static,
+            ), transaction.atomic():
+                pages = self.pages(options['cards'])
+                self.stdout.write(f'{options["cards"]} cards a page, {options["runs"]} renders each')
+                self.stdout.write(f'{"page":<10}{"mode":<18}{"median ms":>11}{"min ms":>9}{"KB":>7}')
+                for page, (template_name, request, context) in pages.items():
+                    for mode in MODES:
+                        self.run_mode(page, mode, template_name, request, context, options['runs'])
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def pages(self, count):
+        # {page: (template, request, context)}, with the context the view would
+        # give the template, all of it already fetched
+        person, = seeding.seed(
+            users=1, cats=count, feedings=14, photos=0, toys=count, toys_per_cat=2,
+            prefix='benchrender',
+        )
+        today = timezone.localdate()
+        request = RequestFactory().get('/')
+        request.user = person
+        get_token(request) # as CsrfViewMiddleware would, for the toy buttons
+        cats = list(
+            Cat.objects.filter(user=person).with_summary(today)
+            .with_missed_meals(settings.MISSED_MEALS_DAYS, today).order_by('name', 'id')
+        )
+        cat = Cat.objects.with_feeding_status(today).get(id=cats[0].id)
+        prefetch_counted(cat)
+        history = rollups.history(cat.id, today, settings.FEEDING_HISTORY_DAYS)
+        return {
+            'index': ('cats/index.html', request, {
+                'cats': cats, 'next_cursor': None, 'page_size': count,
+                'missed_meals_days': settings.MISSED_MEALS_DAYS, 'is_first_page': True,
+            }),
+            'toys': ('toys/index.html', request, {'object_list': list(Toy.objects.all())}),
+            'details': ('cats/details.html', request, {
+                'cat': cat, 'toys': list(Toy.objects.available_for(cat.id).order_by('name', 'id')),
+                'toys_next': None, 'toy_q': '', 'history': history,
+                'missed_meals': sum(missed for _, _, missed in history),
+                'history_days': settings.FEEDING_HISTORY_DAYS,
+            }),
+        }
+
+    def run_mode(self, page, mode, template_name, request, context, runs):
+        cached_loader, cards, empty = MODES[mode]
+        engine = _engine(cached_loader)
+        cache = page_cache()
+
+        def render():
+            # get_template() is part of it: that's where the uncached loader
+            # reads and parses the files
+            return engine.get_template(template_name).render(RequestContext(request, context))
+
+        timings = []
+        with override_settings(CARD_CACHE_TIMEOUT=3600 if cards else 0):
+            cache.clear()
+            html = render() # loads the templates, and the cards for 'cards warm'
+            for _ in range(runs):
+                if empty:
+                    cache.clear()
+                started = time.perf_counter()
+                render()
+                timings.append(time.perf_counter() - started)
+        self.stdout.write(
+            f'{page:<10}{mode:<18}{statistics.median(timings) * 1000:11.1f}'
+            f'{min(timings) * 1000:9.1f}{len(html) / 1024:7.0f}'
+        )
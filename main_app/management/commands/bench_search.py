@@ -0,0 +1,91 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from main_app import search
+from main_app.models import Cat
+
+# python manage.py bench_search --cats 100000 --owners 20 --budget-ms 20
+# seeds lots of cats spread over a few throwaway users (so the index holds
+# 100k cats and the one searching owns 5k of them), then times typeahead
+# searches the way someone typing a name would send them ("m", "mi", "mit", ...)
+# and prints
+# p50/p95/p99. everything happens inside one transaction that is rolled back
+# at the end, so the database is left exactly as it was. exits with an error if
+# p95 goes over the budget, so it can run in CI
+
+NAMES = ['Mittens', 'Lolo', 'Shadow', 'Tigger', 'Smokey', 'Oreo', 'Luna', 'Simba',
+         'Cleo', 'Pumpkin', 'Whiskers', 'Ginger', 'Milo', 'Nala', 'Pepper', 'Jasper']
+BREEDS = ['Tabby', 'Siamese', 'Maine Coon', 'Persian', 'Bengal', 'Sphynx', 'Ragdoll']
+WORDS = ['likes', 'naps', 'sunny', 'windows', 'hates', 'baths', 'chases', 'string',
+         'loud', 'purrs', 'shy', 'friendly', 'orange', 'grey', 'fluffy', 'kitten']
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Time cat search-as-you-type queries against a large seeded table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cats', type=int, default=100000)
+        parser.add_argument('--owners', type=int, default=20, help='users the cats are spread over')
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--budget-ms', type=float, default=20.0, help='the most p95 may take')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        try:
+            with transaction.atomic():
+                timings = self.run(rng, options)
+                raise _Rollback
+        except _Rollback:
+            pass
+        timings.sort()
+        p50, p95, p99 = (timings[min(len(timings) - 1, int(len(timings) * q))]
+                         for q in (0.50, 0.95, 0.99))
+        self.stdout.write(
+            f'{len(timings)} searches over {options["cats"]:,} cats: '
+            f'p50 {p50:.2f}ms  p95 {p95:.2f}ms  p99 {p99:.2f}ms  '
+            f'mean {statistics.mean(timings):.2f}ms'
+        )
+        if p95 > options['budget_ms']:
+            raise CommandError(f'p95 {p95:.2f}ms is over the {options["budget_ms"]}ms budget')
+
+    def run(self, rng, options):
+        users = [User.objects.create(username=f'bench_search_{i}')
+                 for i in range(max(1, options['owners']))]
+        user = users[0]
+        batch = []
+        for i in range(options['cats']):
+            batch.append(Cat(
+                user=users[i % len(users)],
+                name=f'{rng.choice(NAMES)} {i}',
+                breed=rng.choice(BREEDS),
+                description=' '.join(rng.choices(WORDS, k=6)),
+                age=rng.randint(0, 20),
+            ))
+            if len(batch) == 5000:
+                Cat.objects.bulk_create(batch)
+                batch = []
+        Cat.objects.bulk_create(batch)
+
+        # what a typeahead box sends: every prefix of a name, sometimes with a
+        # second word started
+        queries = []
+        while len(queries) < options['queries']:
+            name = rng.choice(NAMES + BREEDS).lower()
+            queries.extend(name[:length] for length in range(1, len(name) + 1))
+            queries.append(f'{name} {rng.choice(WORDS)[:2]}')
+        timings = []
+        for query in queries[:options['queries']]:
+            started = time.perf_counter()
+            search.search_cats(user, query)
+            timings.append((time.perf_counter() - started) * 1000)
+        return timings
@@ -0,0 +1,91 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# python manage.py bench_startup --runs 5 --budget-ms 1500 --budget-mb 120
+# how long a fresh gunicorn worker (or any manage.py command) takes to import
+# everything before it can serve a request, and how much memory that costs.
+# each run starts a new python with `-X importtime`, loads catcollector.wsgi
+# and every view the urls point at, and reports the median time, the peak RSS
+# and the packages that took longest to import. exits with an error if either
+# goes over its budget, or if something in LAZY_MODULES got imported - those
+# are only needed by a few requests and are imported inside the code that uses
+# them (photo storage, thumbnails), so they shouldn't show up at startup
+
+LAZY_MODULES = ('boto3', 'botocore', 'PIL', 'distutils', 'nis')
+
+WORKER = '''
+import json, os, resource, sys, time
+started = time.perf_counter()
+from catcollector.wsgi import application
+from django.urls import get_resolver
+get_resolver().url_patterns # urls.py, and with it every view
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    'seconds': time.perf_counter() - started,
+    'rss_mb': rss / (1024 * 1024 if sys.platform == 'darwin' else 1024),
+    'modules': sorted(sys.modules),
+}))
+'''
+
+
+def _import_times(stderr):
+    # {package: microseconds}, from -X importtime's "import time: self |
+    # cumulative | name" lines. each module's own (self) time is added to its
+    # top-level package, so django.db and django.urls both count as django
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        times[package] = times.get(package, 0) + int(own)
+    return times
+
+
+class Command(BaseCommand):
+    help = "Time a cold start of the app and measure its memory"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5)
+        parser.add_argument('--budget-ms', type=float, default=1500.0,
+                            help='the most the median start may take')
+        parser.add_argument('--budget-mb', type=float, default=120.0,
+                            help='the most RSS a freshly started worker may use')
+        parser.add_argument('--top', type=int, default=10, help='slowest packages to list')
+
+    def handle(self, *args, **options):
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': os.environ.get(
+            'DJANGO_SETTINGS_MODULE', 'catcollector.settings')}
+        runs = []
+        for _ in range(max(1, options['runs'])):
+            worker = subprocess.run(
+                [sys.executable, '-X', 'importtime', '-c', WORKER], cwd=settings.BASE_DIR,
+                env=env, capture_output=True, text=True,
+            )
+            if worker.returncode:
+                raise CommandError(f'the app failed to start:\n{worker.stderr[-2000:]}')
+            result = json.loads(worker.stdout.strip().splitlines()[-1])
+            result['imports'] = _import_times(worker.stderr)
+            runs.append(result)
+
+        seconds = statistics.median(run['seconds'] for run in runs) * 1000
+        rss = max(run['rss_mb'] for run in runs)
+        self.stdout.write(f'startup over {len(runs)} runs: median {seconds:.0f}ms, '
+                          f'peak RSS {rss:.1f}MB')
+        imports = runs[-1]['imports']
+        for name in sorted(imports, key=imports.get, reverse=True)[:options['top']]:
+            self.stdout.write(f'  {imports[name] / 1000:8.1f}ms  {name}')
+
+        eager = [name for name in LAZY_MODULES if name in runs[-1]['modules']]
+        if eager:
+            raise CommandError(f'imported at startup, should be lazy: {", ".join(eager)}')
+        if seconds > options['budget_ms']:
+            raise CommandError(f'startup {seconds:.0f}ms is over the {options["budget_ms"]}ms budget')
+        if rss > options['budget_mb']:
+            raise CommandError(f'RSS {rss:.1f}MB is over the {options["budget_mb"]}MB budget')
@@ -0,0 +1,446 @@
+import http.client
+import importlib.util
+import json
+import os
+import random
+import secrets
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.http import HttpRequest
+from django.middleware.csrf import get_token
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from main_app import seeding
+from main_app.models import MEALS, Cat, Toy
+
+# python manage.py benchmark                       # test client only
+# python manage.py benchmark --target both --save benchmarks/main.json
+# python manage.py benchmark --target servers --concurrency 32  # sync vs async
+# python manage.py benchmark --compare benchmarks/main.json
+#
+# times the main views - the cat index and details pages, adding a feeding,
+# giving a cat a toy, and the toy list - and prints p50/p95/p99 latency,
+# throughput and queries per request for each.
+#
+#   client    goes through Django's test client, in this process. no network
+#             or server in the way, so it shows what the view itself costs.
+#             queries are counted for every request, and whatever it writes
+#             is rolled back at the end
+#   gunicorn  starts gunicorn the way the Procfile does (production settings,
+#             catcollector/gunicorn_conf.py) on a free local port and sends it
+#             real HTTP requests from a few threads at once. queries per
+#             request come from its /metrics. what it adds stays in the
+#             database, and on SQLite two workers writing at once can fail
+#             with "database is locked" (an error in the table) - use
+#             Postgres to compare the write views. run collectstatic first,
+#             as the production settings serve the collected files
+#   asgi      the same, but `gunicorn catcollector.asgi` with uvicorn workers,
+#             which serves the async views (main_app/async_views.py). run
+#             it next to gunicorn with the same --workers and plenty of
+#             --concurrency to see what async buys under load
+#   sync, gthread, gevent
+#             gunicorn with that worker class. `--target workers` runs all
+#             three and asgi, to compare the worker models
+#
+# every server target also reports the memory its processes use, as PSS -
+# pages shared between the master and its workers (everything the preloaded
+# app imported) are split between them rather than counted once per process
+#
+# the data comes from main_app/seeding.py: users named bench0, bench1... are
+# seeded the first time (same --seed, same data), so run it against a
+# throwaway database. --save writes the numbers, with the current git commit,
+# to a JSON file, and --compare checks a run against one of those and fails if
+# p95 got more than --max-regression percent slower or a view started running
+# more queries.
+
+SCENARIOS = ('index', 'details', 'add_feeding', 'assoc_toy', 'toys_index')
+TARGETS = {
+    'client': ['client'], 'gunicorn': ['gunicorn'], 'asgi': ['asgi'],
+    'both': ['client', 'gunicorn'], 'servers': ['gunicorn', 'asgi'],
+    'workers': ['sync', 'gthread', 'gevent', 'asgi'],
+    'all': ['client', 'gunicorn', 'asgi'],
+}
+for _worker in ('sync', 'gthread', 'gevent'):
+    TARGETS[_worker] = [_worker]
+SERVERS = {
+    # target: (app, environment). all of them go through the Procfile's
+    # gunicorn config (catcollector/gunicorn_conf.py)
+    'gunicorn': ('catcollector.wsgi', {}),
+    'sync': ('catcollector.wsgi', {'GUNICORN_WORKER_CLASS': 'sync'}),
+    'gthread': ('catcollector.wsgi', {'GUNICORN_WORKER_CLASS': 'gthread'}),
+    'gevent': ('catcollector.wsgi', {'GUNICORN_WORKER_CLASS': 'gevent'}),
+    'asgi': ('catcollector.asgi', {'GUNICORN_WORKER_CLASS': 'uvicorn.workers.UvicornWorker'}),
+}
+NEEDS = {'gevent': ('gevent', 'psycogreen')} # packages a target can't run without
+
+
+class _Rollback(Exception):
+    pass
+
+
+def percentile(timings, fraction):
+    # nearest-rank: the smallest value with at least `fraction` of the timings
+    # at or below it
+    ordered = sorted(timings)
+    return ordered[max(0, min(len(ordered) - 1, round(fraction * len(ordered) + 0.5) - 1))]
+
+
+def summarize(timings, elapsed, queries, errors):
+    return {
+        'requests': len(timings),
+        'p50_ms': round(percentile(timings, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(timings, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(timings, 0.99) * 1000, 2),
+        'mean_ms': round(statistics.mean(timings) * 1000, 2),
+        'rps': round(len(timings) / elapsed, 1) if elapsed else None,
+        'queries': queries,
+        'errors': errors,
+    }
+
+
+def _pss_mb(pid):
+    # proportional set size: the process's own memory, plus its share of the
+    # pages it has in common with others. Linux only
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as rollup:
+            for line in rollup:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def server_memory(pid):
+    # {'master_mb', 'workers_mb', 'total_mb'} for a gunicorn master and its
+    # workers, or None where /proc can't tell
+    workers = []
+    for entry in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        try:
+            with open(f'/proc/{entry}/stat') as stat:
+                # the parent pid is the second field after the (name)
+                if int(stat.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    workers.append(int(entry))
+        except (OSError, ValueError, IndexError):
+            continue
+    master = _pss_mb(pid)
+    sizes = [size for size in map(_pss_mb, workers) if size is not None]
+    if master is None or not sizes:
+        return None
+    return {'master_mb': round(master, 1), 'workers_mb': round(sum(sizes), 1),
+            'total_mb': round(master + sum(sizes), 1)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = "Benchmark the main views through the test client and/or real servers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', choices=TARGETS, default='client')
+        parser.add_argument('--requests', type=int, default=200, help='per view')
+        parser.add_argument('--warmup', type=int, default=10, help='untimed requests per view first')
+        parser.add_argument('--concurrency', type=int, default=4, help='servers: client threads')
+        parser.add_argument('--workers', type=int, default=2, help='servers: worker processes')
+        parser.add_argument('--page-cache', action='store_true',
+                            help='leave the per-user page cache on (off by default, so the '
+                                 'views actually run)')
+        parser.add_argument('--users', type=int, default=5)
+        parser.add_argument('--cats', type=int, default=20, help='cats per user')
+        parser.add_argument('--feedings', type=int, default=200, help='feedings per cat')
+        parser.add_argument('--toys', type=int, default=200)
+        parser.add_argument('--prefix', default='bench')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--save', metavar='PATH', help='write the results here as JSON')
+        parser.add_argument('--compare', metavar='PATH', help='a file written by --save')
+        parser.add_argument('--max-regression', type=float, default=20.0,
+                            help='percent p95 may grow by before --compare fails')
+
+    def handle(self, *args, **options):
+        self.options = options
+        people = list(User.objects.filter(username__startswith=options['prefix']).order_by('id'))
+        if not people:
+            self.stdout.write('Seeding benchmark data...')
+            people = seeding.seed(
+                users=options['users'], cats=options['cats'], feedings=options['feedings'],
+                toys=options['toys'], prefix=options['prefix'], seed=options['seed'],
+            )
+        rng = random.Random(options['seed'])
+        self.cats = {
+            person.id: list(Cat.objects.filter(user=person).values_list('id', flat=True))
+            for person in people
+        }
+        self.people = [person for person in people if self.cats[person.id]]
+        if not self.people:
+            raise CommandError(f'The {options["prefix"]}* users have no cats to benchmark with.')
+        self.toy_ids = list(Toy.objects.values_list('id', flat=True))
+        plan = {name: self.plan(name, rng) for name in SCENARIOS}
+
+        results, memory = {}, {}
+        for target in TARGETS[options['target']]:
+            missing = [name for name in NEEDS.get(target, ()) if not importlib.util.find_spec(name)]
+            if missing:
+                self.stderr.write(f'skipping {target}, it needs {" and ".join(missing)} installed')
+                continue
+            if target == 'client':
+                results[target] = self.run_client(plan)
+                self.report('test client', results[target])
+            else:
+                results[target], memory[target] = self.run_server(target, plan)
+                self.report(f'{target} ({options["workers"]} workers, '
+                            f'{options["concurrency"]} client threads)', results[target])
+                if memory[target]:
+                    self.stdout.write(
+                        f'memory: {memory[target]["total_mb"]}MB (master '
+                        f'{memory[target]["master_mb"]}MB, workers {memory[target]["workers_mb"]}MB)'
+                    )
+
+        run = {
+            'commit': git_commit(), 'created': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'options': {key: options[key] for key in (
+                'requests', 'warmup', 'concurrency', 'workers', 'page_cache', 'users', 'cats',
+                'feedings', 'toys', 'seed',
+            )},
+            'results': results,
+            'memory': memory,
+        }
+        if options['save']:
+            os.makedirs(os.path.dirname(os.path.abspath(options['save'])), exist_ok=True)
+            with open(options['save'], 'w') as baseline:
+                json.dump(run, baseline, indent=2)
+            self.stdout.write(f'Saved to {options["save"]}')
+        if options['compare']:
+            self.compare(run, options['compare'])
+
+    def plan(self, name, rng):
+        # the requests to send for one view: (user id, method, path, form data),
+        # spread over every bench user and their cats
+        total = self.options['warmup'] + self.options['requests']
+        today = timezone.localdate()
+        requests = []
+        for i in range(total):
+            person = self.people[i % len(self.people)]
+            cat_id = rng.choice(self.cats[person.id])
+            if name == 'index':
+                request = ('GET', reverse('index'), None)
+            elif name == 'details':
+                request = ('GET', reverse('details', args=[cat_id]), None)
+            elif name == 'add_feeding':
+                day = today - timedelta(days=rng.randrange(365))
+                request = ('POST', reverse('add_feeding', args=[cat_id]),
+                           {'date': day.isoformat(), 'meal': rng.choice(MEALS)[0]})
+            elif name == 'assoc_toy':
+                request = ('GET', reverse('assoc_toy', args=[cat_id, rng.choice(self.toy_ids)]), None)
+            else:
+                request = ('GET', reverse('toys_index'), None)
+            requests.append((person.id, *request))
+        return requests
+
+    def run_client(self, plan):
+        clients = {}
+        for person in self.people:
+            clients[person.id] = Client()
+            clients[person.id].force_login(person)
+        cache_off = {} if self.options['page_cache'] else {'PAGE_CACHE_TIMEOUT': 0}
+        results = {}
+        try:
+            # the feedings and toys it adds are rolled back afterwards, so every
+            # run starts from the same data
+            with override_settings(**cache_off), transaction.atomic():
+                self.client_scenarios(plan, clients, results)
+                raise _Rollback
+        except _Rollback:
+            pass
+        return results
+
+    def client_scenarios(self, plan, clients, results):
+        for name, requests in plan.items():
+            timings, queries, errors = [], [], 0
+            for i, (person_id, method, path, data) in enumerate(requests):
+                client = clients[person_id]
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    if method == 'POST':
+                        response = client.post(path, data)
+                    else:
+                        response = client.get(path)
+                    took = time.perf_counter() - started
+                if i < self.options['warmup']:
+                    continue
+                timings.append(took)
+                queries.append(len(captured))
+                errors += response.status_code >= 400
+            results[name] = summarize(
+                timings, sum(timings), round(statistics.fmean(queries), 1), errors
+            )
+
+    def run_server(self, target, plan):
+        if connection.vendor == 'sqlite' and ':memory:' in str(connection.settings_dict['NAME']):
+            raise CommandError("a server can't see an in-memory database.")
+        manifest = getattr(staticfiles_storage, 'manifest_name', None)
+        if manifest and not staticfiles_storage.exists(manifest):
+            raise CommandError('the servers run with the production settings, which need the '
+                               'static files collected - run `manage.py collectstatic` first.')
+        # log everyone in the usual way (a session row), and make a CSRF token
+        # for the feeding form posts
+        sessions = {}
+        for person in self.people:
+            client = Client()
+            client.force_login(person)
+            csrf_request = HttpRequest()
+            token = get_token(csrf_request)
+            cookie = (f'{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}; '
+                      f'{settings.CSRF_COOKIE_NAME}={csrf_request.META["CSRF_COOKIE"]}')
+            sessions[person.id] = {'Cookie': cookie, 'X-CSRFToken': token}
+
+        with socket.socket() as probe: # let the OS pick a free port
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        metrics_token = secrets.token_urlsafe(16)
+        app, server_env = SERVERS[target]
+        env = {
+            **os.environ, **server_env, 'METRICS_TOKEN': metrics_token,
+            # what the app reads the worker count from (see gunicorn_conf.py)
+            'WEB_CONCURRENCY': str(self.options['workers']),
+        }
+        if not self.options['page_cache']:
+            env['PAGE_CACHE_TIMEOUT'] = '0'
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'python:catcollector.gunicorn_conf', app,
+             '--bind', f'127.0.0.1:{port}', '--workers', str(self.options['workers']),
+             '--log-level', 'warning'],
+            cwd=settings.BASE_DIR, env=env,
+        )
+        try:
+            self.wait_for(port, server)
+
+            def send(request):
+                person_id, method, path, data = request
+                headers = dict(sessions[person_id])
+                body = None
+                if data is not None:
+                    body = urlencode(data)
+                    headers['Content-Type'] = 'application/x-www-form-urlencoded'
+                started = time.perf_counter()
+                server_connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                try:
+                    server_connection.request(method, path, body=body, headers=headers)
+                    response = server_connection.getresponse()
+                    response.read()
+                finally:
+                    server_connection.close()
+                return time.perf_counter() - started, response.status
+
+            results = {}
+            with ThreadPoolExecutor(self.options['concurrency']) as pool:
+                for name, requests in plan.items():
+                    list(pool.map(send, requests[:self.options['warmup']]))
+                    started = time.perf_counter()
+                    responses = list(pool.map(send, requests[self.options['warmup']:]))
+                    elapsed = time.perf_counter() - started
+                    results[name] = summarize(
+                        [took for took, _ in responses], elapsed, None,
+                        sum(status >= 400 for _, status in responses),
+                    )
+            # queries per request, as one worker's /metrics saw them
+            for name, queries in self.queries_per_request(port, metrics_token).items():
+                if name in results:
+                    results[name]['queries'] = queries
+            return results, server_memory(server.pid)
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+    def wait_for(self, port, server):
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError('the server exited before it started serving.')
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise CommandError('the server did not start listening within 30 seconds.')
+
+    def queries_per_request(self, port, token):
+        server_connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        try:
+            server_connection.request('GET', reverse('metrics'),
+                                      headers={'Authorization': f'Bearer {token}'})
+            text = server_connection.getresponse().read().decode()
+        finally:
+            server_connection.close()
+        totals = {}
+        for line in text.splitlines():
+            for metric in ('requests', 'queries'):
+                prefix = f'catcollector_view_{metric}_total{{view="'
+                if line.startswith(prefix):
+                    view, value = line[len(prefix):].split('"} ')
+                    totals.setdefault(view, {})[metric] = float(value)
+        return {
+            view: round(counts['queries'] / counts['requests'], 1)
+            for view, counts in totals.items() if counts.get('requests')
+        }
+
+    def report(self, title, results):
+        self.stdout.write('')
+        self.stdout.write(self.style.MIGRATE_HEADING(title))
+        self.stdout.write(f'{"view":<12} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+                          f'{"req/s":>8} {"queries":>8} {"errors":>7}')
+        for name, row in results.items():
+            queries = '-' if row['queries'] is None else row['queries']
+            self.stdout.write(
+                f'{name:<12} {row["p50_ms"]:>8} {row["p95_ms"]:>8} {row["p99_ms"]:>8} '
+                f'{row["rps"]:>8} {queries:>8} {row["errors"]:>7}'
+            )
+
+    def compare(self, run, path):
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)
+        self.stdout.write('')
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f'Compared with {path} (commit {baseline.get("commit")})'
+        ))
+        regressions = []
+        for target, results in run['results'].items():
+            for name, row in results.items():
+                before = baseline.get('results', {}).get(target, {}).get(name)
+                if not before:
+                    continue
+                change = (row['p95_ms'] - before['p95_ms']) / max(before['p95_ms'], 1e-9) * 100
+                line = (f'{target:<9} {name:<12} p95 {before["p95_ms"]} -> {row["p95_ms"]} ms '
+                        f'({change:+.0f}%), queries {before["queries"]} -> {row["queries"]}')
+                slower = change > self.options['max_regression']
+                more_queries = None not in (row['queries'], before['queries']) \
+                    and row['queries'] > before['queries']
+                if slower or more_queries:
+                    regressions.append(line)
+                    line = self.style.ERROR(line)
+                self.stdout.write(line)
+        if regressions:
+            raise CommandError(f'{len(regressions)} regression(s) against {path}')
@@ -0,0 +1,67 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from main_app.models import Cat, FeedingDay, Photo, Toy
+from main_app.pagination import _after
+
+# python manage.py explain_queries --cat 3
+# prints the database's query plan for the queries behind the cat index and
+# cat details pages, so we can check the indexes are actually being used. works
+# the same on SQLite (EXPLAIN QUERY PLAN) and Postgres (EXPLAIN), since Django's
+# QuerySet.explain() picks the right flavor for whichever database is connected
+
+
+class Command(BaseCommand):
+    help = "Print EXPLAIN plans for the queries behind each cat view"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cat', type=int, help='cat id to explain (defaults to the first cat)')
+        parser.add_argument(
+            '--analyze', action='store_true',
+            help='actually run the queries and show real timings (Postgres only)',
+        )
+
+    def handle(self, *args, **options):
+        cat = Cat.objects.filter(id=options['cat']) if options['cat'] else Cat.objects.order_by('id')
+        cat = cat.first()
+        if cat is None:
+            raise CommandError('No cat to explain - create one (or seed some) first.')
+
+        explain_options = {}
+        if options['analyze']:
+            if connection.vendor != 'postgresql':
+                raise CommandError('--analyze is only supported on Postgres.')
+            explain_options['analyze'] = True
+
+        today = timezone.localdate()
+        # the same querysets cats_index and cats_details build
+        plans = [
+            ('cats_index: cats with summary', Cat.objects.filter(user_id=cat.user_id)
+                .with_summary(today).order_by('name', 'id')[:settings.CATS_PAGE_SIZE + 1]),
+            ('cats_details: cat with feeding status', Cat.objects.with_feeding_status(today)
+                .filter(id=cat.id)),
+            ('cats_details: photos', Photo.objects.filter(cat_id=cat.id)),
+            ('cats_index: missed meals', Cat.objects.filter(user_id=cat.user_id)
+                .with_missed_meals(settings.MISSED_MEALS_DAYS, today)),
+            ('cats_details: feeding history', FeedingDay.objects.filter(
+                cat_id=cat.id, date__gt=today - timedelta(days=settings.FEEDING_HISTORY_DAYS),
+                date__lte=today)),
+            ('cats_details: cat toys', Toy.objects.filter(cat__id=cat.id)),
+            ('cats_details: available toys', Toy.objects.available_for(cat.id)
+                .order_by('name', 'id')[:settings.TOYS_PAGE_SIZE + 1]),
+            # "Load More": the page after a toy named 'm' (see pagination.py)
+            ('available_toys: a later page', Toy.objects.available_for(cat.id)
+                .filter(_after(('name', 'id'), ['m', 0]))
+                .order_by('name', 'id')[:settings.TOYS_PAGE_SIZE + 1]),
+        ]
+
+        self.stdout.write(f'Database: {connection.vendor}, cat: {cat.id} ({cat.name})')
+        for label, queryset in plans:
+            self.stdout.write('')
+            self.stdout.write(self.style.MIGRATE_HEADING(label))
+            self.stdout.write(str(queryset.query))
+            self.stdout.write(queryset.explain(**explain_options))
@@ -0,0 +1,55 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from main_app import exports
+
+# python manage.py export_cats feedings --format jsonl --user tester \
+#     --since 2022-01-01 --gzip --output feedings.jsonl.gz
+# streams one kind of data (cats, feedings, photos or toys) to a file, or to
+# stdout if there's no --output. same format as the download on the site
+
+
+class Command(BaseCommand):
+    help = "Stream cats, feedings, photos or cat toys out as CSV or JSON Lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=exports.KINDS)
+        parser.add_argument('--format', choices=exports.FORMATS, default='csv')
+        parser.add_argument('--user', help='only export this username\'s cats')
+        parser.add_argument('--since', help='feedings on or after this date (YYYY-MM-DD)')
+        parser.add_argument('--until', help='feedings on or before this date (YYYY-MM-DD)')
+        parser.add_argument('--gzip', action='store_true', help='gzip the output')
+        parser.add_argument('--output', help='file to write to (default: stdout)')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+            if user is None:
+                raise CommandError(f'No user named {options["user"]}.')
+        dates = {}
+        for name in ('since', 'until'):
+            if options[name]:
+                try:
+                    dates[name] = parse_date(options[name])
+                except ValueError: # the right shape, but no such day, like 2022-13-45
+                    dates[name] = None
+                if dates[name] is None:
+                    raise CommandError(f'--{name} should look like 2022-07-08.')
+
+        chunks = exports.stream(
+            options['kind'], options['format'], user, compress=options['gzip'], **dates
+        )
+        if options['output']:
+            with open(options['output'], 'wb') as output:
+                for chunk in chunks:
+                    output.write(chunk)
+        else:
+            # self.stdout wants text, so go around it to write raw bytes
+            stdout = getattr(self.stdout._out, 'buffer', None) or sys.stdout.buffer
+            for chunk in chunks:
+                stdout.write(chunk)
+            stdout.flush()
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from main_app import derivatives
+from main_app.models import Photo
+
+# python manage.py generate_photo_derivatives
+# makes thumbnails for photos that were uploaded before derivatives existed (or
+# whose generation was cut short). photos that already have every size are
+# skipped without being downloaded, so it's safe to run again and again
+
+
+class Command(BaseCommand):
+    help = "Generate missing thumbnail/WebP derivatives for ready photos"
+
+    def handle(self, *args, **options):
+        photo_ids = Photo.objects.filter(status=Photo.READY).values_list('id', flat=True)
+        for count, photo_id in enumerate(photo_ids.iterator(), start=1):
+            derivatives.generate(photo_id)
+            if count % 100 == 0:
+                self.stdout.write(f'{count} photos checked')
+        self.stdout.write(self.style.SUCCESS('Done'))
@@ -0,0 +1,206 @@
+import csv
+import json
+import os
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.forms import modelform_factory
+
+from main_app import caching, rollups
+from main_app.forms import FeedingEntryForm
+from main_app.models import Cat, Feeding, Toy, true_counters
+from main_app.signals import cats_changed
+
+# python manage.py import_cats cats cats.csv --user shelter
+# python manage.py import_cats feedings feedings.jsonl --user shelter
+# python manage.py import_cats toys toys.csv --user shelter
+#
+# loads a new shelter's data in bulk. the files look just like what
+# `manage.py export_cats` writes, so exports can be imported elsewhere:
+#   cats:      id, name, breed, description, age
+#   feedings:  cat_id, date, meal
+#   toys:      cat_id, toy_name, toy_color
+# cat_id means the id from the cats file (or an existing cat of the user's).
+#
+# each row is checked with the same rules the site's forms use, rows are
+# written in chunks with bulk_create, and bad rows go to a rejects file instead
+# of stopping the import. after every chunk, progress (and which new cat each
+# old cat id became) is saved to a state file, so running the same command
+# again after a crash picks up where it left off.
+
+CatForm = modelform_factory(Cat, fields=['name', 'breed', 'description', 'age'])
+ToyForm = modelform_factory(Toy, fields=['name', 'color'])
+
+
+def read_rows(path, fmt):
+    with open(path, newline='') as source:
+        if fmt == 'csv':
+            yield from csv.DictReader(source)
+        else:
+            for line in source:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class Command(BaseCommand):
+    help = "Bulk import cats, feedings or cat toys from CSV or JSON Lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=('cats', 'feedings', 'toys'))
+        parser.add_argument('path')
+        parser.add_argument('--user', required=True, help='username the cats belong to')
+        parser.add_argument('--format', choices=('csv', 'jsonl'), help='default: from the file extension')
+        parser.add_argument('--chunk-size', type=int, default=settings.IMPORT_CHUNK_SIZE)
+        parser.add_argument(
+            '--state', default='import_state.json',
+            help='where progress and the old -> new cat ids are kept between runs',
+        )
+        parser.add_argument('--rejects', help='default: <path>.rejects.jsonl')
+
+    def handle(self, *args, **options):
+        self.user = User.objects.filter(username=options['user']).first()
+        if self.user is None:
+            raise CommandError(f'No user named {options["user"]}.')
+        path, kind = options['path'], options['kind']
+        fmt = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+        self.state_path = options['state']
+        self.state = {'done': {}, 'cat_ids': {}}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as state_file:
+                self.state = json.load(state_file)
+        progress_key = f'{kind}:{os.path.abspath(path)}'
+        skip = self.state['done'].get(progress_key, 0)
+        if skip:
+            self.stdout.write(f'Resuming after row {skip}')
+        # every cat this user already has, plus the ones earlier imports made,
+        # so feeding and toy rows can be checked without a query per row
+        self.owned = set(Cat.objects.filter(user=self.user).values_list('id', flat=True))
+        self.toys = {} # (name, color) -> toy id, filled in as we go
+
+        write_chunk = {'cats': self.write_cats, 'feedings': self.write_feedings,
+                       'toys': self.write_toys}[kind]
+        rejects_path = options['rejects'] or f'{path}.rejects.jsonl'
+        imported = rejected = 0
+        started = time.monotonic()
+        rows = enumerate(islice(read_rows(path, fmt), skip, None), start=skip + 1)
+        with open(rejects_path, 'a') as rejects:
+            while True:
+                chunk = list(islice(rows, options['chunk_size']))
+                if not chunk:
+                    break
+                good, bad = write_chunk(chunk)
+                for line, row, errors in bad:
+                    rejects.write(json.dumps({'row': line, 'data': row, 'errors': errors}) + '\n')
+                rejects.flush()
+                imported += good
+                rejected += len(bad)
+                self.state['done'][progress_key] = chunk[-1][0]
+                self.save_state()
+                elapsed = max(time.monotonic() - started, 1e-9)
+                self.stdout.write(
+                    f'{chunk[-1][0]} rows read, {imported} imported, {rejected} rejected '
+                    f'({(imported + rejected) / elapsed:,.0f} rows/s)'
+                )
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Done: {imported} imported, {rejected} rejected in {elapsed:.1f}s '
+            f'({(imported + rejected) / max(elapsed, 1e-9):,.0f} rows/s)'
+        ))
+        if rejected:
+            self.stdout.write(f'Rejected rows are in {rejects_path}')
+
+    def save_state(self):
+        # write to a temporary file and swap it in, so a crash mid-write can
+        # never leave a half-written state file behind
+        temporary = f'{self.state_path}.tmp'
+        with open(temporary, 'w') as state_file:
+            json.dump(self.state, state_file)
+        os.replace(temporary, self.state_path)
+
+    def cat_id(self, value):
+        # an id from the cats file, or one of the user's existing cats
+        value = str(value or '').strip()
+        if value in self.state['cat_ids']:
+            return self.state['cat_ids'][value]
+        if value.isdigit() and int(value) in self.owned:
+            return int(value)
+        return None
+
+    def write_cats(self, chunk):
+        good, bad = [], []
+        for line, row in chunk:
+            form = CatForm(row)
+            if form.is_valid():
+                good.append((row.get('id'), Cat(user=self.user, **form.cleaned_data)))
+            else:
+                bad.append((line, row, form.errors))
+        with transaction.atomic():
+            created = Cat.objects.bulk_create([cat for _, cat in good])
+            cats_changed([cat.id for cat in created], [self.user.id], touch=False)
+        for (old_id, _), cat in zip(good, created):
+            self.owned.add(cat.id)
+            if old_id not in (None, ''):
+                self.state['cat_ids'][str(old_id).strip()] = cat.id
+        return len(created), bad
+
+    def write_feedings(self, chunk):
+        good, bad = set(), []
+        for line, row in chunk:
+            cat_id = self.cat_id(row.get('cat_id'))
+            form = FeedingEntryForm({**row, 'cat': cat_id})
+            if cat_id is None:
+                bad.append((line, row, {'cat_id': ['No such cat in this import or for this user.']}))
+            elif form.is_valid():
+                data = form.cleaned_data
+                good.add((cat_id, data['date'], data['meal']))
+            else:
+                bad.append((line, row, form.errors))
+        with transaction.atomic():
+            # ignore_conflicts: a meal already logged is skipped, not an error
+            Feeding.objects.bulk_create(
+                [Feeding(cat_id=cat_id, date=day, meal=meal) for cat_id, day, meal in good],
+                ignore_conflicts=True,
+            )
+            cats_changed({cat_id for cat_id, _, _ in good}, [self.user.id], changes=true_counters())
+            rollups.refresh({(cat_id, day) for cat_id, day, _ in good})
+        return len(good), bad
+
+    def write_toys(self, chunk):
+        pairs, bad = set(), []
+        for line, row in chunk:
+            cat_id = self.cat_id(row.get('cat_id'))
+            form = ToyForm({'name': row.get('toy_name'), 'color': row.get('toy_color')})
+            if cat_id is None:
+                bad.append((line, row, {'cat_id': ['No such cat in this import or for this user.']}))
+            elif form.is_valid():
+                pairs.add((cat_id, (form.cleaned_data['name'], form.cleaned_data['color'])))
+            else:
+                bad.append((line, row, form.errors))
+        with transaction.atomic():
+            self.resolve_toys({toy for _, toy in pairs})
+            Through = Cat.toys.through
+            Through.objects.bulk_create(
+                [Through(cat_id=cat_id, toy_id=self.toys[toy]) for cat_id, toy in pairs],
+                ignore_conflicts=True,
+            )
+            cats_changed({cat_id for cat_id, _ in pairs}, [self.user.id], changes=true_counters())
+        return len(pairs), bad
+
+    def resolve_toys(self, wanted):
+        # toys are matched on (name, color). look up the ones we haven't seen
+        # yet in one query, and make any that don't exist in one bulk_create
+        missing = wanted - self.toys.keys()
+        if not missing:
+            return
+        names = {name for name, _ in missing}
+        for toy_id, name, color in Toy.objects.filter(name__in=names).values_list('id', 'name', 'color'):
+            self.toys.setdefault((name, color), toy_id)
+        new = [Toy(name=name, color=color) for name, color in missing - self.toys.keys()]
+        for toy in Toy.objects.bulk_create(new):
+            self.toys[(toy.name, toy.color)] = toy.id
+        if new: # every details page lists the toys, and bulk_create sends no signals
+            caching.bump(caching.TOYS_VERSION_KEY)
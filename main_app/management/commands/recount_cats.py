@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+
+from main_app.models import COUNTERS, Cat, true_counters
+from main_app.signals import cats_changed
+
+# python manage.py recount_cats [--user alice] [--dry-run]
+# checks each cat's stored counters (feeding_count, last_fed_at, photo_count,
+# toy_count) against its actual feedings, photos and toys, and fixes the ones
+# that drifted - after a bulk write that forgot to recount(), say, or a change
+# made straight in the database. the cats are read in batches of ids, and only
+# the ones that were wrong are written (and have their cached pages dropped)
+
+
+class Command(BaseCommand):
+    help = "Check the stored feeding, photo and toy counts and fix any that drifted"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='only this username\'s cats')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='report the drifted cats without fixing them')
+
+    def handle(self, *args, **options):
+        cats = Cat.objects.order_by('id')
+        if options['user']:
+            cats = cats.filter(user__username=options['user'])
+        checked = drifted = 0
+        after = 0
+        while True:
+            batch = list(
+                cats.filter(id__gt=after).with_true_counts()
+                .values('id', 'name', *COUNTERS, *[f'true_{name}' for name in COUNTERS])
+                [:options['batch_size']]
+            )
+            if not batch:
+                break
+            after = batch[-1]['id']
+            checked += len(batch)
+            wrong = [cat for cat in batch
+                     if any(cat[name] != cat[f'true_{name}'] for name in COUNTERS)]
+            for cat in wrong:
+                off = ', '.join(f'{name} {cat[name]} -> {cat[f"true_{name}"]}'
+                                for name in COUNTERS if cat[name] != cat[f'true_{name}'])
+                self.stdout.write(f'{cat["name"]} (#{cat["id"]}): {off}')
+            if wrong and not options['dry_run']:
+                cats_changed([cat['id'] for cat in wrong], changes=true_counters())
+            drifted += len(wrong)
+
+        verb = 'would fix' if options['dry_run'] else 'fixed'
+        self.stdout.write(self.style.SUCCESS(f'{checked} cats checked, {verb} {drifted}'))
@@ -0,0 +1,63 @@
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from main_app import uploads
+from main_app.models import Photo
+
+# python manage.py retry_photo_uploads [--older-than 600]
+# re-runs uploads that never finished - pending ones a restart cut off, and
+# (with --failed) ones that ran out of attempts. only photos whose spooled file
+# is still around can be retried; the rest are marked failed.
+# a pending photo might just still be waiting in (or going through) a live
+# worker's queue, and retrying it then would upload it twice - or, if the
+# worker finishes first and removes the spooled file, mark a photo that made it
+# as failed. so pending photos are only picked up once they're older than
+# any upload could take: every attempt's backoff plus a generous margin
+
+
+def default_older_than():
+    # the backoff doubles after each attempt
+    backoff = settings.PHOTO_UPLOAD_BACKOFF * (2 ** settings.PHOTO_UPLOAD_ATTEMPTS - 1)
+    return backoff + 300
+
+
+class Command(BaseCommand):
+    help = "Retry photo uploads left pending (or failed) in the upload spool"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--failed', action='store_true', help='retry failed uploads too')
+        parser.add_argument(
+            '--older-than', type=float, default=None,
+            help='seconds a pending upload must have waited before it is retried '
+                 '(default: what all its attempts could take, plus 5 minutes)',
+        )
+
+    def handle(self, *args, **options):
+        older_than = options['older_than']
+        if older_than is None:
+            older_than = default_older_than()
+        # a pending photo's updated_at is when it was queued - status changes
+        # save with update_fields=['status'], which leaves it alone
+        cutoff = timezone.now() - timedelta(seconds=older_than)
+        stale = Q(status=Photo.PENDING, updated_at__lt=cutoff)
+        if options['failed']:
+            stale |= Q(status=Photo.FAILED)
+        retried = uploaded = lost = 0
+        for photo in Photo.objects.filter(stale).only('id', 'key', 'cat_id'):
+            if not photo.key or not os.path.exists(uploads.spool_path(photo.key)):
+                photo.status = Photo.FAILED
+                photo.save(update_fields=['status'])
+                lost += 1
+                continue
+            retried += 1
+            uploaded += uploads.upload(photo.id, photo.key)
+        recent = Photo.objects.filter(status=Photo.PENDING, updated_at__gte=cutoff).count()
+        self.stdout.write(
+            f'{retried} retried, {uploaded} uploaded, {lost} missing their spooled file, '
+            f'{recent} pending for less than {older_than:g}s left alone'
+        )
@@ -0,0 +1,41 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from main_app import seeding
+
+# python manage.py seed_data --users 10 --cats 50 --feedings 300
+# fills the database with made-up users, cats, feedings, photos and toys (see
+# main_app/seeding.py). the users are called seed0, seed1... (or --prefix) and
+# can all log in with the password in seeding.PASSWORD. the same --seed always
+# makes the same data, so benchmark runs can be compared
+
+
+class Command(BaseCommand):
+    help = "Create users with lots of cats, feedings, photos and toys"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=5)
+        parser.add_argument('--cats', type=int, default=20, help='cats per user')
+        parser.add_argument('--feedings', type=int, default=60, help='feedings per cat')
+        parser.add_argument('--photos', type=int, default=3, help='photos per cat')
+        parser.add_argument('--toys', type=int, default=50, help='toys in the shared catalogue')
+        parser.add_argument('--toys-per-cat', type=int, default=4)
+        parser.add_argument('--prefix', default='seed', help='usernames are <prefix>0, <prefix>1...')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username__startswith=options['prefix']).exists():
+            raise CommandError(
+                f'There are already users starting with {options["prefix"]!r} - '
+                f'pick another --prefix or delete them first.'
+            )
+        people = seeding.seed(
+            users=options['users'], cats=options['cats'], feedings=options['feedings'],
+            photos=options['photos'], toys=options['toys'],
+            toys_per_cat=options['toys_per_cat'], prefix=options['prefix'],
+            seed=options['seed'], stdout=self.stdout,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {len(people)} users. Log in as {people[0].username if people else "-"} '
+            f'with password {seeding.PASSWORD!r}'
+        ))
@@ -0,0 +1,39 @@
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+# python manage.py sync_replicas
+# for trying read replicas out locally with SQLite files (see settings.py):
+# copies the primary database over each replica in DATABASE_REPLICAS, which
+# is what replication would have done by now. until it runs, the replicas show
+# the data as it was at the last copy - handy for watching the read-your-writes
+# pinning in main_app/replicas.py at work. real (Postgres) replicas keep
+# themselves up to date, so this only handles SQLite
+
+
+class Command(BaseCommand):
+    help = "Copy the primary SQLite database over the SQLite read replicas"
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError('no replicas - set DATABASE_REPLICA_URLS')
+        primary = connections['default']
+        if primary.vendor != 'sqlite':
+            raise CommandError('only SQLite databases can be copied like this')
+        source = sqlite3.connect(primary.settings_dict['NAME'])
+        try:
+            for alias in settings.DATABASE_REPLICAS:
+                replica = connections[alias]
+                if replica.vendor != 'sqlite':
+                    raise CommandError(f'{alias} is not SQLite')
+                replica.close()
+                target = sqlite3.connect(replica.settings_dict['NAME'])
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+                self.stdout.write(f'copied the primary to {alias} ({replica.settings_dict["NAME"]})')
+        finally:
+            source.close()
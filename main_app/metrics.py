@@ -0,0 +1,257 @@
+import asyncio
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template.backends.django import DjangoTemplates, Template
+
+from . import caching
+
+# per-view costs: for every request, how many SQL queries it ran, how long they
+# took, how long templates took to render, and its slowest query, grouped by
+# url name (the name= in urls.py). totals since the process started are served
+# at /metrics in Prometheus' text format, and each request is also logged as
+# one JSON line on the "main_app.metrics" logger.
+#
+# QUERY_BUDGETS in settings.py caps how many queries a view may run. going over
+# logs a warning - or, under `manage.py test` (QUERY_BUDGETS_STRICT), raises
+# QueryBudgetExceeded, so a change that adds a query per row fails the tests
+# of whatever view it slowed down.
+#
+# note the totals are per process: with several gunicorn workers, each keeps
+# its own and /metrics shows whichever one answered.
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('main_app_metrics', default=None)
+_lock = threading.Lock()
+_totals = {}
+
+SQL_LABEL_LENGTH = 200 # slowest queries are cut to this many characters
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class _Request:
+    # what one request has cost so far
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.slowest_sql = ''
+        self.slowest_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        # installed with connection.execute_wrapper(), so it sees every query
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            took = time.perf_counter() - started
+            self.queries += 1
+            self.db_time += took
+            if took > self.slowest_time:
+                self.slowest_time, self.slowest_sql = took, sql
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        recorder = _current.get()
+        if recorder is None:
+            return super().render(context, request)
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            recorder.template_time += time.perf_counter() - started
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """
+    the usual Django template engine, timing each render for the metrics.
+    {% include %}s happen inside their parent's render, so they aren't counted
+    twice
+    """
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return TimedTemplate(template.template, self)
+
+
+def _view_name(request):
+    # the url name, or the view's dotted path if it hasn't got one
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else 'unmatched'
+
+
+def _budget(view):
+    return settings.QUERY_BUDGETS.get(view, settings.QUERY_BUDGET_DEFAULT)
+
+
+def _record(view, recorder, duration, over_budget):
+    with _lock:
+        totals = _totals.setdefault(view, {
+            'requests': 0, 'queries': 0, 'db_seconds': 0.0, 'template_seconds': 0.0,
+            'seconds': 0.0, 'over_budget': 0, 'slowest_seconds': 0.0, 'slowest_sql': '',
+        })
+        totals['requests'] += 1
+        totals['queries'] += recorder.queries
+        totals['db_seconds'] += recorder.db_time
+        totals['template_seconds'] += recorder.template_time
+        totals['seconds'] += duration
+        totals['over_budget'] += over_budget
+        if recorder.slowest_time > totals['slowest_seconds']:
+            totals['slowest_seconds'] = recorder.slowest_time
+            totals['slowest_sql'] = recorder.slowest_sql
+
+
+class QueryMetricsMiddleware:
+    # goes near the top of MIDDLEWARE, so the session and user lookups count
+    # towards the view they were for. works both ways, so under ASGI it doesn't
+    # push the async views (async_views.py) back onto a thread
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # how Django's own MiddlewareMixin tells it this instance should
+            # be awaited
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder = _Request()
+        token = _current.set(recorder)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                _watch(stack, recorder)
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return _finish(request, response, recorder, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        recorder = _Request()
+        token = _current.set(recorder)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                # connections belong to a thread, and the queries run on the
+                # thread sync_to_async hands them to, not on the event loop's
+                await sync_to_async(_watch)(stack, recorder)
+                try:
+                    response = await self.get_response(request)
+                finally:
+                    await sync_to_async(stack.close)()
+        finally:
+            _current.reset(token)
+        return _finish(request, response, recorder, time.perf_counter() - started)
+
+
+def _watch(stack, recorder):
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(recorder))
+
+
+def _finish(request, response, recorder, duration):
+    view = _view_name(request)
+    budget = _budget(view)
+    over_budget = budget is not None and recorder.queries > budget
+    _record(view, recorder, duration, over_budget)
+    line = {
+        'event': 'request', 'view': view, 'method': request.method,
+        'status': response.status_code, 'ms': round(duration * 1000, 2),
+        'queries': recorder.queries, 'db_ms': round(recorder.db_time * 1000, 2),
+        'template_ms': round(recorder.template_time * 1000, 2),
+        'slowest_sql_ms': round(recorder.slowest_time * 1000, 2),
+        'slowest_sql': recorder.slowest_sql[:SQL_LABEL_LENGTH],
+    }
+    logger.info(json.dumps(line))
+    if over_budget:
+        message = f'{view} ran {recorder.queries} queries, its budget is {budget}'
+        logger.warning(json.dumps({**line, 'event': 'query_budget_exceeded', 'budget': budget}))
+        if settings.QUERY_BUDGETS_STRICT:
+            raise QueryBudgetExceeded(message)
+    return response
+
+
+def snapshot():
+    # a copy of the totals so far, {view: {...}}
+    with _lock:
+        return {view: dict(totals) for view, totals in _totals.items()}
+
+
+def reset():
+    with _lock:
+        _totals.clear()
+
+
+def _label(value):
+    # Prometheus label values escape backslashes, quotes and newlines
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+METRICS = (
+    # (name, type, help, key in the totals)
+    ('catcollector_view_requests_total', 'counter', 'Requests handled', 'requests'),
+    ('catcollector_view_queries_total', 'counter', 'SQL queries run', 'queries'),
+    ('catcollector_view_db_seconds_total', 'counter', 'Time spent in SQL', 'db_seconds'),
+    ('catcollector_view_template_seconds_total', 'counter', 'Time spent rendering templates',
+     'template_seconds'),
+    ('catcollector_view_seconds_total', 'counter', 'Time spent handling requests', 'seconds'),
+    ('catcollector_view_query_budget_exceeded_total', 'counter',
+     'Requests that ran more queries than their QUERY_BUDGETS entry allows', 'over_budget'),
+)
+
+
+def render_metrics():
+    totals = snapshot()
+    lines = []
+    for name, kind, description, key in METRICS:
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+        lines += [f'{name}{{view="{_label(view)}"}} {row[key]}' for view, row in sorted(totals.items())]
+    name = 'catcollector_view_slowest_query_seconds'
+    lines += [f'# HELP {name} Slowest single SQL query seen, with its text',
+              f'# TYPE {name} gauge']
+    lines += [
+        f'{name}{{view="{_label(view)}",sql="{_label(row["slowest_sql"][:SQL_LABEL_LENGTH])}"}} '
+        f'{row["slowest_seconds"]}'
+        for view, row in sorted(totals.items()) if row['slowest_sql']
+    ]
+    lines += ['# HELP catcollector_page_cache_total Per-user page cache lookups (caching.py)',
+              '# TYPE catcollector_page_cache_total counter']
+    for kind, counts in caching.stats().items():
+        for result, count in counts.items():
+            lines.append(f'catcollector_page_cache_total{{kind="{kind}",result="{result}"}} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """
+    the totals in Prometheus' text format. scrapers send METRICS_TOKEN as a
+    bearer token; without one set, only staff (logged in) can look
+    """
+    token = settings.METRICS_TOKEN
+    if token:
+        allowed = request.headers.get('Authorization') == f'Bearer {token}'
+    else:
+        allowed = request.user.is_authenticated and request.user.is_staff
+    if not allowed:
+        return HttpResponseForbidden('metrics need METRICS_TOKEN or a staff login')
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
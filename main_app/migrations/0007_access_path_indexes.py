@@ -0,0 +1,34 @@
+# Generated by Django 4.0.6 on 2026-10-18 06:41
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('main_app', '0006_cat_user'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cat',
+            index=models.Index(fields=['user', 'name', 'id'], name='cat_user_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='feeding',
+            index=models.Index(fields=['cat', '-date', 'meal'], name='feeding_cat_date_meal_idx'),
+        ),
+        migrations.AlterField(
+            model_name='cat',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='feeding',
+            name='cat',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='main_app.cat'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.0.6 on 2026-10-18 06:50
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_feedings(apps, schema_editor):
+    # the unique constraint can't be added while duplicates exist, so keep the
+    # first feeding logged for each (cat, date, meal) and drop the repeats
+    Feeding = apps.get_model('main_app', 'Feeding')
+    duplicates = (
+        Feeding.objects.values('cat_id', 'date', 'meal')
+        .annotate(first_id=Min('id'), copies=Count('id'))
+        .filter(copies__gt=1)
+    )
+    for group in duplicates:
+        Feeding.objects.filter(
+            cat_id=group['cat_id'], date=group['date'], meal=group['meal']
+        ).exclude(id=group['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0010_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_feedings, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='feeding',
+            constraint=models.UniqueConstraint(fields=('cat', 'date', 'meal'), name='feeding_once_per_meal'),
+        ),
+        migrations.RemoveIndex(
+            model_name='feeding',
+            name='feeding_cat_date_meal_idx',
+        ),
+    ]
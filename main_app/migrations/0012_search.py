@@ -0,0 +1,26 @@
+# Generated by Django 4.0.6 on 2026-10-18 08:10
+
+from django.db import migrations
+
+from main_app import search
+
+
+def install(apps, schema_editor):
+    search.install(schema_editor.connection)
+
+
+def uninstall(apps, schema_editor):
+    search.uninstall(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+    # the full-text index lives outside the models (see main_app/search.py),
+    # so there's nothing here for makemigrations to track
+
+    dependencies = [
+        ('main_app', '0011_feeding_once_per_meal'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.0.6 on 2026-10-18 07:08
+
+from itertools import groupby
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+MEAL_BITS = {'B': 1, 'L': 2, 'D': 4} # as in models.py when this was written
+
+
+def fill_feeding_days(apps, schema_editor):
+    # one FeedingDay for every (cat, date) that already has feedings. the
+    # feedings come out sorted, so each day's meals arrive together
+    Feeding = apps.get_model('main_app', 'Feeding')
+    FeedingDay = apps.get_model('main_app', 'FeedingDay')
+    feedings = (
+        Feeding.objects.order_by('cat_id', 'date')
+        .values_list('cat_id', 'date', 'meal')
+        .iterator(chunk_size=2000)
+    )
+    batch = []
+    for (cat_id, day), meals in groupby(feedings, key=lambda row: row[:2]):
+        bits = 0
+        for _, _, meal in meals:
+            bits |= MEAL_BITS.get(meal, 0)
+        batch.append(FeedingDay(cat_id=cat_id, date=day, meals=bits))
+        if len(batch) >= 1000:
+            FeedingDay.objects.bulk_create(batch)
+            batch = []
+    FeedingDay.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0012_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedingDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('meals', models.PositiveSmallIntegerField(default=0)),
+                ('cat', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='main_app.cat')),
+            ],
+            options={
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='feedingday',
+            constraint=models.UniqueConstraint(fields=('cat', 'date'), name='feeding_day_once_per_date'),
+        ),
+        migrations.RunPython(fill_feeding_days, migrations.RunPython.noop),
+    ]
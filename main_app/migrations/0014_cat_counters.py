@@ -0,0 +1,61 @@
+# Generated by Django 4.0.6 on 2026-10-18 07:25
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_counters(apps, schema_editor):
+    # the historical Cat has no recount(), so this spells out the same
+    # subqueries as models.true_counters() did when it was written
+    Cat = apps.get_model('main_app', 'Cat')
+    Feeding = apps.get_model('main_app', 'Feeding')
+    Photo = apps.get_model('main_app', 'Photo')
+    CatToys = Cat.toys.through
+
+    def count(model):
+        counts = (
+            model.objects.filter(cat=OuterRef('pk')).order_by()
+            .values('cat').annotate(n=Count('*')).values('n')
+        )
+        return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
+    Cat.objects.update(
+        feeding_count=count(Feeding),
+        last_fed_at=Subquery(
+            Feeding.objects.filter(cat=OuterRef('pk')).order_by('-date').values('date')[:1]
+        ),
+        photo_count=count(Photo),
+        toy_count=count(CatToys),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0013_feeding_days'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cat',
+            name='feeding_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cat',
+            name='last_fed_at',
+            field=models.DateField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='cat',
+            name='photo_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cat',
+            name='toy_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
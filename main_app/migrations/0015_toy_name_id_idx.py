@@ -0,0 +1,17 @@
+# Generated by Django 4.0.6 on 2026-10-18 08:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0014_cat_counters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='toy',
+            index=models.Index(fields=['name', 'id'], name='toy_name_id_idx'),
+        ),
+    ]
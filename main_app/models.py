@@ -1,6 +1,12 @@
+from datetime import timedelta
+
 from django.db import models
+from django.db.models import (
+    Count, Exists, F, IntegerField, OuterRef, Q, Subquery, Sum, Value,
+)
+from django.db.models.functions import Coalesce, Greatest
 from django.urls import reverse # import reverse to allow redirection in create route
-from datetime import date
+from django.utils import timezone
 from django.contrib.auth.models import User # this is how we are going to bring in
 # the User model from the authorization that is preinstalled by Django
 
@@ -12,13 +18,46 @@ MEALS = (
 # we are representing our meals in a tuple filled with two-tuples. these work as
 # key:value pairs. django sees these and will automatically understand that those
 # letters in the key location represent the words in the value location.
+MEAL_BITS = {code: 1 << i for i, (code, _) in enumerate(MEALS)}
+ALL_MEALS = sum(MEAL_BITS.values())
+# ^ each meal as one bit, for FeedingDay below: B = 1, L = 2, D = 4, so
+# breakfast and dinner together is 5 and a fully fed day is 7
 
 # Create your models here.
 
+class ToyQuerySet(models.QuerySet):
+    def available_for(self, cat_id):
+        # toys this cat does NOT have yet. NOT EXISTS lets the database stop at
+        # the first matching cat_toys row for each toy, and it can use the
+        # (cat_id, toy_id) unique index on the through table to do it, where
+        # NOT IN (...) would build the whole list of the cat's toy ids first
+        return self.filter(
+            ~Exists(Cat.toys.through.objects.filter(cat_id=cat_id, toy_id=OuterRef('pk')))
+        )
+
+    def search(self, term):
+        # a simple "name or color contains" match for the toy pickers
+        if not term:
+            return self
+        return self.filter(Q(name__icontains=term) | Q(color__icontains=term))
+
+
 # Toys model added
 class Toy(models.Model):
     name = models.CharField(max_length=50)
     color = models.CharField(max_length=20)
+    updated_at = models.DateTimeField(auto_now=True) # auto_now stamps the time
+    # on every save(), the etags for our pages are built from these (etags.py)
+
+    objects = ToyQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # the toy pickers page through the whole catalogue sorted by
+            # (name, id) - keyset_page needs this to start where the last page
+            # left off instead of sorting every toy for every page
+            models.Index(fields=['name', 'id'], name='toy_name_id_idx'),
+        ]
 
     def __str__(self):
         return f'{self.color} {self.name}'
@@ -26,6 +65,117 @@ class Toy(models.Model):
     def get_absolute_url(self):
         return reverse('detail', kwargs={'pk': self.id})
 
+def _related_count(model, **filters):
+    # a correlated subquery that counts the rows of model pointing at the outer
+    # cat. subqueries keep each count independent - joining feedings AND toys in
+    # the same query would multiply the rows together and skew the numbers
+    counts = (
+        model.objects.filter(**filters)
+        .order_by()
+        .values('cat')
+        .annotate(total=Count('*'))
+        .values('total')
+    )
+    return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
+
+COUNTERS = ('feeding_count', 'last_fed_at', 'photo_count', 'toy_count')
+
+
+def true_counters():
+    # the true value of each of Cat's counters, as expressions over the outer
+    # cat, for an annotate() or an update()
+    return {
+        'feeding_count': _related_count(Feeding, cat=OuterRef('pk')),
+        'last_fed_at': last_fed(),
+        'photo_count': _related_count(Photo, cat=OuterRef('pk')),
+        'toy_count': _related_count(Cat.toys.through, cat=OuterRef('pk')),
+    }
+
+
+def last_fed():
+    # the outer cat's latest feeding date, straight off the end of the
+    # (cat, date, meal) index
+    return Subquery(
+        Feeding.objects.filter(cat=OuterRef('pk')).order_by('-date').values('date')[:1]
+    )
+
+
+def counter_changes(model, created, day=None, count=1):
+    """
+    the UPDATE that moves a cat's counters along when `count` feedings, photos
+    or toys (model, or Cat.toys.through) were just added (created=True) or
+    removed. F() makes it one atomic statement, so two requests at once can't
+    lose a count. some things are looked up again rather than worked out: a
+    deleted feeding might have been the latest one, and m2m_changed lists the
+    toys it was asked to remove, not the ones the cat actually had
+    """
+    step = count if created else -count
+    if model is Photo:
+        return {'photo_count': F('photo_count') + step}
+    if model is Cat.toys.through:
+        if created:
+            return {'toy_count': F('toy_count') + step}
+        return {'toy_count': true_counters()['toy_count']}
+    if created:
+        # Greatest() is NULL if either side is, hence the Coalesce for a cat's
+        # first feeding
+        latest = Greatest(Coalesce('last_fed_at', Value(day)), Value(day))
+    else:
+        latest = last_fed()
+    return {'feeding_count': F('feeding_count') + step, 'last_fed_at': latest}
+
+
+class CatQuerySet(models.QuerySet):
+    # custom querysets let us chain our own methods onto Cat.objects, just like
+    # the built-in filter() or order_by()
+
+    def with_feeding_status(self, day=None):
+        # meals_fed = how many feedings each cat got on day, and Cat.fed_for_today()
+        # compares it with the number of meals. one query for the whole queryset
+        # instead of a COUNT per cat. (working out fed-or-not in SQL too, with a
+        # Case/When on meals_fed, would copy the whole COUNT subquery into it and
+        # run it twice a row.) pass day in from the view so "today" is worked out
+        # once per request (in the site's timezone) rather than once per cat
+        day = day or timezone.localdate()
+        return self.annotate(meals_fed=_related_count(Feeding, cat=OuterRef('pk'), date=day))
+
+    def with_summary(self, day=None):
+        # the columns the cat index shows for every row. the counts and last
+        # fed date are stored on the cat itself, so only fed-today is left for
+        # the database to work out
+        return self.with_feeding_status(day)
+
+    def with_true_counts(self):
+        # what the stored counters should be, worked out from the rows
+        # themselves, as true_feeding_count, true_last_fed_at...
+        return self.annotate(**{f'true_{name}': value for name, value in true_counters().items()})
+
+    def recount(self):
+        # sets the counters to their true values in one UPDATE, for bulk writes
+        # (which skip the signals that usually keep them up to date) and for
+        # `manage.py recount_cats`. returns how many cats it updated
+        return self.update(**true_counters())
+
+    def with_missed_meals(self, days, day=None):
+        # missed_meals = meals not logged over the `days` days up to day. it
+        # reads the FeedingDay rollup, so each cat costs at most `days` small
+        # rows however many years of feedings it has
+        day = day or timezone.localdate()
+        fed = (
+            FeedingDay.objects.filter(
+                cat=OuterRef('pk'), date__gt=day - timedelta(days=days), date__lte=day
+            )
+            .order_by()
+            .values('cat')
+            .annotate(total=Sum(FeedingDay.meal_count()))
+            .values('total')
+        )
+        return self.annotate(
+            missed_meals=days * len(MEALS) - Coalesce(Subquery(fed, output_field=IntegerField()), 0)
+        )
+
+
 class Cat(models.Model):
     name = models.CharField(max_length=100)
     breed = models.CharField(max_length=100)
@@ -33,20 +183,66 @@ class Cat(models.Model):
     age = models.IntegerField()
     # Add the M:M relationship
     toys = models.ManyToManyField(Toy)
-    user = models.ForeignKey(User, on_delete=models.CASCADE) # here making a cat
+    # also touched whenever the cat's feedings, photos or toys change (signals.py)
+    updated_at = models.DateTimeField(auto_now=True)
+    # kept up to date by signals.py as feedings, photos and toys come and go, so
+    # pages can show them without counting anything. `manage.py recount_cats`
+    # puts them right if they ever drift. plain IntegerFields, so a drifted
+    # count going below zero can't make a delete fail
+    feeding_count = models.IntegerField(default=0, editable=False)
+    last_fed_at = models.DateField(null=True, blank=True, editable=False)
+    photo_count = models.IntegerField(default=0, editable=False)
+    toy_count = models.IntegerField(default=0, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False) # here making a cat
     # belong to a certain user. reminder that models.CASCADE makes it so that an
     # instance of Cat will be deleted if it belongs to a User that is deleted. and
     # again, many cats --> belong to one user, so Cat will require a FK for User
 # this line above^ is all we need here to apply authorization now -> to the master
 # catcollector/urls.py
+    objects = CatQuerySet.as_manager() # swap in our queryset so Cat.objects has
+    # with_summary() and friends on top of everything it normally does
+
+    class Meta:
+        indexes = [
+            # the index page asks for one user's cats sorted by (name, id), so
+            # this index hands them back already in order. it starts with user,
+            # so it also does the job the plain user FK index used to do - that's
+            # why the FK above has db_index=False
+            models.Index(fields=['user', 'name', 'id'], name='cat_user_name_idx'),
+        ]
+
     def __str__(self):
         return self.name
+
+    def save(self, *args, **kwargs):
+        # the counters are only ever written by the database (F() updates and
+        # recount()), never from this instance, whose copies may be out of date
+        # by now - saving them back would undo whatever happened since it loaded
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in COUNTERS
+            ]
+        super().save(*args, **kwargs)
     
     def get_absolute_url(self):
         return reverse('details', kwargs={'cat_id': self.id})
     
     def fed_for_today(self):
-        return self.feeding_set.filter(date=date.today()).count() >= len(MEALS)
+        # cats loaded through Cat.objects.with_feeding_status() already carry
+        # today's count, so there is nothing left to look up
+        if hasattr(self, 'meals_fed'):
+            return self.meals_fed >= len(MEALS)
+        # localdate() is "today" in TIME_ZONE, which matters with USE_TZ = True -
+        # date.today() would be the server's idea of today instead
+        today = timezone.localdate()
+        # if the feedings were already loaded with prefetch_related, count today's
+        # meals from memory instead of asking the database again
+        if 'feeding_set' in getattr(self, '_prefetched_objects_cache', {}):
+            return sum(
+                1 for feeding in self.feeding_set.all() if feeding.date == today
+            ) >= len(MEALS)
+        return self.feeding_set.filter(date=today).count() >= len(MEALS)
     # The fed_for_today method demonstrates the use of filter() to obtain a
     # <QuerySet> for today's feedings, then count() is chained on to the query
     # to return the actual number of objects returned.
@@ -70,7 +266,8 @@ class Feeding(models.Model):
         choices=MEALS, # adding the choices as the tuple we defined above
         default=MEALS[0][0] # default value being the first[0] in the tuple, 'B'
     )
-    cat = models.ForeignKey(Cat, on_delete=models.CASCADE)
+    updated_at = models.DateTimeField(auto_now=True)
+    cat = models.ForeignKey(Cat, on_delete=models.CASCADE, db_index=False)
     # In a one-to-many relationship, the on_delete = models.CASCADE is required.
     # It ensures that if a Cat record is deleted, all of the child Feedings will be
     # deleted automatically as well, thus avoiding orphan records
@@ -85,13 +282,94 @@ class Feeding(models.Model):
     class Meta: # we can add meta attributes to our models also
         ordering = ['-date'] # in this case, to change the default sorting, so most
         # recent date first
+        constraints = [
+            # a cat only gets each meal once a day, so logging the same meal
+            # twice (a double-click, or a bulk upload sent again) is a no-op.
+            # the unique index behind this also serves "this cat's feedings,
+            # newest first" and "this cat's feedings today" (read backwards for
+            # the newest-first one), with meal at the end so the fed-today
+            # counts never have to visit the table itself (a covering index).
+            # like Cat above, it replaces the plain cat FK index
+            models.UniqueConstraint(
+                fields=['cat', 'date', 'meal'], name='feeding_once_per_meal'
+            ),
+        ]
+
+class FeedingDay(models.Model):
+    # a rollup of Feeding: one row per cat per day it was fed, with that day's
+    # meals as bits (see MEAL_BITS). signals.py keeps it in step as feedings are
+    # saved and deleted (rollups.refresh() does it for bulk writes), so the
+    # calendar and the missed meals counts read one small row per day instead
+    # of every feeding the cat ever had
+    date = models.DateField()
+    meals = models.PositiveSmallIntegerField(default=0)
+    cat = models.ForeignKey(Cat, on_delete=models.CASCADE, db_index=False)
+
+    class Meta:
+        ordering = ['-date']
+        constraints = [
+            # also the index behind "this cat's days from X to Y", which is
+            # every query we make on this table
+            models.UniqueConstraint(fields=['cat', 'date'], name='feeding_day_once_per_date'),
+        ]
+
+    def __str__(self):
+        return f"{', '.join(self.get_meals_display()) or 'No meals'} on {self.date}"
+
+    @staticmethod
+    def meal_count():
+        # how many bits are set in meals, worked out by the database
+        count = None
+        for bit in MEAL_BITS.values():
+            fed = F('meals').bitand(bit) / bit
+            count = fed if count is None else count + fed
+        return count
+
+    def meal_codes(self):
+        return [code for code, _ in MEALS if self.meals & MEAL_BITS[code]]
+
+    def get_meals_display(self):
+        return [name for code, name in MEALS if self.meals & MEAL_BITS[code]]
+
+    def meals_fed(self):
+        return len(self.meal_codes())
+
 
 class Photo(models.Model):
+    # photos are saved before their file reaches storage (see uploads.py), so
+    # each one tracks where its upload is at, single letters like MEALS above
+    PENDING, READY, FAILED = 'P', 'R', 'F'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (READY, 'Ready'),
+        (FAILED, 'Failed'),
+    )
+
     url = models.CharField(max_length=200)
+    key = models.CharField(max_length=200, blank=True) # the file's name in storage
+    status = models.CharField(max_length=1, choices=STATUSES, default=READY)
+    # smaller/WebP copies of the photo, filled in by derivatives.py
+    derivatives = models.JSONField(default=dict, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
     cat = models.ForeignKey(Cat, on_delete=models.CASCADE)
 
     def __str__(self):
         return f"Photo for cat_id: {self.cat_id} @{self.url}"
+
+    def _srcset(self, variant):
+        # "url 320w, url 640w, ..." - the browser picks the smallest one that
+        # looks sharp at the size the photo is actually shown
+        sizes = self.derivatives.get('sizes', {})
+        return ', '.join(
+            f'{sizes[width][variant]} {width}w'
+            for width in sorted(sizes, key=int) if variant in sizes[width]
+        )
+
+    def srcset(self):
+        return self._srcset('src')
+
+    def webp_srcset(self):
+        return self._srcset('webp')
 # If a Model "belongs to" another Model, it must have a foreign key. If there's more
 #  than one "belongs to" relationship - that means more than one foreign key.
 
@@ -0,0 +1,76 @@
+import base64
+import json
+
+from django.db.models import Q
+
+# keyset (a.k.a. cursor) pagination. instead of OFFSET, which makes the database
+# walk past every earlier row, we remember the sort values of the last row we
+# showed and ask for the rows that come after it. that stays fast on page 1000
+# just like on page 1, as long as there is an index on the sort fields.
+
+
+def encode_cursor(values):
+    # the cursor is just the sort values of the last row, as url-safe base64 json
+    raw = json.dumps(list(values), default=str).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    # returns None for a missing or garbled cursor, which just means "page one"
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != length:
+        return None
+    return values
+
+
+def _after(fields, values):
+    # (a, b, c) > (x, y, z) spelled out as
+    # a >= x AND (a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z))
+    # the a >= x on its own adds nothing to the answer, but it's what lets the
+    # database jump straight to x in the index - it can't do that with an OR
+    condition = Q()
+    for i, field in enumerate(fields):
+        step = Q(**{f'{field}__gt': values[i]})
+        for prior, value in zip(fields[:i], values[:i]):
+            step &= Q(**{prior: value})
+        condition |= step
+    return Q(**{f'{fields[0]}__gte': values[0]}) & condition
+
+
+def get_page_size(request, default, maximum, param='page_size'):
+    # ?page_size= lets the client pick, clamped so nobody can ask for everything
+    try:
+        size = int(request.GET.get(param, default))
+    except ValueError:
+        size = default
+    return max(1, min(size, maximum))
+
+
+def keyset_page(queryset, fields, cursor, size):
+    """
+    fields is the ascending sort order and must end in a unique column (like id)
+    so that no two rows ever tie. returns (rows, next_cursor), where next_cursor
+    is None on the last page
+    """
+    values = decode_cursor(cursor, len(fields))
+    queryset = queryset.order_by(*fields)
+    if values is not None:
+        queryset = queryset.filter(_after(fields, values))
+    # ask for one extra row - if it shows up, we know there is a next page
+    # without having to run a separate COUNT
+    rows = list(queryset[:size + 1])
+    next_cursor = None
+    if len(rows) > size:
+        rows = rows[:size]
+        last = rows[-1]
+        next_cursor = encode_cursor(
+            last[field] if isinstance(last, dict) else getattr(last, field)
+            for field in fields
+        )
+    return rows, next_cursor
@@ -0,0 +1,131 @@
+import asyncio
+import contextvars
+import random
+import time
+
+from django.conf import settings
+from django.db import connections
+
+# read replicas. with DATABASE_REPLICAS set (settings.py fills it in from
+# DATABASE_REPLICA_URLS), the read-heavy views listed in REPLICA_VIEWS run
+# their queries on a replica, and everything else stays on the primary
+# ('default').
+#
+# replicas lag behind the primary, so someone who has just changed something
+# has to see the change: after a request writes anything, its response sets a
+# cookie that keeps that visitor's reads on the primary for the next
+# REPLICA_PIN_SECONDS - long enough for the redirect after add_feeding, say,
+# and for the replicas to catch up. a request also stays on the primary once it
+# has written, or while it's inside a transaction.
+#
+# only requests (through ReplicaMiddleware) ever read from a replica.
+# management commands, background threads and the like always use the primary
+
+PIN_COOKIE = 'primary_until'
+
+_current = contextvars.ContextVar('main_app_replicas', default=None)
+
+
+class _Request:
+    # where one request's reads may go
+    def __init__(self, pinned):
+        self.pinned = pinned
+        self.allowed = False # set once the view is known to be in REPLICA_VIEWS
+        self.wrote = False
+        self.replica = None # picked on the first read, then kept for the request
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _current.get()
+        if (
+            state is None or not state.allowed or state.pinned or state.wrote
+            or not settings.DATABASE_REPLICAS
+            or connections['default'].in_atomic_block
+        ):
+            return None
+        if state.replica is None:
+            state.replica = random.choice(settings.DATABASE_REPLICAS)
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = _current.get()
+        if state is not None:
+            state.wrote = True
+        # something read off a replica is saved to the primary. otherwise no
+        # opinion, so Django's usual choice (default, or the hint's database)
+        # stands - migrate and the tests write to other databases on purpose
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in settings.DATABASE_REPLICAS:
+            return 'default'
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # they all hold the same data
+        databases = {'default', *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def used():
+    # whether this request has read anything from a replica
+    state = _current.get()
+    return state is not None and state.replica is not None
+
+
+class ReplicaMiddleware:
+    # goes above SessionMiddleware, so saving the session counts as a write.
+    # works both ways, like metrics.QueryMetricsMiddleware
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = _Request(_pinned(request))
+        token = _current.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return _pin(state, response)
+
+    async def __acall__(self, request):
+        # sync_to_async copies the context into its thread, so the queries
+        # there see (and update) this same state
+        state = _Request(_pinned(request))
+        token = _current.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return _pin(state, response)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = _current.get()
+        if state is not None:
+            state.allowed = request.resolver_match.url_name in settings.REPLICA_VIEWS
+
+
+def _pinned(request):
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def _pin(state, response):
+    if state.wrote and settings.DATABASE_REPLICAS:
+        seconds = settings.REPLICA_PIN_SECONDS
+        response.set_cookie(
+            PIN_COOKIE, f'{time.time() + seconds:.3f}', max_age=seconds,
+            httponly=True, samesite='Lax',
+        )
+    return response
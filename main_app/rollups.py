@@ -0,0 +1,108 @@
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import ALL_MEALS, MEAL_BITS, Feeding, FeedingDay
+
+# keeps FeedingDay (one row per cat per day, meals as bits) in step with
+# Feeding, and reads it back for the calendar and the feeding history.
+#
+# single feedings (the add feeding form, the admin) go through signals.py,
+# which flips one bit with meal_added()/meal_removed() - an UPDATE, plus an
+# INSERT the first time a day is seen. bulk_create and update() skip signals,
+# so code that writes feedings that way calls refresh() with the days it
+# touched, which works each of those days out again from the feedings.
+
+
+def meal_added(cat_id, day, meal):
+    bit = MEAL_BITS[meal]
+    days = FeedingDay.objects.filter(cat_id=cat_id, date=day)
+    if days.update(meals=F('meals').bitor(bit)):
+        return
+    try:
+        with transaction.atomic():
+            FeedingDay.objects.create(cat_id=cat_id, date=day, meals=bit)
+    except IntegrityError:
+        # another request made the day's row between our UPDATE and INSERT
+        days.update(meals=F('meals').bitor(bit))
+
+
+def meal_removed(cat_id, day, meal):
+    FeedingDay.objects.filter(cat_id=cat_id, date=day).update(
+        meals=F('meals').bitand(ALL_MEALS ^ MEAL_BITS[meal])
+    )
+
+
+def refresh(days):
+    """
+    works out the rollup again for each (cat_id, date) in days, from whatever
+    feedings those days have now. three queries plus the writes, however many
+    days there are
+    """
+    days = set(days)
+    if not days:
+        return
+    cat_ids = {cat_id for cat_id, _ in days}
+    dates = {day for _, day in days}
+    meals = dict.fromkeys(days, 0)
+    feedings = Feeding.objects.filter(cat_id__in=cat_ids, date__in=dates).order_by()
+    for cat_id, day, meal in feedings.values_list('cat_id', 'date', 'meal'):
+        if (cat_id, day) in meals:
+            meals[(cat_id, day)] |= MEAL_BITS[meal]
+    changed = []
+    for row in FeedingDay.objects.filter(cat_id__in=cat_ids, date__in=dates).order_by():
+        key = (row.cat_id, row.date)
+        if key in meals and row.meals != meals[key]:
+            row.meals = meals[key]
+            changed.append(row)
+        meals.pop(key, None)
+    FeedingDay.objects.bulk_update(changed, ['meals'], batch_size=500)
+    FeedingDay.objects.bulk_create(
+        [FeedingDay(cat_id=cat_id, date=day, meals=bits)
+         for (cat_id, day), bits in meals.items() if bits],
+        batch_size=500, ignore_conflicts=True,
+    )
+
+
+def recent_days(cat_id, today, days):
+    # {date: meal bits} for the `days` days up to today. days with nothing
+    # logged are simply missing
+    return dict(
+        FeedingDay.objects.filter(
+            cat_id=cat_id, date__gt=today - timedelta(days=days), date__lte=today
+        ).values_list('date', 'meals')
+    )
+
+
+def history(cat_id, today, days):
+    """
+    one entry per day, newest first, for the feeding history on the details
+    page: (date, [meal names], missed meal count). days with nothing logged
+    are included, since those are the ones worth noticing
+    """
+    fed = recent_days(cat_id, today, days)
+    rows = []
+    for offset in range(days):
+        day = today - timedelta(days=offset)
+        row = FeedingDay(date=day, meals=fed.get(day, 0))
+        rows.append((day, row.get_meals_display(), len(MEAL_BITS) - row.meals_fed()))
+    return rows
+
+
+def calendar(cat_id, today, weeks):
+    """
+    the last `weeks` weeks as a grid for the heatmap: a list of weeks, oldest
+    first, each a list of 7 days Monday to Sunday. a day is a FeedingDay (not
+    saved, just for its helpers), or None for days after today
+    """
+    start = today - timedelta(days=today.weekday() + 7 * (weeks - 1))
+    fed = recent_days(cat_id, today, (today - start).days + 1)
+    grid = []
+    for week in range(weeks):
+        days = []
+        for weekday in range(7):
+            day = start + timedelta(days=7 * week + weekday)
+            days.append(None if day > today else FeedingDay(date=day, meals=fed.get(day, 0)))
+        grid.append(days)
+    return grid
@@ -0,0 +1,112 @@
+import random
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from .models import MEAL_BITS, MEALS, Cat, Feeding, FeedingDay, Photo, Toy
+
+# fake but realistic-looking data for benchmarks and for trying the site out
+# with more than a handful of cats. used by `manage.py seed_data` and
+# `manage.py benchmark`. the same seed always gives the same data.
+#
+# everything goes in with bulk_create, so nothing passes through signals.py:
+# the FeedingDay rollup is written here directly (we know every meal we made),
+# each user's cats are recounted once at the end, and the search index keeps
+# itself up to date with its database triggers.
+
+NAMES = ['Mittens', 'Lolo', 'Shadow', 'Tigger', 'Smokey', 'Oreo', 'Luna', 'Simba',
+         'Cleo', 'Pumpkin', 'Whiskers', 'Ginger', 'Milo', 'Nala', 'Pepper', 'Jasper']
+BREEDS = ['Tabby', 'Siamese', 'Maine Coon', 'Persian', 'Bengal', 'Sphynx', 'Ragdoll']
+WORDS = ['likes', 'naps', 'sunny', 'windows', 'hates', 'baths', 'chases', 'string',
+         'loud', 'purrs', 'shy', 'friendly', 'orange', 'grey', 'fluffy', 'kitten']
+TOYS = ['mouse', 'ball', 'feather wand', 'laser', 'catnip fish', 'tunnel', 'spring']
+COLORS = ['red', 'blue', 'green', 'grey', 'yellow', 'purple', 'orange', 'pink']
+
+BATCH_SIZE = 2000
+PASSWORD = 'meowmeow123' # every seeded user's password
+
+
+def _bulk(model, rows):
+    model.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+
+
+def _feedings(cat_id, count, today, rng):
+    # `count` feedings going back from today, most meals logged but a few
+    # missed here and there, plus the matching FeedingDay rows
+    feedings, days = [], []
+    day = today
+    while len(feedings) < count:
+        bits = 0
+        for meal, _ in MEALS:
+            if len(feedings) < count and rng.random() < 0.85:
+                feedings.append(Feeding(cat_id=cat_id, date=day, meal=meal))
+                bits |= MEAL_BITS[meal]
+        if bits:
+            days.append(FeedingDay(cat_id=cat_id, date=day, meals=bits))
+        day -= timedelta(days=1)
+    return feedings, days
+
+
+@transaction.atomic
+def seed(users=5, cats=20, feedings=60, photos=3, toys=50, toys_per_cat=4,
+         prefix='seed', seed=0, stdout=None):
+    """
+    makes `users` users named <prefix>0, <prefix>1... (password PASSWORD), each
+    with `cats` cats, and each cat with `feedings` feedings, `photos` photos
+    and `toys_per_cat` toys out of a shared catalogue of `toys`. returns the
+    users
+    """
+    rng = random.Random(seed)
+    today = timezone.localdate()
+
+    def say(message):
+        if stdout:
+            stdout.write(message)
+
+    catalogue = [
+        Toy(name=f'{rng.choice(TOYS)} {i}', color=rng.choice(COLORS)) for i in range(toys)
+    ]
+    _bulk(Toy, catalogue)
+    toy_ids = list(Toy.objects.order_by('-id').values_list('id', flat=True)[:toys])
+    say(f'{toys} toys')
+
+    password = make_password(PASSWORD) # hashing is slow on purpose, so just once
+    _bulk(User, [User(username=f'{prefix}{i}', password=password) for i in range(users)])
+    people = list(User.objects.filter(username__in=[f'{prefix}{i}' for i in range(users)]))
+
+    for person in people:
+        _bulk(Cat, [
+            Cat(
+                user=person,
+                name=f'{rng.choice(NAMES)} {i}',
+                breed=rng.choice(BREEDS),
+                description=' '.join(rng.choices(WORDS, k=6)),
+                age=rng.randint(0, 20),
+            )
+            for i in range(cats)
+        ])
+        cat_ids = list(Cat.objects.filter(user=person).values_list('id', flat=True))
+        new_feedings, new_days, new_photos, new_toys = [], [], [], []
+        for cat_id in cat_ids:
+            cat_feedings, cat_days = _feedings(cat_id, feedings, today, rng)
+            new_feedings += cat_feedings
+            new_days += cat_days
+            new_photos += [
+                Photo(cat_id=cat_id, url=f'https://picsum.photos/seed/{cat_id}-{i}/640/480')
+                for i in range(photos)
+            ]
+            new_toys += [
+                Cat.toys.through(cat_id=cat_id, toy_id=toy_id)
+                for toy_id in rng.sample(toy_ids, min(toys_per_cat, len(toy_ids)))
+            ]
+        _bulk(Feeding, new_feedings)
+        _bulk(FeedingDay, new_days)
+        _bulk(Photo, new_photos)
+        _bulk(Cat.toys.through, new_toys)
+        Cat.objects.filter(user=person).recount()
+        say(f'{person.username}: {len(cat_ids)} cats, {len(new_feedings)} feedings, '
+            f'{len(new_photos)} photos, {len(new_toys)} toys')
+    return people
@@ -0,0 +1,142 @@
+import contextvars
+
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import caching, rollups
+from .models import Cat, Feeding, Photo, Toy, counter_changes
+
+# keeps caching.py's page versions (and Cat.updated_at) in step with the data.
+# each receiver bumps only the versions of the pages that show what changed: a
+# cat's details page, its owner's index, or (for toys, which every details page
+# lists) the toys.
+# the same UPDATE that touches a cat also moves its counters (feeding_count,
+# photo_count...) along, and the Feeding receivers at the bottom keep the
+# FeedingDay rollup up to date (see rollups.py).
+# these are hooked up in MainAppConfig.ready() (apps.py)
+
+
+def cats_changed(cat_ids, user_ids=None, touch=True, changes=None):
+    # also called directly by code that writes with bulk_create() or update(),
+    # which skip the model signals (those should recount() the cats too).
+    # changes are extra columns for the UPDATE, like counter_changes() gives
+    if touch:
+        # a new feeding, photo or toy changes the cat's page too, so move its
+        # updated_at along (etags.py relies on it)
+        Cat.objects.filter(id__in=cat_ids).update(updated_at=timezone.now(), **(changes or {}))
+    if user_ids is None:
+        user_ids = Cat.objects.filter(id__in=cat_ids).values_list('user_id', flat=True)
+    caching.bump(
+        *(caching.cat_version_key(cat_id) for cat_id in cat_ids),
+        *(caching.user_version_key(user_id) for user_id in set(user_ids)),
+    )
+
+
+# the cats being deleted right now. a cat's feedings and photos go with it,
+# each sending post_delete, and moving the counters of a cat that's about to
+# disappear one row at a time would cost an UPDATE (and more) per row. the
+# receivers below skip those, and the cat's own post_delete bumps its page
+# versions once for the lot
+_deleting = contextvars.ContextVar('main_app_deleting_cats', default=frozenset())
+
+
+def _being_deleted(cat_id):
+    return cat_id in _deleting.get()
+
+
+@receiver(pre_delete, sender=Cat)
+def cat_deleting(sender, instance, **kwargs):
+    _deleting.set(_deleting.get() | {instance.pk})
+
+
+@receiver([post_save, post_delete], sender=Cat)
+def cat_changed(sender, instance, signal, **kwargs):
+    if signal is post_delete:
+        # Django deletes the feedings and photos before the cat itself
+        _deleting.set(_deleting.get() - {instance.pk})
+    cats_changed([instance.pk], [instance.user_id], touch=False)
+
+
+@receiver([post_save, post_delete], sender=Feeding)
+@receiver([post_save, post_delete], sender=Photo)
+def cat_child_changed(sender, instance, signal, created=False, **kwargs):
+    if signal is post_delete and _being_deleted(instance.cat_id):
+        return
+    changes = None
+    if signal is post_delete or created:
+        changes = counter_changes(sender, created, day=getattr(instance, 'date', None))
+    elif sender is Feeding:
+        was = getattr(instance, '_rollup_was', None)
+        if was and was != (instance.cat_id, instance.date):
+            # an edit moved it to another day (or cat), which is rare enough
+            # to just count both cats again
+            Cat.objects.filter(id__in={was[0], instance.cat_id}).recount()
+            if was[0] != instance.cat_id:
+                cats_changed([was[0]])
+    cats_changed([instance.cat_id], changes=changes)
+
+
+@receiver([post_save, post_delete], sender=Toy)
+def toy_changed(sender, instance, **kwargs):
+    caching.bump(caching.TOYS_VERSION_KEY)
+
+
+@receiver(pre_delete, sender=Toy)
+def toy_deleting(sender, instance, **kwargs):
+    # deleting a toy cascades to its cat_toys rows without any m2m_changed, so
+    # every cat that had it loses it here, like toy.cat_set.clear() would. it
+    # runs inside the delete's transaction, before the rows go
+    cat_ids = list(instance.cat_set.values_list('id', flat=True))
+    if cat_ids:
+        cats_changed(cat_ids, changes={'toy_count': F('toy_count') - 1})
+
+
+@receiver(m2m_changed, sender=Cat.toys.through)
+def cat_toys_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # fires for cat.toys.add/remove/clear and for toy.cat_set.add/remove/clear.
+    # for the toy.cat_set side, instance is the toy and pk_set holds the cats
+    if action in ('post_add', 'post_remove'):
+        cat_ids = pk_set if reverse else [instance.pk]
+        # each cat gains one toy from toy.cat_set.add(), or all of pk_set from
+        # cat.toys.add() (which leaves out toys the cat already had)
+        changes = counter_changes(
+            Cat.toys.through, action == 'post_add', count=1 if reverse else len(pk_set),
+        )
+    elif action == 'pre_clear':
+        # after the clear we can't tell which cats were involved any more.
+        # it hasn't happened yet, so the counts are set to what they're about
+        # to be: every listed cat loses this one toy, or this cat loses them all
+        cat_ids = list(instance.cat_set.values_list('id', flat=True)) if reverse else [instance.pk]
+        changes = {'toy_count': F('toy_count') - 1 if reverse else 0}
+    else:
+        return
+    if cat_ids:
+        cats_changed(cat_ids, changes=changes)
+
+
+@receiver(pre_save, sender=Feeding)
+def remember_feeding_day(sender, instance, **kwargs):
+    # an edited feeding might have moved to another day, so note where it was
+    # before the save. new feedings (no pk yet) skip the query
+    if instance.pk is not None:
+        instance._rollup_was = (
+            Feeding.objects.filter(pk=instance.pk).values_list('cat_id', 'date').first()
+        )
+
+
+@receiver(post_save, sender=Feeding)
+def feeding_saved(sender, instance, created, **kwargs):
+    if created:
+        rollups.meal_added(instance.cat_id, instance.date, instance.meal)
+    else:
+        was = getattr(instance, '_rollup_was', None)
+        rollups.refresh({(instance.cat_id, instance.date), *([was] if was else [])})
+
+
+@receiver(post_delete, sender=Feeding)
+def feeding_deleted(sender, instance, **kwargs):
+    # a deleted cat's FeedingDay rows go with it anyway
+    if not _being_deleted(instance.cat_id):
+        rollups.meal_removed(instance.cat_id, instance.date, instance.meal)
@@ -0,0 +1,140 @@
+import io
+import os
+import shutil
+import threading
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.urls import reverse
+from django.utils.module_loading import import_string
+
+UPLOAD_SALT = 'main_app.storage.upload'
+
+# where photo files actually live. views and the upload workers only ever talk
+# to get_storage(), so swapping S3 for a folder on disk (handy for local dev and
+# tests) is just a matter of changing PHOTO_STORAGE in settings.py. every
+# backend has url(), save(), open(), exists() and presigned_post()
+
+
+class S3Storage:
+    def __init__(self):
+        self.bucket = settings.S3_BUCKET
+        self.base_url = settings.S3_BASE_URL
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # one boto3 client for the whole process, built the first time it's
+        # needed. boto3 clients are thread safe and keep a pool of open
+        # connections to S3, so every upload reuses them instead of paying for
+        # a fresh client (and a fresh TLS handshake) each time
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import boto3
+                    from botocore.config import Config
+                    self._client = boto3.client('s3', config=Config(
+                        max_pool_connections=settings.PHOTO_UPLOAD_WORKERS or 1,
+                        retries={'max_attempts': 3, 'mode': 'standard'},
+                    ))
+        return self._client
+
+    def url(self, key):
+        # S3 urls are predictable, so we know where a photo will live before
+        # it has even been uploaded
+        return f'{self.base_url}{self.bucket}/{key}'
+
+    def save(self, fileobj, key):
+        self.client.upload_fileobj(fileobj, self.bucket, key)
+
+    def open(self, key):
+        # the whole object, as a file-like object to read from
+        fileobj = io.BytesIO()
+        self.client.download_fileobj(self.bucket, key, fileobj)
+        fileobj.seek(0)
+        return fileobj
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as error:
+            if error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+                return False
+            raise
+        return True
+
+    def presigned_post(self, key, max_size, expires):
+        # a short-lived, signed form the browser can POST the file to itself,
+        # straight to S3. returns {'url': ..., 'fields': {...}}
+        return self.client.generate_presigned_post(
+            self.bucket, key,
+            Conditions=[['content-length-range', 1, max_size]],
+            ExpiresIn=expires,
+        )
+
+
+class LocalStorage:
+    # keeps photos under MEDIA_ROOT and serves them from MEDIA_URL
+    def __init__(self):
+        self.root = settings.MEDIA_ROOT
+        self.base_url = settings.MEDIA_URL
+
+    def url(self, key):
+        return f'{self.base_url}{key}'
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def save(self, fileobj, key):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as destination:
+            shutil.copyfileobj(fileobj, destination)
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def presigned_post(self, key, max_size, expires):
+        # stands in for S3's presigned POST: the browser posts the file to our
+        # own local_photo_upload view along with a signed, expiring token
+        token = signing.dumps({'key': key, 'max_size': max_size}, salt=UPLOAD_SALT)
+        return {'url': reverse('local_photo_upload'), 'fields': {'token': token}}
+
+    def accept_upload(self, token, fileobj, expires):
+        # the other half of presigned_post. raises signing.BadSignature (or its
+        # SignatureExpired subclass) if the token is forged or too old
+        grant = signing.loads(token, salt=UPLOAD_SALT, max_age=expires)
+        if fileobj.size > grant['max_size']:
+            raise ValueError('file is larger than the upload allows')
+        self.save(fileobj, grant['key'])
+        return grant['key']
+
+
+@lru_cache(maxsize=None)
+def get_storage():
+    return import_string(settings.PHOTO_STORAGE)()
+
+
+async def asave(fileobj, key):
+    # save() for async views (async_views.py). boto3 has no async api, so the
+    # upload runs on a thread of its own - not the one the ORM uses - and the
+    # event loop keeps serving other requests while S3 takes its time. the
+    # client is still the one shared, cached client
+    await sync_to_async(get_storage().save, thread_sensitive=False)(fileobj, key)
+
+
+@receiver(setting_changed)
+def reset_storage(setting, **kwargs):
+    # tests swap storage settings with override_settings, so forget the cached
+    # backend whenever one of them changes
+    if setting in ('PHOTO_STORAGE', 'MEDIA_ROOT', 'MEDIA_URL', 'S3_BUCKET', 'S3_BASE_URL'):
+        get_storage.cache_clear()
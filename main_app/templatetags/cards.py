@@ -0,0 +1,81 @@
+from django import template
+from django.conf import settings
+from django.template import Context
+from django.template.defaulttags import CsrfTokenNode
+from django.utils.safestring import mark_safe
+
+from ..caching import page_cache
+
+# {% load cards %}
+# {% cat_cards cats missed_meals_days %}
+# {% toy_cards toys %}  or  {% toy_cards toys 'add' cat.id %}
+#
+# the cards the list pages repeat for every cat or toy. each one is rendered
+# from its own template (cats/card.html, toys/card.html) and the html is kept
+# in the 'pages' cache (caching.py) for CARD_CACHE_TIMEOUT seconds, under a key
+# made from the object's id and updated_at. a cat's updated_at moves whenever
+# anything on its card does (signals.py), and a toy's on every save, so a
+# changed object simply gets a new key - nothing needs deleting. the rest of a
+# cat's card (fed today, missed meals) depends on the day rather than the cat,
+# so those values are in the key too.
+#
+# a whole page of cards is looked up with one get_many() and the ones that
+# were missing stored with one set_many(), rather than a trip to the cache per
+# card. the toy buttons are forms with a CSRF token in them, which is
+# different for every visitor: the cached copy holds a placeholder, swapped for
+# this visitor's token on the way out.
+
+register = template.Library()
+
+CSRF_PLACEHOLDER = 'card-csrf-placeholder'
+_CSRF_INPUT = CsrfTokenNode().render(Context({'csrf_token': CSRF_PLACEHOLDER}))
+
+
+def _cards(context, template_name, name, objects, version, **values):
+    # version(obj) -> what goes in obj's key besides its id and values
+    engine_template = context.template.engine.get_template(template_name)
+    objects = list(objects)
+    keys = [
+        ':'.join(map(str, ['cats:card', name, obj.pk, *version(obj), *values.values()]))
+        for obj in objects
+    ]
+    timeout = settings.CARD_CACHE_TIMEOUT
+    cache = page_cache()
+    cached = cache.get_many(keys) if timeout and keys else {}
+    cards, fresh = [], {}
+    for obj, key in zip(objects, keys):
+        html = cached.get(key)
+        if html is None:
+            # the same way an inclusion tag renders its template
+            html = engine_template.render(
+                context.new({name: obj, 'csrf_token': CSRF_PLACEHOLDER, **values})
+            )
+            fresh[key] = html
+        cards.append(html)
+    if timeout and fresh:
+        cache.set_many(fresh, timeout)
+    html = ''.join(cards)
+    if _CSRF_INPUT in html:
+        html = html.replace(_CSRF_INPUT, CsrfTokenNode().render(context))
+    return mark_safe(html)
+
+
+@register.simple_tag(takes_context=True)
+def cat_cards(context, cats, missed_meals_days):
+    # cats from with_summary() and with_missed_meals(), as the index gets them
+    return _cards(
+        context, 'cats/card.html', 'cat', cats,
+        lambda cat: (cat.updated_at.timestamp(), cat.fed_for_today(), cat.missed_meals),
+        missed_meals_days=missed_meals_days,
+    )
+
+
+@register.simple_tag(takes_context=True)
+def toy_cards(context, toys, action=None, cat_id=None):
+    # action is 'add' or 'remove' (with the cat_id to do it to) for the
+    # buttons on a cat's details page
+    return _cards(
+        context, 'toys/card.html', 'toy', toys,
+        lambda toy: (toy.updated_at.timestamp(),),
+        action=action, cat_id=cat_id,
+    )
@@ -1,3 +1,1323 @@
-from django.test import TestCase
+from datetime import date, timedelta
+import gzip
+import importlib
+import importlib.util
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from catcollector.postgres.pool import Pool, PoolTimeout
+
+from . import async_views, caching, derivatives, metrics, replicas, search, uploads
+from .templatetags import cards
+from .models import ALL_MEALS, MEALS, Cat, Feeding, FeedingDay, Photo, Toy
 
 # Create your tests here.
+
+# django_heroku swaps in whitenoise's manifest storage, which needs collectstatic
+# to have been run. the tests render real templates, so point {% static %} back
+# at the plain storage instead
+plain_static = override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage'
+)
+
+
+@plain_static
+class CatDetailsQueryTests(TestCase):
+    # the details page should cost the same number of queries whether a cat has
+    # a few photos, feedings and toys or a whole pile of them
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        self.cat = Cat.objects.create(
+            name='Lolo', breed='tabby', description='foul little demon', age=3,
+            user=self.user,
+        )
+
+    def get_details(self):
+        return self.client.get(reverse('details', kwargs={'cat_id': self.cat.id}))
+
+    def test_query_count_is_fixed(self):
+        # session + user, the two etag queries (cat and toys), then cat (with
+        # feeding status), feedings and available toys. the cat's counts say it
+        # has no photos or toys, so those aren't looked up
+        with self.assertNumQueries(7):
+            response = self.get_details()
+        self.assertContains(response, 'No Photos')
+
+        for meal, _ in (('B', 'Breakfast'), ('L', 'Lunch'), ('D', 'Dinner')):
+            Feeding.objects.create(date=timezone.localdate(), meal=meal, cat=self.cat)
+        for i in range(5):
+            Photo.objects.create(url=f'https://example.com/{i}.png', cat=self.cat)
+            toy = Toy.objects.create(name=f'mouse {i}', color='grey')
+            if i % 2:
+                self.cat.toys.add(toy)
+
+        # ...plus photos and the cat's toys, however many there are
+        with self.assertNumQueries(9):
+            response = self.get_details()
+        self.assertContains(response, 'has been fed all their meals for today')
+        self.assertEqual(len(response.context['toys']), 3)
+
+        for i in range(5, 15):
+            Photo.objects.create(url=f'https://example.com/{i}.png', cat=self.cat)
+            self.cat.toys.add(Toy.objects.create(name=f'ball {i}', color='red'))
+        with self.assertNumQueries(9):
+            self.get_details()
+
+
+@plain_static
+class CatIndexTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        # same name on purpose, so the id tiebreaker in the cursor gets exercised
+        self.cats = [
+            Cat.objects.create(
+                name=name, breed='tabby', description='', age=1, user=self.user
+            )
+            for name in ('Sachi', 'Lolo', 'Raven', 'Lolo', 'Clementine')
+        ]
+        other = User.objects.create_user('someone', password='meowmeow123')
+        Cat.objects.create(name='Stranger', breed='', description='', age=1, user=other)
+
+    def test_walks_every_page_in_name_order(self):
+        seen = []
+        url = reverse('index') + '?page_size=2'
+        while url:
+            response = self.client.get(url)
+            seen += [cat.id for cat in response.context['cats']]
+            cursor = response.context['next_cursor']
+            url = cursor and reverse('index') + f'?page_size=2&after={cursor}'
+        expected = sorted(self.cats, key=lambda cat: (cat.name, cat.id))
+        self.assertEqual(seen, [cat.id for cat in expected])
+
+    def test_summary_columns_come_from_one_query(self):
+        lolo = self.cats[1]
+        for meal in ('B', 'L', 'D'):
+            Feeding.objects.create(date=timezone.localdate(), meal=meal, cat=lolo)
+        Feeding.objects.create(date=date(2022, 1, 1), meal='B', cat=lolo)
+        lolo.toys.add(Toy.objects.create(name='mouse', color='grey'))
+        # session + user + the etag query + the one cats query
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('index'))
+        row = next(cat for cat in response.context['cats'] if cat.id == lolo.id)
+        self.assertEqual(row.feeding_count, 4)
+        self.assertEqual(row.toy_count, 1)
+        self.assertEqual(row.last_fed_at, timezone.localdate())
+        self.assertTrue(row.fed_for_today())
+        self.assertEqual(len(response.context['cats']), 5)
+
+
+@plain_static
+class AvailableToysTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        self.cat = Cat.objects.create(name='Lolo', breed='', description='', age=1, user=self.user)
+        self.toys = [Toy.objects.create(name=f'toy {i:02}', color='red' if i % 3 else 'blue')
+                     for i in range(10)]
+        self.cat.toys.add(self.toys[0], self.toys[5])
+
+    def test_available_for_skips_the_cats_toys(self):
+        available = set(Toy.objects.available_for(self.cat.id))
+        self.assertEqual(available, set(self.toys) - {self.toys[0], self.toys[5]})
+
+    @override_settings(TOYS_PAGE_SIZE=3)
+    def test_load_more_walks_the_rest_of_the_catalogue(self):
+        response = self.client.get(reverse('details', kwargs={'cat_id': self.cat.id}))
+        names = [toy.name for toy in response.context['toys']]
+        cursor = response.context['toys_next']
+        url = reverse('available_toys', kwargs={'cat_id': self.cat.id})
+        while cursor:
+            data = self.client.get(url, {'after': cursor}).json()
+            names += [name for name in (f'toy {i:02}' for i in range(10)) if name in data['html']]
+            cursor = data['next']
+        self.assertEqual(names, [f'toy {i:02}' for i in (1, 2, 3, 4, 6, 7, 8, 9)])
+
+    def test_search(self):
+        response = self.client.get(
+            reverse('details', kwargs={'cat_id': self.cat.id}), {'toy_q': 'blue'}
+        )
+        self.assertEqual(
+            [toy.name for toy in response.context['toys']], ['toy 03', 'toy 06', 'toy 09']
+        )
+
+
+class FeedingStatusTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('tester', password='meowmeow123')
+        self.today = timezone.localdate()
+        self.fed = Cat.objects.create(name='Lolo', breed='', description='', age=1, user=user)
+        self.hungry = Cat.objects.create(name='Raven', breed='', description='', age=1, user=user)
+        for meal in ('B', 'L', 'D'):
+            Feeding.objects.create(date=self.today, meal=meal, cat=self.fed)
+        Feeding.objects.create(date=self.today, meal='B', cat=self.hungry)
+        Feeding.objects.create(date=self.today - timedelta(days=1), meal='L', cat=self.hungry)
+
+    def test_whole_queryset_in_one_query(self):
+        with self.assertNumQueries(1):
+            cats = {cat.id: cat for cat in Cat.objects.with_feeding_status(self.today)}
+            self.assertEqual(cats[self.fed.id].meals_fed, 3)
+            self.assertEqual(cats[self.hungry.id].meals_fed, 1)
+            self.assertTrue(cats[self.fed.id].fed_for_today())
+            self.assertFalse(cats[self.hungry.id].fed_for_today())
+
+    def test_counts_each_cats_feedings_once(self):
+        sql = str(Cat.objects.with_feeding_status(self.today).query)
+        self.assertEqual(sql.count('COUNT('), 1)
+
+    def test_other_days(self):
+        yesterday = self.today - timedelta(days=1)
+        cat = Cat.objects.with_feeding_status(yesterday).get(id=self.hungry.id)
+        self.assertEqual(cat.meals_fed, 1)
+
+    def test_falls_back_to_a_query_without_the_annotation(self):
+        cat = Cat.objects.get(id=self.fed.id)
+        with self.assertNumQueries(1):
+            self.assertTrue(cat.fed_for_today())
+
+
+class ExplainQueriesCommandTests(TestCase):
+    def test_plans_use_the_new_indexes(self):
+        user = User.objects.create_user('tester', password='meowmeow123')
+        cat = Cat.objects.create(name='Lolo', breed='', description='', age=1, user=user)
+        out = StringIO()
+        call_command('explain_queries', cat=cat.id, stdout=out)
+        self.assertIn('cat_user_name_idx', out.getvalue())
+        # SQLite builds the feeding_once_per_meal constraint into the table, so
+        # its index shows up under an automatic name - what matters is that
+        # feedings are never scanned
+        self.assertNotIn('SCAN main_app_feeding', out.getvalue())
+        self.assertNotIn('SCAN U0', out.getvalue())
+        # the toy pickers walk the catalogue in (name, id) order off the index,
+        # and a later page starts from its cursor instead of the first toy
+        self.assertIn('toy_name_id_idx', out.getvalue())
+        self.assertNotIn('TEMP B-TREE', out.getvalue())
+        later_page = out.getvalue().split('available_toys: a later page')[1]
+        self.assertIn('SEARCH main_app_toy USING INDEX toy_name_id_idx', later_page)
+
+
+class BrokenStorage:
+    # a storage backend that never manages to save anything
+    def url(self, key):
+        return f'/broken/{key}'
+
+    def save(self, fileobj, key):
+        raise ConnectionError('storage is down')
+
+
+@plain_static
+class PhotoUploadTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        self.cat = Cat.objects.create(name='Lolo', breed='', description='', age=1, user=self.user)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.media = os.path.join(tmp.name, 'media')
+        self.spool = os.path.join(tmp.name, 'spool')
+        settings = override_settings(
+            PHOTO_STORAGE='main_app.storage.LocalStorage', MEDIA_ROOT=self.media,
+            PHOTO_SPOOL_DIR=self.spool, PHOTO_UPLOAD_WORKERS=0, PHOTO_UPLOAD_BACKOFF=0,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def post_photo(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                reverse('add_photo', kwargs={'cat_id': self.cat.id}),
+                {'photo-file': SimpleUploadedFile('lolo.png', b'not really a png')},
+            )
+
+    def test_upload_lands_in_storage_and_photo_is_ready(self):
+        response = self.post_photo()
+        self.assertRedirects(response, reverse('details', kwargs={'cat_id': self.cat.id}))
+        photo = Photo.objects.get(cat=self.cat)
+        self.assertEqual(photo.status, Photo.READY)
+        self.assertTrue(photo.key.endswith('.png'))
+        self.assertEqual(photo.url, f'/media/{photo.key}')
+        with open(os.path.join(self.media, photo.key), 'rb') as saved:
+            self.assertEqual(saved.read(), b'not really a png')
+        self.assertEqual(os.listdir(self.spool), [])
+
+    def test_thumbnail_failure_does_not_fail_the_upload(self):
+        with mock.patch.object(derivatives, 'generate', side_effect=RuntimeError('S3 is down')), \
+                self.assertLogs('main_app.uploads', 'ERROR'):
+            response = self.post_photo()
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Photo.objects.get(cat=self.cat).status, Photo.READY)
+        self.assertEqual(os.listdir(self.spool), [])
+
+    @override_settings(PHOTO_STORAGE='main_app.tests.BrokenStorage', PHOTO_UPLOAD_ATTEMPTS=3)
+    def test_failed_upload_is_kept_for_a_retry(self):
+        with self.assertLogs('main_app.uploads', 'WARNING') as logs:
+            self.post_photo()
+        photo = Photo.objects.get(cat=self.cat)
+        self.assertEqual(photo.status, Photo.FAILED)
+        self.assertEqual(sum('upload attempt' in line for line in logs.output), 3)
+        self.assertEqual(os.listdir(self.spool), [photo.key])
+
+        # storage is back - the retry command finishes the job
+        with override_settings(PHOTO_STORAGE='main_app.storage.LocalStorage'):
+            call_command('retry_photo_uploads', failed=True, stdout=StringIO())
+        photo.refresh_from_db()
+        self.assertEqual(photo.status, Photo.READY)
+
+    def test_recent_pending_uploads_are_left_to_their_worker(self):
+        with mock.patch.object(uploads, 'background'): # queued, never run
+            self.post_photo()
+        photo = Photo.objects.get(cat=self.cat)
+        out = StringIO()
+        call_command('retry_photo_uploads', stdout=out)
+        self.assertIn('0 retried', out.getvalue())
+        self.assertIn('1 pending', out.getvalue())
+        photo.refresh_from_db()
+        self.assertEqual(photo.status, Photo.PENDING)
+
+        # long enough ago that no worker can still be on it
+        Photo.objects.filter(id=photo.id).update(
+            updated_at=timezone.now() - timedelta(hours=1)
+        )
+        call_command('retry_photo_uploads', stdout=StringIO())
+        photo.refresh_from_db()
+        self.assertEqual(photo.status, Photo.READY)
+
+
+@plain_static
+class DirectPhotoUploadTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        self.cat = Cat.objects.create(name='Lolo', breed='', description='', age=1, user=self.user)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        settings = override_settings(
+            PHOTO_STORAGE='main_app.storage.LocalStorage', MEDIA_ROOT=tmp.name,
+            PHOTO_UPLOAD_MAX_SIZE=100,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def presign(self):
+        return self.client.post(
+            reverse('photo_upload_url', kwargs={'cat_id': self.cat.id}), {'filename': 'lolo.jpg'}
+        ).json()
+
+    def test_upload_then_confirm(self):
+        upload = self.presign()
+        response = self.client.post(
+            upload['url'], {**upload['fields'], 'file': SimpleUploadedFile('lolo.jpg', b'meow')}
+        )
+        self.assertEqual(response.status_code, 204)
+        confirm_url = reverse('confirm_photo', kwargs={'cat_id': self.cat.id})
+        for _ in range(2): # confirming twice still makes just one photo
+            photo = self.client.post(confirm_url, {'confirm_token': upload['confirm_token']}).json()
+        self.assertEqual(Photo.objects.get().url, photo['url'])
+        self.assertEqual(Photo.objects.get().status, Photo.READY)
+
+    def test_rejects_oversized_and_forged_uploads(self):
+        upload = self.presign()
+        response = self.client.post(
+            upload['url'], {**upload['fields'], 'file': SimpleUploadedFile('big.jpg', b'x' * 101)}
+        )
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post(
+            upload['url'], {'token': 'forged', 'file': SimpleUploadedFile('lolo.jpg', b'meow')}
+        )
+        self.assertEqual(response.status_code, 403)
+        # nothing reached storage, so there is nothing to confirm
+        response = self.client.post(
+            reverse('confirm_photo', kwargs={'cat_id': self.cat.id}),
+            {'confirm_token': upload['confirm_token']},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Photo.objects.exists())
+
+    def test_only_the_owner_can_get_an_upload_url(self):
+        other = User.objects.create_user('someone', password='meowmeow123')
+        self.client.force_login(other)
+        response = self.client.post(
+            reverse('photo_upload_url', kwargs={'cat_id': self.cat.id}), {'filename': 'x.jpg'}
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class PhotoDerivativeTests(TestCase):
+    def setUp(self):
+        from PIL import Image
+        user = User.objects.create_user('tester', password='meowmeow123')
+        cat = Cat.objects.create(name='Lolo', breed='', description='', age=1, user=user)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        settings = override_settings(
+            PHOTO_STORAGE='main_app.storage.LocalStorage', MEDIA_ROOT=tmp.name,
+            PHOTO_THUMBNAIL_WIDTHS=(320, 640, 1280),
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.media = tmp.name
+        Image.new('RGB', (800, 600), 'orange').save(os.path.join(tmp.name, 'lolo.jpg'))
+        self.photo = Photo.objects.create(url='/media/lolo.jpg', key='lolo.jpg', cat=cat)
+
+    def test_makes_each_smaller_width_plus_a_full_size_webp(self):
+        from PIL import Image
+        derivatives.generate(self.photo.id)
+        self.photo.refresh_from_db()
+        self.assertEqual(self.photo.derivatives['width'], 800)
+        sizes = self.photo.derivatives['sizes']
+        self.assertEqual(sorted(sizes, key=int), ['320', '640', '800'])
+        self.assertEqual(sizes['800']['src'], '/media/lolo.jpg')
+        with Image.open(os.path.join(self.media, 'lolo_320w.webp')) as thumbnail:
+            self.assertEqual((thumbnail.format, thumbnail.size), ('WEBP', (320, 240)))
+        self.assertEqual(
+            self.photo.srcset(),
+            '/media/lolo_320w.jpg 320w, /media/lolo_640w.jpg 640w, /media/lolo.jpg 800w',
+        )
+
+    def test_existing_sizes_are_not_made_again(self):
+        derivatives.generate(self.photo.id)
+        os.remove(os.path.join(self.media, 'lolo.jpg'))
+        # the original is gone, so this only works if it isn't opened at all
+        with self.assertNumQueries(1):
+            derivatives.generate(self.photo.id)
+
+    def test_closes_the_original_and_skips_huge_images(self):
+        from main_app.storage import LocalStorage
+        opened = []
+        def open_original(storage, key):
+            opened.append(open(storage.path(key), 'rb'))
+            return opened[-1]
+        with mock.patch.object(LocalStorage, 'open', open_original), \
+                mock.patch('PIL.Image.MAX_IMAGE_PIXELS', 1000), \
+                self.assertLogs('main_app.derivatives', 'WARNING'):
+            derivatives.generate(self.photo.id) # 800x600 is a "decompression bomb" now
+        self.assertTrue(opened[0].closed)
+        self.photo.refresh_from_db()
+        self.assertEqual(self.photo.derivatives, {})
+
+
+@plain_static
+class PageCacheTests(TestCase):
+    def setUp(self):
+        caches['pages'].clear()
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        self.cat = Cat.objects.create(name='Lolo', breed='', description='', age=1, user=self.user)
+        self.details = reverse('details', kwargs={'cat_id': self.cat.id})
+        # the first visit hands out the CSRF cookie, so it is never cached
+        self.client.get(self.details)
+
+    def assert_cached(self, url, cached=True):
+        hits = sum(kind['hits'] for kind in caching.stats().values())
+        response = self.client.get(url)
+        now = sum(kind['hits'] for kind in caching.stats().values())
+        self.assertEqual(now - hits, 1 if cached else 0)
+        return response
+
+    def test_second_visit_is_a_hit(self):
+        self.assert_cached(self.details, cached=False)
+        with self.assertNumQueries(4): # just session, user and the etag queries
+            response = self.assert_cached(self.details)
+        self.assertContains(response, 'Lolo')
+        self.assertEqual(caching.stats()['details'], {'hits': 1, 'misses': 2})
+
+    def test_writes_invalidate_just_the_affected_pages(self):
+        other = Cat.objects.create(name='Raven', breed='', description='', age=1, user=self.user)
+        other_details = reverse('details', kwargs={'cat_id': other.id})
+        index = reverse('index')
+        for url in (self.details, other_details, index):
+            self.client.get(url)
+
+        Feeding.objects.create(date=timezone.localdate(), meal='B', cat=self.cat)
+        self.assert_cached(self.details, cached=False)
+        self.assert_cached(other_details)
+        self.assert_cached(index, cached=False)
+
+        toy = Toy.objects.create(name='mouse', color='grey') # every cat can see it
+        self.assert_cached(other_details, cached=False)
+        self.client.get(self.details)
+        toy.cat_set.add(self.cat) # from the toy's side of the relationship
+        self.assert_cached(self.details, cached=False)
+        self.assert_cached(other_details)
+
+    def test_pages_are_per_user(self):
+        self.client.get(reverse('index'))
+        someone = User.objects.create_user('someone', password='meowmeow123')
+        self.client.force_login(someone)
+        response = self.client.get(reverse('index'))
+        self.assertNotContains(response, 'Lolo')
+
+
+@plain_static
+@override_settings(PAGE_CACHE_TIMEOUT=0) # so every visit renders the page
+class CardCacheTests(TestCase):
+    def setUp(self):
+        caches['pages'].clear()
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        self.cat = Cat.objects.create(name='Lolo', breed='', description='', age=1, user=self.user)
+        self.toy = Toy.objects.create(name='mouse', color='grey')
+
+    def card_renders(self, url):
+        # how many cards were rendered from their templates for one visit
+        from django.template.base import Template
+        with mock.patch.object(Template, 'render', autospec=True, side_effect=Template.render) as render:
+            response = self.client.get(url)
+        names = [call.args[0].origin.template_name for call in render.call_args_list]
+        return response, sum(name in ('cats/card.html', 'toys/card.html') for name in names)
+
+    def test_cards_are_reused_until_the_object_changes(self):
+        index = reverse('index')
+        self.assertEqual(self.card_renders(index)[1], 1)
+        response, renders = self.card_renders(index)
+        self.assertEqual(renders, 0)
+        self.assertContains(response, 'Lolo')
+
+        self.cat.name = 'Clementine'
+        self.cat.save()
+        response, renders = self.card_renders(index)
+        self.assertEqual(renders, 1)
+        self.assertContains(response, 'Clementine')
+        self.assertNotContains(response, 'Lolo')
+
+        Feeding.objects.bulk_create(
+            Feeding(date=timezone.localdate(), meal=meal, cat=self.cat) for meal, _ in MEALS
+        ) # no signals, so updated_at stays put - fed today is in the key anyway
+        self.assertContains(self.client.get(index), 'Fed all meals today')
+
+        self.client.get(reverse('toys_index'))
+        self.toy.name = 'feather wand'
+        self.toy.save()
+        response = self.client.get(reverse('toys_index'))
+        self.assertContains(response, 'feather wand')
+        self.assertNotContains(response, 'mouse')
+
+    def test_cached_toy_buttons_carry_each_visitors_csrf_token(self):
+        self.cat.toys.add(self.toy)
+        details = reverse('details', kwargs={'cat_id': self.cat.id})
+        remove = reverse('assoc_toy_delete', kwargs={'cat_id': self.cat.id, 'toy_id': self.toy.id})
+        for _ in range(2): # the second visitor gets the card from the cache
+            client = Client(enforce_csrf_checks=True)
+            client.force_login(self.user)
+            content = client.get(details).content.decode()
+            self.assertNotIn(cards.CSRF_PLACEHOLDER, content)
+            token = re.search(
+                f'action="{remove}".*?name="csrfmiddlewaretoken" value="([^"]+)"', content, re.S
+            ).group(1)
+            response = client.post(remove, {'csrfmiddlewaretoken': token})
+            self.assertEqual(response.status_code, 302)
+            self.cat.toys.add(self.toy)
+
+
+class PageCacheSettingsTests(SimpleTestCase):
+    def load(self, **env):
+        # a fresh copy of settings.py under env, leaving the real one alone
+        path = os.path.join(os.path.dirname(__file__), '..', 'catcollector', 'settings.py')
+        spec = importlib.util.spec_from_file_location('settings_copy', path)
+        module = importlib.util.module_from_spec(spec)
+        with mock.patch.dict(os.environ, env):
+            for name in ('PAGE_CACHE_URL', 'PAGE_CACHE_TIMEOUT', 'WEB_CONCURRENCY'):
+                if name not in env:
+                    os.environ.pop(name, None)
+            spec.loader.exec_module(module)
+        return module
+
+    def test_per_process_cache_is_off_with_several_workers(self):
+        self.assertEqual(self.load().PAGE_CACHE_TIMEOUT, 300)
+        self.assertEqual(self.load(WEB_CONCURRENCY='1').PAGE_CACHE_TIMEOUT, 300)
+        # the other workers would never see the version bumps
+        self.assertEqual(self.load(WEB_CONCURRENCY='4').PAGE_CACHE_TIMEOUT, 0)
+        shared = self.load(WEB_CONCURRENCY='4', PAGE_CACHE_URL='file:///tmp/cat-pages')
+        self.assertEqual(shared.PAGE_CACHE_TIMEOUT, 300)
+
+
+@plain_static
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        caches['pages'].clear()
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        self.cat = Cat.objects.create(name='Lolo', breed='', description='', age=1, user=self.user)
+        self.toy = Toy.objects.create(name='mouse', color='grey')
+
+    def test_unchanged_pages_answer_304_without_rendering(self):
+        urls = [
+            reverse('index'), reverse('details', kwargs={'cat_id': self.cat.id}),
+            reverse('toys_index'), reverse('detail', kwargs={'pk': self.toy.id}),
+        ]
+        self.client.get(urls[1]) # pick up the CSRF cookie first
+        for url in urls:
+            etag = self.client.get(url)['ETag']
+            # session + user + at most two etag queries, nothing else
+            with self.assertNumQueries(4 if url == urls[1] else 3):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304, url)
+
+    def test_child_and_toy_changes_move_the_details_etag(self):
+        url = reverse('details', kwargs={'cat_id': self.cat.id})
+        self.client.get(url)
+        etag = self.client.get(url)['ETag']
+        Feeding.objects.create(date=timezone.localdate(), meal='B', cat=self.cat)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        etag = self.client.get(url)['ETag']
+        self.cat.toys.add(self.toy)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        etag = self.client.get(url)['ETag']
+        self.toy.delete()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class BulkFeedingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        self.cats = [
+            Cat.objects.create(name=f'cat {i}', breed='', description='', age=1, user=self.user)
+            for i in range(3)
+        ]
+        self.today = timezone.localdate()
+
+    def post(self, feedings):
+        return self.client.post(
+            reverse('bulk_add_feeding'), json.dumps({'feedings': feedings}),
+            content_type='application/json',
+        )
+
+    def test_logs_a_whole_day_with_a_fixed_number_of_queries(self):
+        Feeding.objects.create(cat=self.cats[0], date=self.today, meal='B')
+        feedings = [
+            {'cat': cat.id, 'date': str(self.today), 'meal': meal}
+            for cat in self.cats for meal in ('B', 'L', 'D')
+        ]
+        feedings.append(feedings[-1]) # sent twice by mistake
+        # session, user, ownership, existing feedings, savepoint, insert,
+        # touch cats, cat owners (for the caches), then the daily rollup:
+        # feedings and rollup rows for those days, update, insert. and the
+        # savepoint release
+        with self.assertNumQueries(13):
+            response = self.post(feedings)
+        self.assertEqual(response.json(), {'created': 8, 'duplicates': 2})
+        self.assertEqual(Feeding.objects.count(), 9)
+        self.assertTrue(all(
+            cat.fed_for_today() for cat in Cat.objects.with_feeding_status(self.today)
+        ))
+        self.assertEqual(
+            set(FeedingDay.objects.values_list('cat_id', 'meals')),
+            {(cat.id, ALL_MEALS) for cat in self.cats},
+        )
+
+    def test_nothing_is_saved_if_anything_is_wrong(self):
+        stranger = User.objects.create_user('someone', password='meowmeow123')
+        not_mine = Cat.objects.create(name='Stranger', breed='', description='', age=1, user=stranger)
+        response = self.post([
+            {'cat': self.cats[0].id, 'date': str(self.today), 'meal': 'B'},
+            {'cat': self.cats[0].id, 'date': 'yesterday', 'meal': 'B'},
+            {'cat': not_mine.id, 'date': str(self.today), 'meal': 'L'},
+            {'cat': self.cats[1].id, 'date': str(self.today), 'meal': 'X'},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['index'] for error in response.json()['errors']], [1, 2, 3])
+        self.assertFalse(Feeding.objects.exists())
+
+    def test_add_feeding_ignores_a_repeat(self):
+        url = reverse('add_feeding', kwargs={'cat_id': self.cats[0].id})
+        for _ in range(2):
+            self.client.post(url, {'date': str(self.today), 'meal': 'D'})
+        self.assertEqual(Feeding.objects.count(), 1)
+
+
+@plain_static
+class FeedingDayTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        self.cat = Cat.objects.create(name='Lolo', breed='', description='', age=1, user=self.user)
+        self.today = timezone.localdate()
+
+    def meals(self, day):
+        return FeedingDay.objects.filter(cat=self.cat, date=day).values_list('meals', flat=True).first()
+
+    def test_follows_feedings_as_they_change(self):
+        yesterday = self.today - timedelta(days=1)
+        breakfast = Feeding.objects.create(cat=self.cat, date=self.today, meal='B')
+        dinner = Feeding.objects.create(cat=self.cat, date=self.today, meal='D')
+        self.assertEqual(self.meals(self.today), 0b101)
+        breakfast.delete()
+        self.assertEqual(self.meals(self.today), 0b100)
+        dinner.date = yesterday # moving a feeding fixes up both days
+        dinner.save()
+        self.assertEqual((self.meals(self.today), self.meals(yesterday)), (0, 0b100))
+
+    def test_missed_meals(self):
+        for days_ago, meal in ((0, 'B'), (0, 'L'), (1, 'D'), (30, 'B')):
+            Feeding.objects.create(cat=self.cat, date=self.today - timedelta(days=days_ago), meal=meal)
+        cat = Cat.objects.with_missed_meals(7, self.today).get(id=self.cat.id)
+        self.assertEqual(cat.missed_meals, 7 * 3 - 3)
+        response = self.client.get(reverse('details', kwargs={'cat_id': self.cat.id}))
+        self.assertEqual(response.context['missed_meals'], 14 * 3 - 3)
+        self.assertEqual(response.context['history'][0], (self.today, ['Breakfast', 'Lunch'], 1))
+
+    def test_calendar(self):
+        Feeding.objects.create(cat=self.cat, date=self.today, meal='L')
+        response = self.client.get(
+            reverse('feeding_calendar', kwargs={'cat_id': self.cat.id}), {'weeks': 4}
+        )
+        grid = response.context['grid']
+        self.assertEqual((len(grid), {len(week) for week in grid}), (4, {7}))
+        self.assertEqual(grid[-1][self.today.weekday()].meal_codes(), ['L'])
+        self.assertEqual(response.context['meals_fed'], 1)
+        self.assertContains(response, 'meals-1')
+        stranger = User.objects.create_user('someone', password='meowmeow123')
+        self.client.force_login(stranger)
+        response = self.client.get(reverse('feeding_calendar', kwargs={'cat_id': self.cat.id}))
+        self.assertEqual(response.status_code, 404)
+
+
+class CounterTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        self.cat = Cat.objects.create(name='Lolo', breed='', description='', age=1, user=self.user)
+        self.today = timezone.localdate()
+
+    def counters(self):
+        return Cat.objects.values_list(
+            'feeding_count', 'last_fed_at', 'photo_count', 'toy_count'
+        ).get(id=self.cat.id)
+
+    def test_follow_feedings_photos_and_toys(self):
+        earlier = self.today - timedelta(days=3)
+        self.client.post(reverse('add_feeding', kwargs={'cat_id': self.cat.id}),
+                         {'date': earlier, 'meal': 'B'})
+        latest = Feeding.objects.create(cat=self.cat, date=self.today, meal='D')
+        photo = Photo.objects.create(cat=self.cat, url='https://example.com/1.png')
+        toys = [Toy.objects.create(name=f'toy {i}', color='red') for i in range(3)]
+        self.cat.toys.add(*toys)
+        self.cat.toys.add(toys[0]) # already has it, so no change
+        toys[1].cat_set.remove(self.cat)
+        self.assertEqual(self.counters(), (2, self.today, 1, 2))
+
+        latest.delete() # back to the feeding before it
+        photo.delete()
+        self.client.get(reverse('assoc_toy_delete', kwargs={'cat_id': self.cat.id, 'toy_id': toys[0].id}))
+        self.assertEqual(self.counters(), (1, earlier, 0, 1))
+        self.cat.toys.clear()
+        self.assertEqual(self.counters()[3], 0)
+
+    def test_deleting_a_toy_takes_it_off_its_cats(self):
+        toys = [Toy.objects.create(name=f'toy {i}', color='red') for i in range(2)]
+        self.cat.toys.add(*toys)
+        other = Cat.objects.create(name='Raven', breed='', description='', age=1, user=self.user)
+        other.toys.add(toys[0])
+        updated_at = Cat.objects.get(id=self.cat.id).updated_at
+        toys[0].delete() # the cascade skips m2m_changed
+        self.assertEqual(self.counters()[3], 1)
+        self.assertEqual(Cat.objects.get(id=other.id).toy_count, 0)
+        self.assertGreater(Cat.objects.get(id=self.cat.id).updated_at, updated_at)
+
+    def test_deleting_a_cat_skips_its_rows_counters(self):
+        other = Cat.objects.create(name='Raven', breed='', description='', age=1, user=self.user)
+        for days in range(10):
+            Feeding.objects.create(cat=self.cat, date=self.today - timedelta(days=days), meal='B')
+        Photo.objects.create(cat=self.cat, url='https://example.com/1.png')
+        feeding = Feeding.objects.create(cat=other, date=self.today, meal='B')
+        cat_id = self.cat.id
+        with CaptureQueriesContext(connection) as captured:
+            self.cat.delete()
+        self.assertFalse(any(
+            query['sql'].startswith(('UPDATE "main_app_cat"', 'UPDATE "main_app_feedingday"'))
+            for query in captured
+        ))
+        self.assertLess(len(captured), 15) # however many feedings it had
+        self.assertFalse(FeedingDay.objects.filter(cat_id=cat_id).exists())
+        # and once it's gone, other cats' rows count again
+        feeding.delete()
+        self.assertEqual(Cat.objects.get(id=other.id).feeding_count, 0)
+
+    def test_saving_a_stale_cat_keeps_the_counts(self):
+        stale = Cat.objects.get(id=self.cat.id)
+        Feeding.objects.create(cat=self.cat, date=self.today, meal='B')
+        stale.name = 'Lola'
+        stale.save()
+        self.assertEqual(self.counters(), (1, self.today, 0, 0))
+        self.assertEqual(Cat.objects.get(id=self.cat.id).name, 'Lola')
+
+    def test_recount_command_fixes_drift(self):
+        Feeding.objects.create(cat=self.cat, date=self.today, meal='B')
+        Cat.objects.filter(id=self.cat.id).update(feeding_count=7, toy_count=2)
+        out = StringIO()
+        call_command('recount_cats', dry_run=True, stdout=out)
+        self.assertIn('feeding_count 7 -> 1', out.getvalue())
+        self.assertEqual(self.counters()[0], 7)
+        call_command('recount_cats', stdout=out)
+        self.assertEqual(self.counters(), (1, self.today, 0, 0))
+        out = StringIO()
+        call_command('recount_cats', stdout=out)
+        self.assertIn('1 cats checked, fixed 0', out.getvalue())
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        self.cat = Cat.objects.create(name='Lolo', breed='tabby', description='', age=3, user=self.user)
+        self.toy = Toy.objects.create(name='mouse', color='grey')
+        self.cat.toys.add(self.toy)
+        for day in range(1, 6):
+            Feeding.objects.create(cat=self.cat, date=date(2022, 7, day), meal='B')
+        stranger = User.objects.create_user('someone', password='meowmeow123')
+        Cat.objects.create(name='Stranger', breed='', description='', age=1, user=stranger)
+
+    def download(self, path, **params):
+        response = self.client.get('/export/' + path, params)
+        return b''.join(response.streaming_content)
+
+    def test_csv_of_your_own_cats(self):
+        lines = self.download('cats.csv').decode().splitlines()
+        self.assertEqual(lines[0], 'id,name,breed,description,age,username,updated_at')
+        self.assertEqual(len(lines), 2)
+        self.assertIn('Lolo,tabby', lines[1])
+
+    def test_gzipped_jsonl_feedings_in_a_date_range(self):
+        body = self.download('feedings.jsonl', since='2022-07-02', until='2022-07-04', gzip='1')
+        rows = [json.loads(line) for line in gzip.decompress(body).splitlines()]
+        self.assertEqual([row['date'] for row in rows], ['2022-07-02', '2022-07-03', '2022-07-04'])
+
+    @override_settings(EXPORT_CHUNK_SIZE=2, EXPORT_BUFFER_SIZE=10)
+    def test_streams_in_pieces(self):
+        response = self.client.get('/export/feedings.csv')
+        chunks = list(response.streaming_content)
+        self.assertGreater(len(chunks), 5)
+        self.assertEqual(len(b''.join(chunks).splitlines()), 6)
+
+    def test_command_writes_toy_pairs_to_a_file(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'toys.csv')
+            call_command('export_cats', 'toys', user='tester', output=path)
+            with open(path) as exported:
+                self.assertEqual(
+                    exported.read().splitlines(),
+                    ['cat_id,toy_id,toy_name,toy_color', f'{self.cat.id},{self.toy.id},mouse,grey'],
+                )
+
+    def test_command_rejects_bad_dates(self):
+        for since in ('last week', '2022-13-45'):
+            with self.assertRaisesMessage(CommandError, '--since should look like 2022-07-08.'):
+                call_command('export_cats', 'feedings', since=since, stdout=StringIO())
+
+
+class ImportCatsCommandTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('shelter', password='meowmeow123')
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.folder = tmp.name
+        self.state = os.path.join(tmp.name, 'state.json')
+
+    def write(self, name, text):
+        path = os.path.join(self.folder, name)
+        with open(path, 'w') as file:
+            file.write(text)
+        return path
+
+    def run_import(self, kind, path, **options):
+        call_command(
+            'import_cats', kind, path, user='shelter', state=self.state,
+            stdout=StringIO(), **options
+        )
+
+    def test_cats_feedings_and_toys_round_trip(self):
+        cats = self.write('cats.csv', 'id,name,breed,description,age\n'
+                          '10,Lolo,tabby,foul little demon,3\n'
+                          '11,Sachi,tortie,,not a number\n'
+                          '12,Raven,black,tripod,4\n')
+        feedings = self.write('feedings.jsonl', '\n'.join(json.dumps(row) for row in [
+            {'cat_id': 10, 'date': '2022-07-08', 'meal': 'B'},
+            {'cat_id': 10, 'date': '2022-07-08', 'meal': 'Q'},
+            {'cat_id': 11, 'date': '2022-07-08', 'meal': 'B'},
+            {'cat_id': 12, 'date': '2022-07-09', 'meal': 'D'},
+        ]))
+        toys = self.write('toys.csv', 'cat_id,toy_name,toy_color\n10,mouse,grey\n12,mouse,grey\n12,ball,red\n')
+        existing = Toy.objects.create(name='mouse', color='grey')
+
+        self.run_import('cats', cats)
+        self.run_import('feedings', feedings)
+        self.run_import('toys', toys)
+
+        lolo, raven = Cat.objects.filter(user=self.user).order_by('name')
+        self.assertEqual((lolo.name, raven.name), ('Lolo', 'Raven'))
+        self.assertEqual(Feeding.objects.filter(cat=lolo).count(), 1)
+        self.assertEqual(Feeding.objects.filter(cat=raven).count(), 1)
+        self.assertEqual(
+            list(FeedingDay.objects.filter(cat=raven).values_list('date', 'meals')),
+            [(date(2022, 7, 9), 0b100)],
+        )
+        self.assertEqual(list(lolo.toys.all()), [existing]) # matched, not duplicated
+        self.assertEqual(Toy.objects.count(), 2)
+        with open(cats + '.rejects.jsonl') as rejects:
+            self.assertEqual([json.loads(line)['row'] for line in rejects], [2])
+        with open(feedings + '.rejects.jsonl') as rejects:
+            self.assertEqual([json.loads(line)['row'] for line in rejects], [2, 3])
+
+    def test_resumes_from_the_last_finished_chunk(self):
+        cats = self.write('cats.csv', 'id,name,breed,description,age\n' + ''.join(
+            f'{i},cat {i},tabby,a cat,1\n' for i in range(10)
+        ))
+        real_bulk_create = Cat.objects.bulk_create
+        calls = []
+
+        def flaky_bulk_create(objs, *args, **kwargs):
+            calls.append(len(objs))
+            if len(calls) == 3:
+                raise ConnectionError('database went away')
+            return real_bulk_create(objs, *args, **kwargs)
+
+        with mock.patch.object(Cat.objects, 'bulk_create', flaky_bulk_create):
+            with self.assertRaises(ConnectionError):
+                self.run_import('cats', cats, chunk_size=3)
+        self.assertEqual(Cat.objects.count(), 6)
+        self.run_import('cats', cats, chunk_size=3)
+        self.assertEqual(
+            sorted(Cat.objects.values_list('name', flat=True)),
+            sorted(f'cat {i}' for i in range(10)),
+        )
+
+
+class ApiTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        self.cats = [
+            Cat.objects.create(name=f'cat {i}', breed='tabby', description='a cat', age=i, user=self.user)
+            for i in range(5)
+        ]
+        self.toy = Toy.objects.create(name='mouse', color='grey')
+        for cat in self.cats:
+            cat.toys.add(self.toy)
+            for meal in ('B', 'L'):
+                Feeding.objects.create(cat=cat, date=date(2022, 7, 8), meal=meal)
+        stranger = User.objects.create_user('someone', password='meowmeow123')
+        self.strangers_cat = Cat.objects.create(name='Stranger', breed='', description='x', age=1, user=stranger)
+        self.strangers_cat.toys.add(self.toy)
+
+    def test_sparse_fields_includes_and_paging_in_bounded_queries(self):
+        url = reverse('api_list', kwargs={'resource': 'cats'})
+        params = {'fields': 'name', 'include': 'feedings,toys', 'fields[feedings]': 'meal',
+                  'page_size': 2}
+        seen = []
+        while True:
+            # session + user + the page + one per include
+            with self.assertNumQueries(5):
+                body = self.client.get(url, params).json()
+            seen += body['data']
+            if not body['next']:
+                break
+            params['after'] = body['next']
+        self.assertEqual([cat['name'] for cat in seen], [f'cat {i}' for i in range(5)])
+        self.assertEqual(set(seen[0]), {'id', 'name', 'feedings', 'toys'})
+        self.assertEqual(set(seen[0]['feedings'][0]), {'id', 'meal'})
+        self.assertEqual(sorted(feeding['meal'] for feeding in seen[0]['feedings']), ['B', 'L'])
+        self.assertEqual(seen[0]['toys'], [{'id': self.toy.id, 'name': 'mouse', 'color': 'grey'}])
+
+    def test_embedded_fields_use_the_names_they_come_back_under(self):
+        cat = self.client.get(
+            reverse('api_detail', kwargs={'resource': 'cats', 'pk': self.cats[0].id}),
+            {'include': 'toys', 'fields[toys]': 'name'},
+        ).json()['data']
+        self.assertEqual(cat['toys'], [{'id': self.toy.id, 'name': 'mouse'}])
+        toy = self.client.get(
+            reverse('api_detail', kwargs={'resource': 'toys', 'pk': self.toy.id}),
+            {'include': 'cats', 'fields[cats]': 'name'},
+        ).json()['data']
+        self.assertEqual(sorted(cat['name'] for cat in toy['cats']), [f'cat {i}' for i in range(5)])
+        response = self.client.get(
+            reverse('api_list', kwargs={'resource': 'cats'}),
+            {'include': 'toys', 'fields[toys]': 'toy__name'},
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_only_your_own_cats(self):
+        response = self.client.get(
+            reverse('api_detail', kwargs={'resource': 'cats', 'pk': self.strangers_cat.id})
+        )
+        self.assertEqual(response.status_code, 404)
+        toy = self.client.get(
+            reverse('api_detail', kwargs={'resource': 'toys', 'pk': self.toy.id}), {'include': 'cats'}
+        ).json()['data']
+        self.assertEqual(len(toy['cats']), 5)
+        feedings = self.client.get(
+            reverse('api_list', kwargs={'resource': 'feedings'}), {'cat': self.strangers_cat.id}
+        ).json()['data']
+        self.assertEqual(feedings, [])
+
+    def test_errors(self):
+        url = reverse('api_list', kwargs={'resource': 'cats'})
+        self.assertEqual(self.client.get(url, {'fields': 'password'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'include': 'owner'}).status_code, 400)
+        self.client.logout()
+        self.assertEqual(self.client.get(url).status_code, 401)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        self.lolo = Cat.objects.create(
+            name='Lolo', breed='tabby', description='foul little demon', age=3, user=self.user,
+        )
+        self.other = Cat.objects.create(
+            name='Mittens', breed='siamese', description='sits next to lolo all day', age=2,
+            user=self.user,
+        )
+        stranger = User.objects.create_user('stranger', password='meowmeow123')
+        Cat.objects.create(name='Lola', breed='tabby', description='', age=1, user=stranger)
+        Toy.objects.create(name='lobster', color='red')
+        Toy.objects.create(name='ball', color='blue')
+
+    def names(self, **params):
+        body = self.client.get(reverse('search'), params).json()
+        return {kind: [row['name'] for row in rows] for kind, rows in body.items()}
+
+    def test_prefix_matches_ranked_by_field(self):
+        # a name match beats a mention in another cat's description
+        self.assertEqual(self.names(q='lo', type='cats'), {'cats': ['Lolo', 'Mittens']})
+        self.assertEqual(self.names(q='tab'), {'cats': ['Lolo'], 'toys': []})
+        self.assertEqual(self.names(q='lo'), {'cats': ['Lolo', 'Mittens'], 'toys': ['lobster']})
+        self.assertEqual(self.names(q='blu', type='toys'), {'toys': ['ball']})
+        self.assertEqual(self.names(q='"*)('), {'cats': [], 'toys': []})
+
+    def test_too_many_matches_to_rank(self):
+        # name matches still come first, then the newest
+        with mock.patch.object(search, 'RANKED_MATCHES', 1):
+            self.assertEqual(self.names(q='lo', type='cats'), {'cats': ['Lolo', 'Mittens']})
+            self.assertEqual(self.names(q='l', type='cats', limit=1), {'cats': ['Lolo']})
+
+    def test_index_follows_writes(self):
+        # triggers keep the index current, including for bulk writes that
+        # never go through save()
+        Cat.objects.filter(id=self.lolo.id).update(name='Pudding')
+        Cat.objects.bulk_create([Cat(name='Loaf', breed='', description='bread', age=1,
+                                     user=self.user)])
+        self.other.delete()
+        self.assertEqual(self.names(q='lo', type='cats'), {'cats': ['Loaf']})
+        self.assertEqual(self.names(q='pud', type='cats'), {'cats': ['Pudding']})
+
+    def test_bench_command(self):
+        out = StringIO()
+        call_command('bench_search', cats=300, queries=20, budget_ms=1000, stdout=out)
+        self.assertIn('20 searches over 300 cats', out.getvalue())
+        self.assertEqual(Cat.objects.count(), 3) # the seeded cats were rolled back
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    # the pool doesn't care what it pools, so plain sqlite3 connections stand
+    # in for Postgres ones here
+    def make_pool(self, **kwargs):
+        self.opened = []
+
+        def connect():
+            self.opened.append(sqlite3.connect(':memory:', check_same_thread=False))
+            return self.opened[-1]
+        return Pool(connect, 2, timeout=0.05, **kwargs)
+
+    def test_reuses_connections_up_to_its_size(self):
+        pool = self.make_pool()
+        first, second = pool.get(), pool.get()
+        with self.assertRaises(PoolTimeout):
+            pool.get()
+        pool.put(first)
+        self.assertIs(pool.get(), first)
+        pool.put(first)
+        pool.put(second)
+        self.assertEqual((len(self.opened), pool.idle), (2, 2))
+
+    def test_drops_broken_and_old_connections(self):
+        def reset(conn):
+            conn.execute('SELECT 1') # raises once it's closed
+        pool = self.make_pool(reset=reset, check=lambda conn: conn is not self.opened[0])
+        conn = pool.get()
+        conn.close()
+        pool.put(conn) # broken, so thrown away
+        self.assertEqual(pool.idle, 0)
+        conn = pool.get()
+        pool.put(conn)
+        self.assertIs(pool.get(), self.opened[1])
+        pool.put(self.opened[1])
+        pool.max_age = 0
+        self.assertIs(pool.get(), self.opened[2]) # the idle one was too old
+        self.assertEqual(len(self.opened), 3)
+
+    def test_bench_needs_postgres(self):
+        with self.assertRaises(CommandError):
+            call_command('bench_connections', requests=1)
+
+
+@plain_static
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        self.cat = Cat.objects.create(name='Lolo', breed='', description='', age=1, user=self.user)
+        metrics.reset()
+
+    def test_per_view_totals_in_prometheus_format(self):
+        details = reverse('details', kwargs={'cat_id': self.cat.id})
+        with self.assertLogs('main_app.metrics', 'INFO') as logs:
+            self.client.get(details)
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line['view'], line['status']), ('details', 200))
+        self.assertEqual(line['queries'], 7) # see CatDetailsQueryTests
+        self.assertGreater(line['template_ms'], 0)
+
+        self.assertEqual(self.client.get('/metrics').status_code, 403) # not staff
+        with override_settings(METRICS_TOKEN='s3cret'):
+            body = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret').content.decode()
+        self.assertIn('catcollector_view_requests_total{view="details"} 1', body)
+        self.assertIn('catcollector_view_queries_total{view="details"} 7', body)
+        self.assertIn('catcollector_view_slowest_query_seconds{view="details",sql="SELECT', body)
+        self.assertIn('catcollector_page_cache_total{kind="details",result="misses"} ', body)
+
+    def test_query_budgets(self):
+        with override_settings(QUERY_BUDGETS={'about': 0}), \
+                self.assertLogs('main_app.metrics', 'WARNING') as logs:
+            with self.assertRaises(metrics.QueryBudgetExceeded):
+                self.client.get(reverse('about')) # the session lookup alone is one
+            with override_settings(QUERY_BUDGETS_STRICT=False):
+                response = self.client.get(reverse('about'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(logs.records[-1].getMessage())['event'], 'query_budget_exceeded')
+        self.assertEqual(metrics.snapshot()['about']['over_budget'], 2)
+
+
+@plain_static
+class BenchmarkCommandTests(TestCase):
+    def test_seed_data(self):
+        out = StringIO()
+        call_command('seed_data', users=2, cats=3, feedings=10, photos=1, toys=5,
+                     toys_per_cat=2, prefix='kitty', stdout=out)
+        self.assertIn('Created 2 users', out.getvalue())
+        cats = Cat.objects.filter(user__username__startswith='kitty')
+        self.assertEqual(cats.count(), 6)
+        self.assertEqual(Feeding.objects.filter(cat__in=cats).count(), 60)
+        self.assertEqual(Photo.objects.filter(cat__in=cats).count(), 6)
+        self.assertEqual(Cat.toys.through.objects.filter(cat__in=cats).count(), 12)
+        # the rollup matches the feedings, as if they had been added one by one
+        fed = sum(day.meals_fed() for day in FeedingDay.objects.filter(cat__in=cats))
+        self.assertEqual(fed, 60)
+        self.assertTrue(self.client.login(username='kitty0', password='meowmeow123'))
+        with self.assertRaises(CommandError):
+            call_command('seed_data', prefix='kitty', stdout=StringIO())
+
+    def test_client_benchmark_saves_and_compares(self):
+        path = os.path.join(tempfile.mkdtemp(), 'baseline.json')
+        options = dict(requests=5, warmup=1, users=1, cats=2, feedings=10, toys=5)
+        call_command('benchmark', save=path, stdout=StringIO(), **options)
+        feedings = Feeding.objects.count()
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)
+        details = baseline['results']['client']['details']
+        self.assertEqual(details['requests'], 5)
+        self.assertEqual(details['queries'], 9) # see CatDetailsQueryTests
+        self.assertEqual(details['errors'], 0)
+        self.assertLessEqual(details['p50_ms'], details['p99_ms'])
+
+        out = StringIO()
+        call_command('benchmark', compare=path, max_regression=1000, stdout=out, **options)
+        self.assertIn('client    details', out.getvalue())
+        self.assertEqual(Feeding.objects.count(), feedings) # its feedings were rolled back
+
+        baseline['results']['client']['details']['queries'] = 5
+        with open(path, 'w') as baseline_file:
+            json.dump(baseline, baseline_file)
+        with self.assertRaises(CommandError):
+            call_command('benchmark', compare=path, max_regression=1000, stdout=StringIO(), **options)
+
+
+    def test_render_benchmark(self):
+        out = StringIO()
+        call_command('bench_render', cards=5, runs=1, stdout=out)
+        for page in ('index', 'toys', 'details'):
+            self.assertIn(f'{page:<10}cards warm', out.getvalue())
+        self.assertFalse(Cat.objects.exists()) # its cats were rolled back
+
+class StartupTests(TestCase):
+    def test_cold_start(self):
+        # generous budgets - this is here to catch a heavy import creeping into
+        # every worker (bench_startup also fails if boto3, Pillow... get imported
+        # at startup), not to time the machine the tests run on
+        out = StringIO()
+        call_command('bench_startup', runs=1, budget_ms=5000, budget_mb=250, stdout=out)
+        self.assertIn('startup over 1 runs', out.getvalue())
+        self.assertIn('django', out.getvalue())
+
+
+class GunicornConfigTests(SimpleTestCase):
+    def load(self, **env):
+        with mock.patch.dict(os.environ, env):
+            sys.modules.pop('catcollector.gunicorn_conf', None)
+            config = importlib.import_module('catcollector.gunicorn_conf')
+            return config, dict(os.environ)
+
+    def test_production_defaults(self):
+        config, env = self.load()
+        self.assertEqual(env['DJANGO_ENV'], 'production')
+        self.assertEqual((config.worker_class, config.preload_app), ('gthread', True))
+        self.assertEqual((config.max_requests, config.max_requests_jitter), (1000, 100))
+        # settings.py needs the worker count to know a locmem page cache isn't enough
+        self.assertEqual(env['WEB_CONCURRENCY'], str(config.workers))
+
+    def test_gevent_skips_persistent_connections(self):
+        config, env = self.load(GUNICORN_WORKER_CLASS='gevent', GUNICORN_MAX_REQUESTS='0')
+        self.assertEqual((config.worker_class, config.max_requests), ('gevent', 0))
+        self.assertEqual(env['DB_CONN_MAX_AGE'], '0')
+        self.assertNotIn('DB_CONN_MAX_AGE', os.environ)
+
+
+@plain_static
+@override_settings(ROOT_URLCONF='catcollector.asgi_urls')
+class AsyncViewTests(TestCase):
+    # the async views catcollector/asgi.py serves, through the async test client
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        self.async_client.force_login(self.user)
+        self.cat = Cat.objects.create(name='Lolo', breed='', description='', age=1, user=self.user)
+        self.toy = Toy.objects.create(name='mouse', color='grey')
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.media = os.path.join(tmp.name, 'media')
+        settings = override_settings(
+            PHOTO_STORAGE='main_app.storage.LocalStorage', MEDIA_ROOT=self.media,
+            PHOTO_SPOOL_DIR=os.path.join(tmp.name, 'spool'), PHOTO_UPLOAD_WORKERS=0,
+            PHOTO_UPLOAD_ATTEMPTS=1,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    async def test_index_and_details(self):
+        details = reverse('details', kwargs={'cat_id': self.cat.id})
+        await self.async_client.get(details) # picks up a CSRF cookie
+        response = await self.async_client.get(details)
+        self.assertIs(response.resolver_match.func, async_views.cats_details)
+        self.assertContains(response, 'Lolo')
+        self.assertContains(response, 'mouse') # in the toys it doesn't have yet
+        # (the 4.0 async client takes header names as is, not as HTTP_*)
+        response = await self.async_client.get(details, **{'if-none-match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        response = await self.async_client.get(reverse('index'))
+        self.assertIs(response.resolver_match.func, async_views.cats_index)
+        self.assertContains(response, 'Lolo')
+
+        self.async_client.cookies.clear() # logged out
+        response = await self.async_client.get(details)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.url.startswith('/accounts/login/'))
+
+    async def test_toys(self):
+        metrics.reset()
+        url = reverse('assoc_toy', kwargs={'cat_id': self.cat.id, 'toy_id': self.toy.id})
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 302)
+        # the metrics middleware sees the queries the view ran off the event loop
+        self.assertGreater(metrics.snapshot()['assoc_toy']['queries'], 2)
+        toys = sync_to_async(lambda: list(self.cat.toys.values_list('name', flat=True)))
+        self.assertEqual(await toys(), ['mouse'])
+        await self.async_client.get(url + 'delete/')
+        self.assertEqual(await toys(), [])
+
+    # Django 4.0's async test client can't post files, so these go through the
+    # sync one - Django runs the async view for it
+
+    def test_add_photo_uploads_in_the_request(self):
+        url = reverse('add_photo', kwargs={'cat_id': self.cat.id})
+        with self.assertLogs('main_app.derivatives', 'WARNING'): # not a real png
+            response = self.client.post(
+                url, {'photo-file': SimpleUploadedFile('lolo.png', b'not really a png')},
+            )
+        self.assertEqual(response.status_code, 302)
+        photo = Photo.objects.get(cat=self.cat)
+        self.assertEqual(photo.status, Photo.READY)
+        with open(os.path.join(self.media, photo.key), 'rb') as saved:
+            self.assertEqual(saved.read(), b'not really a png')
+
+    @override_settings(PHOTO_STORAGE='main_app.tests.BrokenStorage')
+    def test_add_photo_falls_back_to_the_spool(self):
+        url = reverse('add_photo', kwargs={'cat_id': self.cat.id})
+        with self.assertLogs('main_app', 'WARNING') as logs, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                url, {'photo-file': SimpleUploadedFile('lolo.png', b'not really a png')},
+            )
+        self.assertIn('spooling it for a retry', logs.output[0])
+        self.assertIn('upload attempt 1/1 failed', logs.output[1])
+        self.assertEqual(Photo.objects.get(cat=self.cat).status, Photo.FAILED)
+
+
+@plain_static
+@override_settings(DATABASE_REPLICAS=['replica'], PAGE_CACHE_TIMEOUT=0)
+class ReplicaTests(TransactionTestCase):
+    # 'replica' is a second test database (settings.py). nothing replicates
+    # into it, so rows only get there when replicate() copies them - anything
+    # written after that is the lag a real replica would have
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='meowmeow123')
+        self.client.force_login(self.user)
+        self.cat = Cat.objects.create(name='Lolo', breed='', description='', age=1, user=self.user)
+        self.replicate()
+
+    def replicate(self):
+        for model in (User, Session, Toy, Cat, Cat.toys.through, Feeding, FeedingDay, Photo):
+            model.objects.using('replica').all().delete()
+            model.objects.using('replica').bulk_create(model.objects.using('default').all())
+
+    def names(self):
+        return [cat.name for cat in self.client.get(reverse('index')).context['cats']]
+
+    def test_reads_stay_on_the_primary_after_a_write(self):
+        Cat.objects.create(name='Raven', breed='', description='', age=1, user=self.user)
+        self.assertEqual(self.names(), ['Lolo']) # the replica hasn't got Raven yet
+        # pages that aren't in REPLICA_VIEWS always read the primary
+        calendar = reverse('feeding_calendar', kwargs={'cat_id': self.cat.id})
+        self.assertEqual(self.client.get(calendar).status_code, 200)
+
+        response = self.client.post(reverse('add_feeding', kwargs={'cat_id': self.cat.id}),
+                                    {'date': timezone.localdate(), 'meal': 'B'})
+        self.assertIn(replicas.PIN_COOKIE, response.cookies)
+        details = self.client.get(reverse('details', kwargs={'cat_id': self.cat.id}))
+        self.assertEqual(details.context['cat'].feeding_count, 1)
+        self.assertEqual(self.names(), ['Lolo', 'Raven'])
+
+        del self.client.cookies[replicas.PIN_COOKIE] # as if the pin ran out
+        self.assertEqual(self.names(), ['Lolo'])
+        self.replicate()
+        self.assertEqual(self.names(), ['Lolo', 'Raven'])
+
+    def test_only_requests_use_the_replica(self):
+        router = replicas.PrimaryReplicaRouter()
+        self.assertIsNone(router.db_for_read(Cat)) # management commands, threads...
+        self.assertEqual(Cat.objects.filter(name='Lolo').db, 'default')
+        cat = Cat.objects.using('replica').get(name='Lolo')
+        self.assertEqual(router.db_for_write(Cat, instance=cat), 'default')
@@ -0,0 +1,144 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from . import derivatives
+from .models import Photo
+from .storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# photo uploads happen here, in a small pool of background threads, so the
+# request that receives the photo can redirect right away instead of holding a
+# gunicorn worker hostage while S3 takes its time.
+#
+# the flow: add_photo saves a pending Photo row and copies the upload into
+# PHOTO_SPOOL_DIR (fast, it's local disk). once that row is committed, a worker
+# pushes the spooled file to storage, retrying with exponential backoff, and
+# flips the photo to ready or failed. the spool file only goes away after a
+# successful upload, so `manage.py retry_photo_uploads` can pick up anything a
+# crash or an outage left behind. uploaded photos then get their thumbnails
+# made (derivatives.py) on the same worker.
+
+_executor = None
+_slots = None
+_lock = threading.Lock()
+
+
+def _get_executor():
+    # built on first use rather than at import time, so each gunicorn worker
+    # (which forks from the master) gets its own threads
+    global _executor, _slots
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _slots = threading.BoundedSemaphore(settings.PHOTO_UPLOAD_QUEUE_SIZE)
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.PHOTO_UPLOAD_WORKERS,
+                    thread_name_prefix='photo-upload',
+                )
+    return _executor
+
+
+def spool_path(key):
+    return os.path.join(settings.PHOTO_SPOOL_DIR, key)
+
+
+def enqueue(photo, fileobj):
+    # copy the upload somewhere that outlives this request (Django deletes its
+    # own temp file as soon as the response goes out), then hand it to a worker
+    # once the pending Photo row is safely committed
+    path = spool_path(photo.key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as spooled:
+        for chunk in fileobj.chunks():
+            spooled.write(chunk)
+    transaction.on_commit(lambda: background(upload, photo.id, photo.key))
+
+
+def background(func, *args):
+    # runs func(*args) on the photo worker pool. the pool isn't just for
+    # uploads - derivatives.py uses it too, for anything too slow for a request
+    if not settings.PHOTO_UPLOAD_WORKERS:
+        # PHOTO_UPLOAD_WORKERS = 0 means "just do it now", which is what the
+        # tests (and anyone debugging) want
+        func(*args)
+        return
+    executor = _get_executor()
+    # only so many jobs can be waiting at once. when they're all taken this
+    # blocks, which pushes back on new uploads instead of piling files up in
+    # memory forever
+    _slots.acquire()
+    future = executor.submit(_run_in_worker, func, *args)
+    future.add_done_callback(lambda _: _slots.release())
+
+
+def _run_in_worker(func, *args):
+    try:
+        func(*args)
+    except Exception:
+        logger.exception('photo worker crashed running %s%r', func.__name__, args)
+    finally:
+        # database connections belong to the thread that opened them, so tidy
+        # ours up before the thread goes back to the pool
+        connections.close_all()
+
+
+def upload(photo_id, key):
+    path = spool_path(key)
+    attempts = settings.PHOTO_UPLOAD_ATTEMPTS
+    delay = settings.PHOTO_UPLOAD_BACKOFF
+    for attempt in range(1, attempts + 1):
+        try:
+            with open(path, 'rb') as spooled:
+                get_storage().save(spooled, key)
+        except FileNotFoundError:
+            logger.error('spooled file for photo %s is gone, marking it failed', photo_id)
+            break
+        except Exception:
+            logger.warning(
+                'upload attempt %s/%s failed for photo %s', attempt, attempts, photo_id,
+                exc_info=True,
+            )
+            if attempt < attempts:
+                time.sleep(delay)
+                delay *= 2 # wait twice as long before each new attempt
+        else:
+            # save() rather than update() so the post_save signal tells the page
+            # cache that this cat's photos changed
+            _set_status(photo_id, Photo.READY)
+            # we're already in the background, and the original is right here
+            # on local disk, so this is the cheapest moment to make thumbnails
+            try:
+                with open(path, 'rb') as spooled:
+                    derivatives.generate(photo_id, spooled)
+            except Exception:
+                # the photo itself is uploaded and ready either way. generate()
+                # only makes what's missing, so the thumbnails can be made later
+                logger.exception('could not make thumbnails for photo %s', photo_id)
+            os.remove(path)
+            logger.info('uploaded photo %s as %s', photo_id, key)
+            return True
+    _set_status(photo_id, Photo.FAILED)
+    logger.error('giving up on photo %s after %s attempts', photo_id, attempts)
+    return False
+
+
+def uploaded(photo_id):
+    # for a photo that was already uploaded during the request (the async
+    # add_photo does that): mark it ready and make its thumbnails in the
+    # background, fetching the original back from storage
+    _set_status(photo_id, Photo.READY)
+    background(derivatives.generate, photo_id)
+
+
+def _set_status(photo_id, status):
+    photo = Photo.objects.only('cat_id').get(id=photo_id)
+    photo.status = status
+    photo.save(update_fields=['status'])
+
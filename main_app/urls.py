@@ -1,7 +1,7 @@
 # after creating this file, add a few lines to catcollector/urls.py
 # in order to import the views it requires a few dependences we need:
 from django.urls import path
-from . import views
+from . import api, async_views, metrics, views
 
 # we will define all app-level urls
 urlpatterns = [
@@ -26,6 +26,8 @@ urlpatterns = [
     # the detail entry. in short, its just how django works. remember to add the
     # views and the html
     path('cats/<int:cat_id>/add_feeding/', views.add_feeding, name='add_feeding'),
+    path('cats/<int:cat_id>/calendar/', views.feeding_calendar, name='feeding_calendar'),
+    path('feedings/bulk/', views.bulk_add_feeding, name='bulk_add_feeding'),
     path('toys/', views.ToyList.as_view(), name='toys_index'),
     path('toys/<int:pk>/', views.ToyDetail.as_view(), name='detail'),
     path('toys/create/', views.ToyCreate.as_view(), name='toys_create'),
@@ -34,14 +36,41 @@ urlpatterns = [
     path('cats/<int:cat_id>/add_feeding/', views.add_feeding, name='add_feeding'),
     # associate a toy with a cat (M:M) ^
     path('cats/<int:cat_id>/add_photo/', views.add_photo, name='add_photo'),
+    path('cats/<int:cat_id>/photo_upload_url/', views.photo_upload_url, name='photo_upload_url'),
+    path('cats/<int:cat_id>/confirm_photo/', views.confirm_photo, name='confirm_photo'),
+    path('photos/upload/', views.local_photo_upload, name='local_photo_upload'),
+    # ^ direct-to-storage photo uploads, see the comment above photo_upload_url
     path('cats/<int:cat_id>/assoc_toy/<int:toy_id>/', views.assoc_toy, name='assoc_toy'),
     path('cats/<int:cat_id>/assoc_toy/<int:toy_id>/delete/', views.assoc_toy_delete, name='assoc_toy_delete'),
+    path('cats/<int:cat_id>/available_toys/', views.available_toys, name='available_toys'),
+    # ^ returns the next page of available toys as JSON for the "Load More" button
     # toys paths added with model ^
+    path('search/', views.search_view, name='search'),
+    # ^ ranked search-as-you-type over cats and toys, answers JSON
+    path('export/<str:kind>.<str:fmt>', views.export_data, name='export_data'),
+    # ^ e.g. export/feedings.csv - streams the user's data as a download
+    path('api/<str:resource>/', api.api_list, name='api_list'),
+    path('api/<str:resource>/<int:pk>/', api.api_detail, name='api_detail'),
+    # ^ the read-only JSON API, see main_app/api.py
+    path('metrics', metrics.metrics_view, name='metrics'),
+    # ^ per-view query counts and timings for Prometheus, see main_app/metrics.py
     path('accounts/signup', views.signup, name='signup'),
     # we are staying consistent ^ with Django's prebuilt auth-based URLS, and laying
     # groundwork to build our own signup view.
 ]
 
+# the same urls, served by the async versions of their views (async_views.py).
+# catcollector/asgi_urls.py puts these in front of the ones above when we run
+# under ASGI
+async_urlpatterns = [
+    path('cats/', async_views.cats_index, name='index'),
+    path('cats/<int:cat_id>/', async_views.cats_details, name='details'),
+    path('cats/<int:cat_id>/add_photo/', async_views.add_photo, name='add_photo'),
+    path('cats/<int:cat_id>/assoc_toy/<int:toy_id>/', async_views.assoc_toy, name='assoc_toy'),
+    path('cats/<int:cat_id>/assoc_toy/<int:toy_id>/delete/', async_views.assoc_toy_delete,
+         name='assoc_toy_delete'),
+]
+
 """
 That name argument within each path is used to obtain the correct URL in templates
 using DTL's url template tag, this makes it so we dont need to hardcode the path
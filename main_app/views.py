@@ -1,9 +1,21 @@
 # Add the following import
 # from django.http import HttpResponse # this is for testing the routes
-from distutils.log import error
-from multiprocessing import context
-from nis import cat
-from django.shortcuts import render, redirect
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.http import (
+    Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse,
+    StreamingHttpResponse,
+)
+from django.shortcuts import get_object_or_404, render, redirect
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.views.decorators.csrf import csrf_exempt
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition, require_POST
 from django.views.generic.edit import CreateView # this generic import will allow
 # us to generate a simple create form based on our model.
 from django.views.generic.edit import UpdateView, DeleteView # you can just add them
@@ -22,13 +34,19 @@ from django.contrib.auth.decorators import login_required # this will make it so
 from django.contrib.auth.mixins import LoginRequiredMixin # this will import the
 # mixin that we will used to authorize/restrict the CLASS-based views, and which is
 # implemented with multiple inheritance
-from .models import Cat, Toy, Photo
-from .forms import FeedingForm
+from .models import MEALS, Cat, Feeding, Toy, Photo, true_counters
+from .signals import cats_changed
+from .caching import (
+    TOYS_VERSION_KEY, cache_page_per_user, cat_version_key, user_version_key,
+)
+from .forms import FeedingEntryForm, FeedingForm
+from .pagination import get_page_size, keyset_page
+from . import derivatives, etags, exports, rollups, search, uploads
+from .storage import get_storage # S3 (or local) photo storage lives in storage.py
+import json
 import uuid  # a python utility that will help us generate random strings
-import boto3 # this is the AWS boto3 library
 
-S3_BASE_URL = 'https://s3-us-west-1.amazonaws.com/'
-BUCKET = 'tuesdayscatcollector'
+CONFIRM_SALT = 'main_app.views.confirm_photo'
 
 """
 note: to DRY our code, we are including a base.html.
@@ -36,6 +54,14 @@ this will create a template inheritance base. a file that includes everything th
 will be going to EVERY page. sort of like django's version of partials
 """
 
+def today_for(request):
+    # works out today's date (in TIME_ZONE, since USE_TZ is on) the first time
+    # it is asked for during a request and reuses it after that, so every cat on
+    # the page agrees on what "today" is
+    if not hasattr(request, 'cat_today'):
+        request.cat_today = timezone.localdate()
+    return request.cat_today
+
 # Create your views here.
 def home(request):
     """
@@ -60,41 +86,183 @@ a FOLDER called cats first, then then within that we have our template.
 """
 
 @login_required # we'll need to place the decorator above the view we want to restrict
+@condition(etag_func=etags.cats_index_etag) # answers 304 if the browser's copy is current
+@cache_page_per_user('index', lambda request: [user_version_key(request.user.pk)])
 def cats_index(request):
     # This reads ALL cats, not just the logged in user's cats. this CAN be useful
     # if we want to have a space for everyone to show their contributions.
     # cats = Cat.objects.all()
-    cats = Cat.objects.filter(user=request.user)
+    today = today_for(request)
+    cats = (
+        Cat.objects.filter(user=request.user).with_summary(today)
+        .with_missed_meals(settings.MISSED_MEALS_DAYS, today)
+    )
     # this^ will filter and dsiplay the requesting user's cats only, or this v
     # cats = request.user.cat_set.all() , which displays all the cats set to the
     # current user.
-    return render(request, 'cats/index.html', { 'cats': cats })
+    # with_summary() and with_missed_meals() add the feeding/toy columns in the
+    # same query, and keyset_page only pulls one page of cats, ordered by name
+    # (id breaks ties)
+    page_size = get_page_size(
+        request, settings.CATS_PAGE_SIZE, settings.CATS_MAX_PAGE_SIZE
+    )
+    cats, next_cursor = keyset_page(
+        cats, ('name', 'id'), request.GET.get('after'), page_size
+    )
+    return render(request, 'cats/index.html', {
+        'cats': cats, 'next_cursor': next_cursor, 'page_size': page_size,
+        'missed_meals_days': settings.MISSED_MEALS_DAYS,
+        'is_first_page': not request.GET.get('after'),
+    })
 
 # we are going to be using seed data for testing. but the key vaule here references
 # the cats that will be in our index, connecting to the DB
 
 @login_required
+@condition(etag_func=etags.cats_details_etag)
+@cache_page_per_user(
+    'details', lambda request, cat_id: [cat_version_key(cat_id), TOYS_VERSION_KEY]
+)
 def cats_details(request, cat_id):
-    cat = Cat.objects.get(id=cat_id)
-    toys_cat_doesnt_have = Toy.objects.exclude(id__in=cat.toys.all().values_list('id'))
+    # prefetch_counted grabs every photo and toy for this cat up front (one
+    # query each), so the template never has to go back to the database no
+    # matter how many rows the cat has
+    today = today_for(request)
+    cat = Cat.objects.with_feeding_status(today).get(id=cat_id)
+    prefetch_counted(cat)
+    # the feeding history is the last couple of weeks from the daily rollup,
+    # not every feeding ever logged - the calendar page goes further back
+    history = rollups.history(cat.id, today, settings.FEEDING_HISTORY_DAYS)
+    # only the first page of toys the cat doesn't have - the catalogue is shared
+    # by everyone, so it can be huge. the rest come in through available_toys
+    toys_cat_doesnt_have, next_cursor = available_toys_page(request, cat.id)
     feeding_form = FeedingForm() # instantiating FeedingForm to be rendered
     return render(request, 'cats/details.html', {
-        'cat': cat, 'feeding_form': feeding_form, 'toys': toys_cat_doesnt_have
+        'cat': cat, 'feeding_form': feeding_form, 'toys': toys_cat_doesnt_have,
         # including feeding_form along with the cat model, and adding toys
+        'toys_next': next_cursor, 'toy_q': request.GET.get('toy_q', ''),
+        'history': history, 'missed_meals': sum(missed for _, _, missed in history),
+        'history_days': settings.FEEDING_HISTORY_DAYS,
+    })
+
+@login_required
+@cache_page_per_user('calendar', lambda request, cat_id: [cat_version_key(cat_id)])
+def feeding_calendar(request, cat_id):
+    # a heatmap of the meals a cat got each day, a column per week like a
+    # contributions graph. ?weeks= picks how far back it goes
+    cat = get_object_or_404(Cat, id=cat_id, user=request.user)
+    weeks = get_page_size(
+        request, settings.CALENDAR_WEEKS, settings.CALENDAR_MAX_WEEKS, param='weeks'
+    )
+    grid = rollups.calendar(cat.id, today_for(request), weeks)
+    days = [day for week in grid for day in week if day is not None]
+    return render(request, 'cats/calendar.html', {
+        'cat': cat, 'grid': grid, 'weeks': weeks,
+        'meals_fed': sum(day.meals_fed() for day in days),
+        'meals_missed': sum(len(MEALS) - day.meals_fed() for day in days),
     })
 
+def prefetch_counted(cat):
+    # prefetch_related for the cat's photos and toys, skipping whichever its
+    # counters say it has none of
+    prefetch_related_objects([cat], *[
+        name for name, count in (('photo_set', cat.photo_count), ('toys', cat.toy_count))
+        if count
+    ])
+
+def available_toys_page(request, cat_id):
+    # one page of the toys a cat doesn't have yet, optionally narrowed down by
+    # ?toy_q=, as a list (so the template can check AND loop without running the
+    # query twice) plus the cursor for the next page
+    toys = Toy.objects.available_for(cat_id).search(request.GET.get('toy_q'))
+    page_size = get_page_size(
+        request, settings.TOYS_PAGE_SIZE, settings.TOYS_MAX_PAGE_SIZE
+    )
+    return keyset_page(toys, ('name', 'id'), request.GET.get('after'), page_size)
+
+@login_required
+def available_toys(request, cat_id):
+    # the "Load More" button on the details page calls this with fetch() and
+    # gets back the next batch of toy cards as ready-to-insert html
+    toys, next_cursor = available_toys_page(request, cat_id)
+    html = render_to_string(
+        'cats/available_toys.html', {'toys': toys, 'cat_id': cat_id}, request=request
+    )
+    return JsonResponse({'html': html, 'next': next_cursor})
+
 @login_required
 def add_feeding(request, cat_id):
     # create the ModelForm using the data in request.POST
     form = FeedingForm(request.POST)
     # validate the form
     if form.is_valid():
-        # don't save the form to the db until it has the cat_id assigned
-        new_feeding = form.save(commit=False)
-        new_feeding.cat_id = cat_id
-        new_feeding.save()
+        # the form doesn't know the cat_id, so we add it here. get_or_create
+        # because each meal can only be logged once a day (see Feeding.Meta) -
+        # logging it again just leaves the existing feeding alone
+        Feeding.objects.get_or_create(cat_id=cat_id, **form.cleaned_data)
     return redirect('details', cat_id=cat_id)
 
+@login_required
+@require_POST
+def bulk_add_feeding(request):
+    """
+    logs lots of feedings in one request, for shelter staff doing a whole day
+    at once. expects JSON like
+        {"feedings": [{"cat": 1, "date": "2022-07-08", "meal": "B"}, ...]}
+    it's all or nothing: if any entry is invalid or names a cat that isn't
+    yours, nothing is saved and the response lists what was wrong.
+    """
+    try:
+        entries = json.loads(request.body)['feedings']
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'expected {"feedings": [...]}'}, status=400)
+    if not isinstance(entries, list) or len(entries) > settings.BULK_FEEDING_MAX:
+        return JsonResponse(
+            {'error': f'send a list of at most {settings.BULK_FEEDING_MAX} feedings'},
+            status=400,
+        )
+
+    errors, valid = [], []
+    for index, entry in enumerate(entries):
+        form = FeedingEntryForm(entry if isinstance(entry, dict) else {})
+        if form.is_valid():
+            data = form.cleaned_data
+            valid.append((index, (data['cat'], data['date'], data['meal'])))
+        else:
+            errors.append({'index': index, 'errors': form.errors})
+    cat_ids = {row[0] for _, row in valid}
+    # one query checks the user owns every cat mentioned
+    owned = set(Cat.objects.filter(user=request.user, id__in=cat_ids).values_list('id', flat=True))
+    for index, row in valid:
+        if row[0] not in owned:
+            errors.append({'index': index, 'errors': {'cat': ['Not one of your cats.']}})
+    if errors:
+        return JsonResponse({'errors': sorted(errors, key=lambda e: e['index'])}, status=400)
+    # a set, so repeats within the upload itself collapse into one
+    rows = {row for _, row in valid}
+
+    with transaction.atomic():
+        # and one query finds which of these were logged already
+        existing = set(
+            Feeding.objects.filter(cat_id__in=cat_ids, date__in={row[1] for row in rows})
+            .values_list('cat_id', 'date', 'meal')
+        )
+        new_rows = rows - existing
+        # ignore_conflicts covers anyone logging the same meal at the same
+        # moment - the unique constraint quietly drops the repeat
+        Feeding.objects.bulk_create(
+            [Feeding(cat_id=cat_id, date=day, meal=meal) for cat_id, day, meal in new_rows],
+            batch_size=500, ignore_conflicts=True,
+        )
+        # bulk_create skips the post_save signal, so update the caches, the
+        # cats' counters and the daily rollup ourselves
+        if new_rows:
+            cats_changed({row[0] for row in new_rows}, changes=true_counters())
+            rollups.refresh({(cat_id, day) for cat_id, day, _ in new_rows})
+    return JsonResponse({
+        'created': len(new_rows), 'duplicates': len(entries) - len(new_rows),
+    })
+
 @login_required
 def assoc_toy(request, cat_id, toy_id):
     Cat.objects.get(id=cat_id).toys.add(toy_id)
@@ -105,6 +273,15 @@ def assoc_toy_delete(request, cat_id, toy_id):
     Cat.objects.get(id=cat_id).toys.remove(toy_id)
     return redirect('details', cat_id=cat_id)
 
+def photo_key(filename):
+    return uuid.uuid4().hex[:6] + filename[filename.rfind('.'):]
+    # what uuid.uuid4() does is create a long, unique string of characters
+    # .hex with slice operator [:6] will shorten that unique string to only
+    # be 6 characters long.
+    # then + the file type that is being uploaded... we are taking the photo
+    # file's name[then rfinding the '.': <- and then slicing it right there]
+    # basically this will replace 'file_name.png' with 'bd504f.png'
+
 @login_required
 def add_photo(request, cat_id):
     # attempting to collect the photo file data
@@ -113,39 +290,141 @@ def add_photo(request, cat_id):
 
     # conditional logic to determine if file is present...
     if photo_file:
-        # ...if it IS then we will create a reference to the boto3 client
-        s3 = boto3.client('s3')
-        # we'll then need a unique "key" for S3, and an image file extension too
-        key = uuid.uuid4().hex[:6] + photo_file.name[photo_file.name.rfind('.'):]
-            # what uuid.uuid4() does is create a long, unique string of characters
-            # .hex with slice operator [:6] will shorten that unique string to only
-            # be 6 characters long.
-            # then + the file type that is being uploaded... we are taking the photo
-            # file's name[then rfinding the '.': <- and then slicing it right there]
-            # basically this will replace 'file_name.png' with 'bd504f.png'
-
-        # if the IF above is successful...
-        try:
-            # ...upload that photo file to aws s3. any time we upload to s3 it will
-            # give us a predictable URL in exchange.
-            s3.upload_fileobj(photo_file, BUCKET, key)
-            # we will take the exchanged url and save it to the database, URLs
-            # exchanged with aws s3 will always be laid out this way
-            url = f"{S3_BASE_URL}{BUCKET}/{key}"
-                # reminder that we defined S3_BASE_URL and BUCKET at the top and key
-                # within this def's if statement
-            # this will create a photo instance with the photo model we have and
-            # provide the cat_id as as a foreign key value
-            photo = Photo(url=url, cat_id=cat_id)
-            # save the photo instance
-            photo.save()
-        # if the IF above is not successful...
-        except Exception as error:
-            # print an error message along with what caused it as defined above
-            print('An error occurred uploading file to S3:', error)
-    # finally we will redirect to the details page
+        # we'll need a unique "key" for storage, and an image file extension too
+        key = photo_key(photo_file.name)
+
+        # storage urls are predictable, so the photo can be saved right away as
+        # "pending"... any time we upload to s3 it will give us a predictable URL
+        photo = Photo.objects.create(
+            url=get_storage().url(key), key=key, cat_id=cat_id, status=Photo.PENDING
+        )
+        # ...and the actual upload happens in the background (see uploads.py),
+        # which marks the photo ready, or failed if storage keeps refusing it
+        uploads.enqueue(photo, photo_file)
+    # finally we will redirect to the details page, without waiting on the upload
     return redirect('details', cat_id=cat_id)
 
+# direct uploads: rather than sending the photo through add_photo (and through
+# our servers), the browser asks photo_upload_url for a presigned form, posts
+# the file straight to storage with it, then calls confirm_photo to save the
+# Photo row. the confirm token is signed, so it can only confirm the exact key
+# we handed out, for the cat we handed it out for
+
+@login_required
+@require_POST
+def photo_upload_url(request, cat_id):
+    cat = get_object_or_404(Cat, id=cat_id, user=request.user)
+    key = photo_key(request.POST.get('filename', ''))
+    upload = get_storage().presigned_post(
+        key, settings.PHOTO_UPLOAD_MAX_SIZE, settings.PHOTO_UPLOAD_URL_EXPIRES
+    )
+    confirm_token = signing.dumps({'cat': cat.id, 'key': key}, salt=CONFIRM_SALT)
+    return JsonResponse({
+        'url': upload['url'], 'fields': upload['fields'], 'confirm_token': confirm_token,
+    })
+
+@login_required
+@require_POST
+def confirm_photo(request, cat_id):
+    cat = get_object_or_404(Cat, id=cat_id, user=request.user)
+    try:
+        grant = signing.loads(
+            request.POST.get('confirm_token', ''), salt=CONFIRM_SALT,
+            max_age=settings.PHOTO_UPLOAD_URL_EXPIRES * 2,
+        )
+    except signing.BadSignature:
+        return JsonResponse({'error': 'invalid or expired upload'}, status=400)
+    storage = get_storage()
+    if grant['cat'] != cat.id or not storage.exists(grant['key']):
+        return JsonResponse({'error': 'upload not found'}, status=400)
+    # get_or_create so a double-click on confirm doesn't make two photos
+    photo, created = Photo.objects.get_or_create(
+        cat=cat, key=grant['key'], defaults={'url': storage.url(grant['key'])}
+    )
+    if created: # thumbnails get made in the background, like for add_photo
+        transaction.on_commit(lambda: uploads.background(derivatives.generate, photo.id))
+    return JsonResponse({'id': photo.id, 'url': photo.url})
+
+@csrf_exempt # the browser posts here like it would to S3 - the signed token
+@require_POST # is the permission slip, not the session
+def local_photo_upload(request):
+    # only LocalStorage hands out urls to this view. it plays the part of the
+    # S3 endpoint for local development and tests
+    storage = get_storage()
+    if not hasattr(storage, 'accept_upload'):
+        raise Http404
+    photo_file = request.FILES.get('file')
+    if photo_file is None:
+        return HttpResponseBadRequest('no file')
+    try:
+        storage.accept_upload(
+            request.POST.get('token', ''), photo_file, settings.PHOTO_UPLOAD_URL_EXPIRES
+        )
+    except (signing.BadSignature, ValueError) as error:
+        return HttpResponseForbidden(str(error))
+    return HttpResponse(status=204)
+
+@login_required
+def search_view(request):
+    """
+    search-as-you-type as JSON: /search/?q=lo&type=cats finds Lolo.
+    type is cats, toys or all (the default). you only ever find your own cats,
+    but every toy. the best matches come first
+    """
+    query = request.GET.get('q', '')
+    kind = request.GET.get('type', 'all')
+    if kind not in ('all', 'cats', 'toys'):
+        return HttpResponseBadRequest('type should be cats, toys or all')
+    limit = get_page_size(
+        request, settings.SEARCH_LIMIT, settings.SEARCH_MAX_LIMIT, param='limit'
+    )
+    results = {}
+    if kind in ('all', 'cats'):
+        results['cats'] = [
+            {**cat, 'url': reverse('details', args=[cat['id']])}
+            for cat in search.search_cats(request.user, query, limit)
+        ]
+    if kind in ('all', 'toys'):
+        results['toys'] = [
+            {**toy, 'url': reverse('detail', args=[toy['id']])}
+            for toy in search.search_toys(query, limit)
+        ]
+    return JsonResponse(results)
+
+@login_required
+def export_data(request, kind, fmt):
+    """
+    downloads everything of one kind (cats, feedings, photos or toys) for the
+    logged in user as csv or jsonl, e.g. /export/feedings.csv?since=2022-01-01.
+    since/until narrow feedings down by date and ?gzip=1 compresses the
+    download on the fly. it streams, so even huge exports start right away
+    """
+    if kind not in exports.KINDS or fmt not in exports.FORMATS:
+        raise Http404
+    try:
+        since, until = (_parse_date_param(request, name) for name in ('since', 'until'))
+    except ValueError as error:
+        return HttpResponseBadRequest(str(error))
+    compress = request.GET.get('gzip') in ('1', 'true')
+    filename = f'{kind}.{fmt}' + ('.gz' if compress else '')
+    response = StreamingHttpResponse(
+        exports.stream(kind, fmt, request.user, since, until, compress),
+        content_type='application/gzip' if compress else (
+            'text/csv' if fmt == 'csv' else 'application/jsonl'
+        ),
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+def _parse_date_param(request, name):
+    value = request.GET.get(name)
+    if not value:
+        return None
+    parsed = parse_date(value)
+    if parsed is None:
+        raise ValueError(f'{name} should look like 2022-07-08')
+    return parsed
+
 def signup(request):
     error_message = ''
     # IF the request is POST == we need to create a new user, because a form was
@@ -207,10 +486,14 @@ templates/main_app/cat_form.html. All CBVs by default will use a folder inside
 of the templates folder with a name the same as the app, in our case main_app.
 """
 
+# decorating get (not dispatch) means LoginRequiredMixin still gets to turn
+# away logged out visitors before any etag work happens
+@method_decorator(condition(etag_func=etags.toy_list_etag), name='get')
 class ToyList(LoginRequiredMixin, ListView):
     model = Toy
     template_name = 'toys/index.html'
 
+@method_decorator(condition(etag_func=etags.toy_detail_etag), name='get')
 class ToyDetail(LoginRequiredMixin, DetailView):
     model = Toy
     template_name = 'toys/detail.html'